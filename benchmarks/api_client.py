@@ -0,0 +1,92 @@
+# Compares handler throughput with a fresh blocking client per event (the old code path) against
+# the shared, pooled async client created at operator startup.
+#
+#   python3 -m benchmarks.api_client --events 500 --latency 0.005
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import time
+
+import kubernetes
+import kubernetes_asyncio
+
+import resources.safekeeper
+from benchmarks.fake_kube import FakeKubeApi
+
+
+def blocking_event(url: str, namespace: str):
+    # What every handler used to do: a new ApiClient and blocking calls on an executor thread.
+    configuration = kubernetes.client.Configuration(host=url)
+    kube_client = kubernetes.client.ApiClient(configuration)
+    statefulset, service = safekeeper_objects(namespace)
+    kubernetes.client.AppsV1Api(kube_client).create_namespaced_stateful_set(namespace=namespace, body=statefulset)
+    kubernetes.client.CoreV1Api(kube_client).create_namespaced_service(namespace=namespace, body=service)
+    kube_client.close()
+
+
+async def async_event(kube_client: kubernetes_asyncio.client.ApiClient, namespace: str):
+    statefulset, service = safekeeper_objects(namespace)
+    await kubernetes_asyncio.client.AppsV1Api(kube_client).create_namespaced_stateful_set(namespace=namespace,
+                                                                                          body=statefulset)
+    await kubernetes_asyncio.client.CoreV1Api(kube_client).create_namespaced_service(namespace=namespace,
+                                                                                     body=service)
+
+
+def safekeeper_objects(namespace: str):
+    resource_limits = kubernetes.client.V1ResourceRequirements(limits={"cpu": "100m", "memory": "200Mi"})
+    statefulset = resources.safekeeper.safekeeper_statefulset(namespace=namespace,
+                                                              resources=resource_limits,
+                                                              remote_storage_bucket_endpoint="http://minio:9000",
+                                                              remote_storage_bucket_name="neon",
+                                                              remote_storage_bucket_region="us-east-1",
+                                                              remote_storage_prefix_in_bucket="neon",
+                                                              image_pull_policy="IfNotPresent",
+                                                              image="neondatabase/neon",
+                                                              replicas=3)
+    return statefulset, resources.safekeeper.safekeeper_service(namespace)
+
+
+async def run_before(url: str, events: int, workers: int) -> float:
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        await asyncio.gather(*(loop.run_in_executor(executor, blocking_event, url, f"before-{i}")
+                               for i in range(events)))
+    return time.perf_counter() - started
+
+
+async def run_after(url: str, events: int, pool_size: int) -> float:
+    configuration = kubernetes_asyncio.client.Configuration(host=url)
+    configuration.connection_pool_maxsize = pool_size
+    async with kubernetes_asyncio.client.ApiClient(configuration=configuration) as kube_client:
+        started = time.perf_counter()
+        await asyncio.gather(*(async_event(kube_client, f"after-{i}") for i in range(events)))
+        return time.perf_counter() - started
+
+
+async def main(args):
+    api = FakeKubeApi(latency=args.latency)
+    url = await api.start()
+    try:
+        before = await run_before(url, args.events, args.workers)
+        after = await run_after(url, args.events, args.pool_size)
+    finally:
+        await api.stop()
+    report = {
+        "events": args.events,
+        "api_latency_seconds": args.latency,
+        "before": {"seconds": round(before, 3), "events_per_sec": round(args.events / before, 1)},
+        "after": {"seconds": round(after, 3), "events_per_sec": round(args.events / after, 1)},
+        "speedup": round(before / after, 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared async client vs per-event blocking client")
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.005, help="fake api server latency per request")
+    parser.add_argument("--workers", type=int, default=8, help="executor threads for the blocking path")
+    parser.add_argument("--pool-size", type=int, default=32, help="connection pool size for the async client")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,97 @@
+# Compares /attach-hook throughput with the generations written straight to the NeonTenant status against the
+# local SQLite store with group commit, mirrored to the status in the background.
+#
+#   python3 -m benchmarks.attach --callers 1000 --attaches 5 --latency 0.005
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import kubernetes_asyncio
+
+from benchmarks.fake_kube import FakeKubeApi
+from controlplane.generations import Generations, SqliteGenerationStore, StatusGenerationStore, StatusMirror
+from controlplane.tenants import TenantTable
+
+NAMESPACE = "bench"
+
+
+def tenant_table(tenants: int) -> TenantTable:
+    table = TenantTable()
+    table.replace({"metadata": {"name": f"tenant-{i}", "uid": f"00000000-0000-0000-0000-{i:012d}"},
+                   "spec": {}, "status": {}} for i in range(tenants))
+    table.ready.set()
+    return table
+
+
+async def caller(generations: Generations, tenant_ids: list, attaches: int, nodes: int, latencies: list):
+    for _ in range(attaches):
+        started = time.perf_counter()
+        await generations.attach(random.choice(tenant_ids), random.randrange(nodes))
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_store(generations: Generations, args) -> dict:
+    # None of the tenants is attached yet, they all belong to the default pageserver.
+    tenant_ids = [location.tenant_id for location in generations.table.on_node(0)]
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(caller(generations, tenant_ids, args.attaches, args.nodes, latencies)
+                           for _ in range(args.callers)))
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "seconds": round(seconds, 3),
+        "attaches_per_sec": round(len(latencies) / seconds, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+
+
+async def main(args):
+    api = FakeKubeApi(latency=args.latency)
+    url = await api.start()
+    configuration = kubernetes_asyncio.client.Configuration(host=url)
+    configuration.connection_pool_maxsize = args.pool_size
+    kube_client = kubernetes_asyncio.client.ApiClient(configuration=configuration)
+    report = {"callers": args.callers, "attaches": args.callers * args.attaches, "tenants": args.tenants,
+              "api_latency_seconds": args.latency}
+    try:
+        api.requests.clear()
+        status = Generations(tenant_table(args.tenants), StatusGenerationStore(kube_client, NAMESPACE))
+        report["status"] = await run_store(status, args)
+        report["status"]["api_requests"] = sum(api.requests.values())
+
+        with tempfile.TemporaryDirectory() as directory:
+            api.requests.clear()
+            store = SqliteGenerationStore(os.path.join(directory, "generations.db"))
+            mirror = StatusMirror(kube_client, NAMESPACE)
+            mirroring = asyncio.create_task(mirror.run())
+            sqlite = Generations(tenant_table(args.tenants), store, mirror)
+            await sqlite.load()
+            report["sqlite"] = await run_store(sqlite, args)
+            report["sqlite"]["commits"] = store.commits
+            mirroring.cancel()
+            await asyncio.gather(mirroring, return_exceptions=True)
+            report["sqlite"]["api_requests"] = sum(api.requests.values())
+            await store.close()
+    finally:
+        await kube_client.close()
+        await api.stop()
+    report["speedup"] = round(report["sqlite"]["attaches_per_sec"] / report["status"]["attaches_per_sec"], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Attach throughput of the generation stores")
+    parser.add_argument("--callers", type=int, default=1000, help="concurrent attach-hook callers")
+    parser.add_argument("--attaches", type=int, default=5, help="attaches made by each caller")
+    parser.add_argument("--tenants", type=int, default=1000)
+    parser.add_argument("--nodes", type=int, default=3, help="pageservers the tenants are attached to")
+    parser.add_argument("--latency", type=float, default=0.005, help="fake api server latency per request")
+    parser.add_argument("--pool-size", type=int, default=32, help="connection pool size for the api client")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+# Load test of a running control plane: hammers its endpoints one after the other with concurrent clients and
+# reports the requests/sec and p50/p99 latency of each one as JSON.
+#
+#   python3 control-plane-server.py &
+#   python3 -m benchmarks.control_plane --url http://127.0.0.1:1234 --requests 20000 --concurrency 256
+import argparse
+import asyncio
+import collections
+import json
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import aiohttp
+
+PROXY_PARAMS = {"session_id": "bench", "application_name": "bench", "project": "bench"}
+
+
+def endpoints(args) -> Dict[str, Callable]:
+    """
+    A request per endpoint, taking the session and the state kept between the requests of that endpoint
+    """
+    tenant_ids = args.tenant_ids or ["00000000000000000000000000000000"]
+
+    async def root(session: aiohttp.ClientSession, state: dict):
+        async with session.get(f"{args.url}/") as response:
+            await response.read()
+            return response.status
+
+    async def role_secret(session: aiohttp.ClientSession, state: dict):
+        async with session.get(f"{args.url}/proxy_get_role_secret",
+                               params={**PROXY_PARAMS, "role": "postgres"}) as response:
+            await response.read()
+            return response.status
+
+    async def wake_compute(session: aiohttp.ClientSession, state: dict):
+        async with session.get(f"{args.url}/proxy_wake_compute",
+                               params={**PROXY_PARAMS, "options": ""}) as response:
+            await response.read()
+            return response.status
+
+    async def compute_spec(session: aiohttp.ClientSession, state: dict):
+        # Polls like compute_ctl, sending back the ETag of the spec it got.
+        headers = {"If-None-Match": state["etag"]} if "etag" in state else {}
+        async with session.get(f"{args.url}/compute/api/v2/computes/{args.compute_id}/spec",
+                               headers=headers) as response:
+            await response.read()
+            if "ETag" in response.headers:
+                state["etag"] = response.headers["ETag"]
+            return response.status
+
+    async def validate(session: aiohttp.ClientSession, state: dict):
+        body = {"tenants": [{"id": tenant_id, "gen": 1} for tenant_id in tenant_ids]}
+        async with session.post(f"{args.url}/validate", json=body) as response:
+            await response.read()
+            return response.status
+
+    return {
+        "/": root,
+        "/proxy_get_role_secret": role_secret,
+        "/proxy_wake_compute": wake_compute,
+        "/compute/api/v2/computes/{compute_id}/spec": compute_spec,
+        "/validate": validate,
+    }
+
+
+async def run_endpoint(session: aiohttp.ClientSession, request: Callable, requests: int, concurrency: int) -> dict:
+    latencies: List[float] = []
+    statuses = collections.Counter()
+    remaining = iter(range(requests))
+    state = {}
+
+    async def client():
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                statuses[await request(session, state)] += 1
+            except aiohttp.ClientError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests_per_sec": round(requests / seconds, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000, 2),
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+    }
+
+
+async def main(args):
+    selected = endpoints(args)
+    if args.endpoints:
+        selected = {path: request for path, request in selected.items() if path in args.endpoints}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    report = {"url": args.url, "requests": args.requests, "concurrency": args.concurrency, "endpoints": {}}
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for path, request in selected.items():
+            # A short warm up, filling the connection pool and the caches of the control plane.
+            await run_endpoint(session, request, min(args.concurrency, args.requests), args.concurrency)
+            report["endpoints"][path] = await run_endpoint(session, request, args.requests, args.concurrency)
+    result = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    print(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Requests/sec and latency of the control plane endpoints")
+    parser.add_argument("--url", default="http://127.0.0.1:1234")
+    parser.add_argument("--requests", type=int, default=10000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=128, help="concurrent clients and connections")
+    parser.add_argument("--endpoints", nargs="+", help="only load these endpoint paths")
+    parser.add_argument("--compute-id", default="0")
+    parser.add_argument("--tenant-ids", nargs="+", help="tenant ids sent to /validate")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,86 @@
+# A minimal in-process stand-in for the kubernetes api server, used by the benchmarks.
+import asyncio
+import collections
+import json
+from typing import Dict, Tuple
+
+from aiohttp import web
+
+
+class FakeKubeApi:
+    """
+    Serves create/read/patch/delete requests for namespaced objects from memory.
+
+    Attributes:
+        latency (float): Artificial delay in seconds added to every request.
+        objects (Dict[str, dict]): Stored objects keyed by their request path.
+        requests (Dict[Tuple[str, str], int]): Request counts keyed by (verb, resource).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects: Dict[str, dict] = {}
+        self.requests: Dict[Tuple[str, str], int] = collections.Counter()
+        self._runner = None
+        self.url = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        parts = request.path.strip("/").split("/")
+        verb = request.method.lower()
+        if verb == "post":
+            resource = parts[-1]
+            body = await request.json()
+            name = body.get("metadata", {}).get("name", "")
+            path = f"{request.path}/{name}"
+            self.requests[(verb, resource)] += 1
+            if path in self.objects:
+                return self._status(409, "AlreadyExists")
+            self.objects[path] = body
+            return web.json_response(body, status=201)
+        resource = parts[-2] if len(parts) > 1 else parts[-1]
+        self.requests[(verb, resource)] += 1
+        if verb == "get":
+            if request.path not in self.objects:
+                return self._status(404, "NotFound")
+            return web.json_response(self.objects[request.path])
+        if verb == "patch":
+            body = json.loads(await request.text())
+            self.objects[request.path] = _merge(self.objects.get(request.path, {}), body)
+            return web.json_response(self.objects[request.path])
+        if verb == "delete":
+            if self.objects.pop(request.path, None) is None:
+                return self._status(404, "NotFound")
+            return self._status(200, "Success")
+        return self._status(405, "MethodNotAllowed")
+
+    @staticmethod
+    def _status(code: int, reason: str) -> web.Response:
+        return web.json_response({"kind": "Status", "apiVersion": "v1", "code": code, "reason": reason},
+                                 status=code)
+
+
+def _merge(current: dict, patch: dict) -> dict:
+    merged = dict(current)
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
@@ -0,0 +1,65 @@
+# A minimal in-process stand-in for the pageserver http api, used by the benchmarks.
+import asyncio
+import collections
+import re
+import uuid
+from typing import Dict, Tuple
+
+from aiohttp import web
+
+# Tenant and timeline ids, replaced by a placeholder in the request counts.
+_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class FakePageserver:
+    """
+    Answers the tenant and timeline management calls made by the operator with success, and the attach hook of the
+    control plane.
+
+    Attributes:
+        latency (float): Artificial delay in seconds added to every request.
+        requests (Dict[Tuple[str, str], int]): Request counts keyed by (method, path template).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests: Dict[Tuple[str, str], int] = collections.Counter()
+        self._runner = None
+        self.url = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.requests[(request.method, _ID.sub("{id}", request.path))] += 1
+        if request.path == "/attach-hook":
+            # The control plane hook issuing the generations, served by the same stand-in.
+            return web.json_response({"gen": 1})
+        if request.method == "GET" and request.path == "/metrics":
+            return web.Response(text="pageserver_resident_physical_size 0\nprocess_cpu_seconds_total 0\n")
+        if request.method == "GET" and request.path == "/v1/tenant":
+            return web.json_response([])
+        if request.method == "POST" and request.path.endswith("/timeline"):
+            body = await request.json()
+            return web.json_response({"tenant_id": request.path.split("/")[3],
+                                      "timeline_id": body["new_timeline_id"],
+                                      "pg_version": body.get("pg_version")}, status=201)
+        if request.method in ("POST", "PUT"):
+            return web.json_response(uuid.uuid4().hex, status=201 if request.method == "POST" else 200)
+        if request.method == "DELETE":
+            return web.Response(status=202)
+        return web.json_response({})
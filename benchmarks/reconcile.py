@@ -0,0 +1,223 @@
+# Drives NeonDeployment, NeonTenant and NeonTimeline objects through the handlers of main.py against
+# stand-ins for the kubernetes api and the pageserver, and reports the throughput as JSON.
+#
+#   python3 -m benchmarks.reconcile --sizes 10 100 1000 --output results.json
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import kopf
+import kubernetes_asyncio
+from kopf._cogs.structs import bodies, references
+from kopf._core.actions import execution
+from kopf._core.engines import posting
+from kopf._core.intents import causes
+
+from benchmarks.fake_kube import FakeKubeApi
+from benchmarks.fake_pageserver import FakePageserver
+from resources.placement import PageserverPod
+
+RESOURCES = {
+    plural: references.Resource(group="neon.tech", version="v1alpha1", plural=plural)
+    for plural in ("neondeployments", "neontenants", "neontimelines")
+}
+REASONS = {"create": causes.Reason.CREATE, "update": causes.Reason.UPDATE, "delete": causes.Reason.DELETE}
+
+
+def object_uid(namespace: str, kind: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{namespace}.{kind}"))
+
+
+def deployment_body(namespace: str, compute_cpu: str = "100m") -> dict:
+    return {
+        "apiVersion": "neon.tech/v1alpha1",
+        "kind": "NeonDeployment",
+        "metadata": {"name": "neon", "namespace": namespace, "uid": object_uid(namespace, "deployment")},
+        "spec": {
+            "storageConfig": {
+                "credentials": {"awsAccessKeyID": "minio", "awsSecretAccessKey": "password"},
+                "endpoint": "http://minio:9000",
+                "bucketName": "neon",
+                "bucketRegion": "us-east-1",
+                "prefixInBucket": "neon",
+            },
+            "computeNode": {"resources": {"limits": {"cpu": compute_cpu, "memory": "200Mi"}}},
+            "storageBroker": {},
+            "controlPlane": {},
+            "pageServer": {},
+            "safeKeeper": {},
+        },
+        "status": {},
+    }
+
+
+def tenant_body(namespace: str) -> dict:
+    return {
+        "apiVersion": "neon.tech/v1alpha1",
+        "kind": "NeonTenant",
+        "metadata": {"name": "tenant", "namespace": namespace, "uid": object_uid(namespace, "tenant")},
+        "spec": {},
+    }
+
+
+def timeline_body(namespace: str) -> dict:
+    return {
+        "apiVersion": "neon.tech/v1alpha1",
+        "kind": "NeonTimeline",
+        "metadata": {"name": "main", "namespace": namespace, "uid": object_uid(namespace, "timeline")},
+        "spec": {"tenant_id": uuid.UUID(object_uid(namespace, "tenant")).hex},
+    }
+
+
+def ready_indices(namespaces: List[str]) -> Dict[str, dict]:
+    # What the watch-fed indexes hold once the NeonDeployments are rolled out.
+    statefulsets, deployments, services, pageservers, tenants = {}, {}, {}, {}, {}
+    for namespace in namespaces:
+        statefulsets[(namespace, "safekeeper")] = [3]
+        statefulsets[(namespace, "pageserver")] = [1]
+        deployments[(namespace, "storage-broker")] = [1]
+        services[(namespace, "pageserver")] = [True]
+        services[(namespace, "storage-broker")] = [True]
+        pageservers[namespace] = [PageserverPod(node_id=0, name="pageserver-0", ready=True, cpu=1.0)]
+        tenant_id = uuid.UUID(object_uid(namespace, "tenant")).hex
+        tenants[(namespace, tenant_id)] = [((tenant_id, 0),)]
+    return {"ready_statefulsets": statefulsets, "ready_deployments": deployments,
+            "pre_requisite_services": services, "pageserver_pods": pageservers, "tenant_pageservers": tenants}
+
+
+async def invoke(handler: Callable, plural: str, action: str, raw: dict, indices: dict, memo: kopf.Memo,
+                 latencies: List[float]):
+    # Call the handler with the same kwargs and context kopf would give it.
+    body = bodies.Body(raw)
+    patch = kopf.Patch()
+    cause = causes.ChangingCause(logger=logging.getLogger("benchmark"), indices=indices, memo=memo,
+                                 resource=RESOURCES[plural], patch=patch, body=body, initial=False,
+                                 reason=REASONS[action])
+    kwargs = dict(cause.kwargs, retry=0, started=None, runtime=None, param=None)
+    token = execution.cause_var.set(cause)
+    started = time.perf_counter()
+    try:
+        await handler(**kwargs)
+    finally:
+        latencies.append(time.perf_counter() - started)
+        execution.cause_var.reset(token)
+    # Carry the status written by the handler into the next phase, as kopf does.
+    status = patch.get("status")
+    if status:
+        raw.setdefault("status", {}).update(status)
+
+
+async def run_phase(main, phase: str, objects: Dict[str, List[dict]], indices: dict, memo: kopf.Memo) -> dict:
+    handlers = {
+        ("neondeployments", "create"): main.create_deployment,
+        ("neondeployments", "update"): main.update_deployment,
+        ("neondeployments", "delete"): main.delete_deployment,
+        ("neontenants", "create"): main.create_tenant,
+        ("neontenants", "update"): main.update_tenant,
+        ("neontenants", "delete"): main.delete_tenant,
+        ("neontimelines", "create"): main.create_timeline,
+        ("neontimelines", "update"): main.update_timeline,
+        ("neontimelines", "delete"): main.delete_timeline,
+    }
+    latencies: List[float] = []
+    # Deployments come first on creation and last on deletion, like in a cluster being brought up and down.
+    order = list(objects) if phase != "delete" else list(reversed(objects))
+    started = time.perf_counter()
+    for plural in order:
+        await asyncio.gather(*(invoke(handlers[(plural, phase)], plural, phase, raw, indices, memo, latencies)
+                               for raw in objects[plural]))
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "events": len(latencies),
+        "seconds": round(seconds, 3),
+        "events_per_sec": round(len(latencies) / seconds, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+    }
+
+
+async def run_size(main, size: int, args) -> dict:
+    api = FakeKubeApi(latency=args.api_latency)
+    pageserver = FakePageserver(latency=args.pageserver_latency)
+    kube_url = await api.start()
+    pageserver_url = await pageserver.start()
+    main.PAGESERVER_URL = pageserver_url
+    main.PAGESERVER_NODE_URL = pageserver_url
+    main.CONTROL_PLANE_URL = pageserver_url
+    configuration = kubernetes_asyncio.client.Configuration(host=kube_url)
+    configuration.connection_pool_maxsize = args.pool_size
+    memo = kopf.Memo()
+    memo.kube_client = main.resources.metrics.instrument(kubernetes_asyncio.client.ApiClient(configuration))
+    memo.retry_policy = main.resources.retry.RetryPolicy()
+    memo.retry_limiter = main.resources.retry.NamespaceLimiter()
+    memo.pre_requisite_wakeups = main.resources.retry.Wakeups()
+    memo.pageserver_api = main.resources.pageserver_api.PageserverClient(pool_size=args.pool_size)
+    memo.placement = main.resources.placement.Placement(memo.pageserver_api, pageserver_url)
+
+    namespaces = [f"bench-{i}" for i in range(size)]
+    objects = {
+        "neondeployments": [deployment_body(namespace) for namespace in namespaces],
+        "neontenants": [tenant_body(namespace) for namespace in namespaces],
+        "neontimelines": [timeline_body(namespace) for namespace in namespaces],
+    }
+    indices = ready_indices(namespaces)
+    report = {"size": size}
+    try:
+        for phase in ("create", "update", "delete"):
+            if phase == "update":
+                # A real change for the compute nodes, the other components are left untouched.
+                for raw in objects["neondeployments"]:
+                    raw["spec"]["computeNode"]["resources"]["limits"]["cpu"] = "200m"
+            api.requests.clear()
+            pageserver.requests.clear()
+            report[phase] = await run_phase(main, phase, objects, indices, memo)
+            report[phase]["api_requests"] = {f"{verb} {kind}": count
+                                             for (verb, kind), count in sorted(api.requests.items())}
+            report[phase]["pageserver_requests"] = {f"{method} {path}": count
+                                                    for (method, path), count in sorted(pageserver.requests.items())}
+    finally:
+        await memo.kube_client.close()
+        await memo.pageserver_api.close()
+        await api.stop()
+        await pageserver.stop()
+    # ru_maxrss is in kilobytes on Linux.
+    report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
+
+
+async def run(args):
+    os.environ.setdefault("PRE_REQUISITE_WAIT_SECONDS", "0")
+    import main
+
+    settings = kopf.OperatorSettings()
+    main.configure(settings=settings)
+    posting.settings_var.set(settings)
+    reports = [await run_size(main, size, args) for size in args.sizes]
+    result = json.dumps({
+        "api_latency_seconds": args.api_latency,
+        "pageserver_latency_seconds": args.pageserver_latency,
+        "results": reports,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    print(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile throughput of the operator handlers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+                        help="number of objects of each kind")
+    parser.add_argument("--api-latency", type=float, default=0.002, help="fake api server latency per request")
+    parser.add_argument("--pageserver-latency", type=float, default=0.005, help="fake pageserver latency per request")
+    parser.add_argument("--pool-size", type=int, default=32, help="connection pool size for the api client")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    asyncio.run(run(parser.parse_args()))
@@ -1,12 +1,55 @@
+import asyncio
+import contextlib
+import json
+import logging
 import os
+import uuid
 from enum import Enum
 from typing import Optional, List, Dict
 
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel
 
+from controlplane import catalogs as compute_catalogs
+from controlplane import computes as compute_specs
+from controlplane import confirm as catalog_confirm
+from controlplane import generations as tenant_generations
+from controlplane import leader as worker_leader
+from controlplane import logs
+from controlplane import metrics as control_plane_metrics
+from controlplane import pool as compute_pool
+from controlplane import profiles as settings_profiles
+from controlplane import roles as role_secrets
+from controlplane import safekeepers as compute_safekeepers
+from controlplane import suspend as compute_suspend
+from controlplane import tenants as tenant_table
+from controlplane import watch
+from resources.common import kube_api_client, parse_cpu, parse_memory
+
+# How long the handlers wait for the tenants and compute timelines to be loaded after a restart.
+TENANTS_READY_TIMEOUT_SECONDS = float(os.getenv("TENANTS_READY_TIMEOUT_SECONDS", "10"))
+# Worker processes serving the api, each one with its own watches and caches. Only one of them, the holder of the
+# leader lock, runs the background controllers.
+WORKERS = int(os.getenv("CONTROL_PLANE_WORKERS", "1"))
+LEADER_LOCK_PATH = os.getenv("CONTROL_PLANE_LEADER_LOCK", "/data/leader.lock")
+# Idle compute nodes kept running for the wake ups of the proxy, 0 disabling the warm pool.
+COMPUTE_WARM_POOL_SIZE = int(os.getenv("COMPUTE_WARM_POOL_SIZE", "0"))
+# How long a wake up waits for a compute node when the warm pool is empty.
+COMPUTE_WAKE_TIMEOUT_SECONDS = float(os.getenv("COMPUTE_WAKE_TIMEOUT_SECONDS", "60"))
+# How long a compute stays idle before it is suspended, for the NeonTimelines without a suspendTimeoutSeconds.
+COMPUTE_SUSPEND_TIMEOUT_SECONDS = int(os.getenv("COMPUTE_SUSPEND_TIMEOUT_SECONDS", "300"))
+# The resources of the compute pods and the workload profile their postgres settings are derived from, with the
+# settings set explicitly as a JSON object.
+COMPUTE_CPU = parse_cpu(os.getenv("COMPUTE_CPU"))
+COMPUTE_MEMORY = parse_memory(os.getenv("COMPUTE_MEMORY"))
+COMPUTE_SETTINGS_PROFILE = os.getenv("COMPUTE_SETTINGS_PROFILE") or settings_profiles.DEFAULT_PROFILE
+COMPUTE_SETTINGS_OVERRIDES = json.loads(os.getenv("COMPUTE_SETTINGS_OVERRIDES") or "{}")
+
+logger = logging.getLogger("control-plane")
+
 
 class GenericOption(BaseModel):
     """
@@ -145,7 +188,9 @@ class ComputeSpec(BaseModel):
         skip_pg_catalog_updates (bool): Whether to skip updates to the pg_catalog table.
         tenant_id (str): The ID of the tenant for which the compute operation is being performed.
         timeline_id (str): The ID of the timeline for which the compute operation is being performed.
-        pageserver_connstring (str): The connection string for the page server.
+        pageserver_connstring (str): The connection string for the page server, one per shard separated by commas
+            for a sharded tenant.
+        shard_stripe_size (Optional[int]): The stripe size of a sharded tenant, in pages.
         safekeeper_connstrings (List[str]): The list of connection strings for the safekeepers.
         mode (Optional[ComputeMode]): The mode in which the compute operation is to be performed.
         storage_auth_token (Optional[str]): The authentication token for the storage system.
@@ -159,6 +204,7 @@ class ComputeSpec(BaseModel):
     tenant_id: str
     timeline_id: str
     pageserver_connstring: str
+    shard_stripe_size: Optional[int] = None
     safekeeper_connstrings: List[str]
     mode: Optional[ComputeMode] = None
     storage_auth_token: Optional[str] = None
@@ -248,60 +294,154 @@ class WelcomeMessage(BaseModel):
     message: str
 
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    logs.configure(os.getenv("LOG_LEVEL", "INFO"))
+    namespace = os.getenv("NAMESPACE")
+    kube_client = await kube_api_client()
+    catalogs = compute_catalogs.catalog_store()
+    app.state.compute_specs = compute_specs.ComputeSpecs(render_compute_spec, catalogs)
+    # A tenant moving to another pageserver re-renders the specs of its computes.
+    app.state.tenants = tenant_table.TenantTable(
+        default_node_id=int(os.getenv("DEFAULT_PAGESERVER_NODE_ID", "0")),
+        changed=app.state.compute_specs.invalidate_tenant)
+    store, mirror = tenant_generations.generation_store(kube_client, namespace, workers=WORKERS)
+    # The mirror is handed over once this worker leads.
+    app.state.generations = tenant_generations.Generations(app.state.tenants, store)
+    # Loaded before the listing, which keeps the stored generations newer than the status.
+    await app.state.generations.load()
+    app.state.safekeepers = compute_safekeepers.Safekeepers(namespace, app.state.compute_specs.invalidate)
+    app.state.role_secrets = role_secrets.RoleSecrets(
+        role_secrets.timeline_reader(kube_client, namespace),
+        max_size=int(os.getenv("ROLE_SECRET_CACHE_SIZE", "10000")),
+        ttl_seconds=float(os.getenv("ROLE_SECRET_CACHE_TTL_SECONDS", "60")))
+    app.state.compute_pods = compute_pool.ComputePods()
+    app.state.compute_pool = compute_pool.ComputePool(kube_client, namespace, app.state.compute_specs,
+                                                      app.state.compute_pods, size=COMPUTE_WARM_POOL_SIZE,
+                                                      wake_timeout_seconds=COMPUTE_WAKE_TIMEOUT_SECONDS)
+    tasks = [
+        asyncio.create_task(tenant_table.TenantWatch(kube_client, namespace, app.state.tenants).run()),
+        asyncio.create_task(compute_specs.ComputeTimelineWatch(kube_client, namespace, app.state.compute_specs,
+                                                               app.state.role_secrets).run()),
+        asyncio.create_task(watch.PodWatch(kube_client, namespace, "app=compute-node", app.state.compute_pods).run()),
+        asyncio.create_task(watch.EndpointSliceWatch(kube_client, namespace, [compute_safekeepers.SAFEKEEPER_SERVICE,
+                                                                              compute_safekeepers.COMPUTE_SERVICE],
+                                                     app.state.safekeepers).run()),
+        asyncio.create_task(app.state.compute_specs.follow()),
+        asyncio.create_task(lead(worker_leader.Leader(LEADER_LOCK_PATH), store, mirror)),
+    ]
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        await store.close()
+        await catalogs.close()
+        await kube_client.close()
+        control_plane_metrics.exited()
+
+
+async def lead(leader: worker_leader.Leader, store: tenant_generations.GenerationStore,
+               mirror: Optional[tenant_generations.StatusMirror]):
+    """
+    Run the background controllers once this worker holds the leader lock: the warm pool resizing, the suspension
+    of the idle computes, the confirmation of the catalog changes and the mirror of the generations to the NeonTenant
+    status. The other workers only write with preconditions, when binding computes on wake up, or to the generation
+    and catalog stores.
+    """
+    await leader.acquire()
+    logger.info("Running the background controllers", extra={"pid": os.getpid()})
+    controllers = [
+        app.state.compute_pool.run(),
+        compute_suspend.Suspender(app.state.compute_pool,
+                                  default_timeout_seconds=COMPUTE_SUSPEND_TIMEOUT_SECONDS).run(),
+        catalog_confirm.CatalogConfirmer(app.state.compute_specs.catalogs, app.state.compute_specs,
+                                         app.state.compute_pods).run(),
+    ]
+    if mirror is not None:
+        # The attachments followed are compared with those of the listing.
+        await app.state.tenants.ready.wait()
+        app.state.generations.mirror = mirror
+        controllers += [mirror.run(), mirror.follow(store, app.state.tenants)]
+    try:
+        await asyncio.gather(*controllers)
+    finally:
+        leader.release()
+
+
 oauth2_scheme = HTTPBearer()
-app = FastAPI()
+# Responses are serialized with orjson.
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.mount("/metrics", control_plane_metrics.asgi_app())
+
+
+async def loaded(table, what: str):
+    """
+    A watch-fed table, once its initial listing is loaded
+    """
+    try:
+        await asyncio.wait_for(table.ready.wait(), TENANTS_READY_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"{what} are not loaded yet")
+    return table
+
+
+async def loaded_tenants() -> tenant_table.TenantTable:
+    """
+    The tenant table, once the initial listing is loaded: answering before would invalidate every tenant
+    """
+    return await loaded(app.state.tenants, "tenants")
 
 
 @app.get("/")
-def read_root() -> WelcomeMessage:
+async def read_root() -> WelcomeMessage:
     return WelcomeMessage(message="Control Panel API is running")
 
 
 @app.post("/re-attach")
 async def re_attach(re_attach_request: ReAttachRequest) -> ReAttachResponse:
     """
-    Re-attach is called to re-attach a tenant to a page server to acquire a new generation number.
+    Re-attach is called by a starting page server to acquire a new generation number for each of its tenants.
     """
-    print(f"Re-attaching pageserver node: {re_attach_request.node_id}")
-    # TODO: needs business logic.
-    tenants = []
-    tenants.append(ReAttachResponseTenant(id="9ef87a5bf0d92544f6fafeeb3239695c", gen=1))
+    logger.info("Re-attaching pageserver", extra={"node_id": re_attach_request.node_id})
+    await loaded_tenants()
+    locations = await app.state.generations.re_attach(tenant_table.node_id_of(re_attach_request.node_id))
+    tenants = [ReAttachResponseTenant(id=location.tenant_id, gen=location.generation) for location in locations]
     response = ReAttachResponse(tenants=tenants)
     return response
 
 
 @app.post("/validate")
-def validate(validate_request: ValidateRequest) -> ValidateResponse:
+async def validate(validate_request: ValidateRequest) -> ValidateResponse:
     """
-    Validate is called to validate the tenant generation numbers.
+    Validate is called to validate the tenant generation numbers, only the latest generation of a tenant is valid.
     """
-    tenants = []
-    for tenant in validate_request.tenants:
-        # TODO: get tenant from k8s resources
-        k8s_tenant = None
-        valid = True  # tenant.gen == k8s_tenant.gen
-        tenants.append(ValidateResponseTenant(id=tenant.id, valid=valid))
+    await loaded_tenants()
+    results = await app.state.generations.validate([(str(tenant.id), tenant.gen)
+                                                    for tenant in validate_request.tenants])
+    tenants = [ValidateResponseTenant(id=tenant_id, valid=valid) for tenant_id, valid in results]
     response = ValidateResponse(tenants=tenants)
     return response
 
 
 @app.post("/attach-hook")
-def attach_hook(request: AttachHookRequest) -> AttachHookResponse:
-    """
-    Attach hook is called to attach a tenant to a page server to acquire a new generation number.
-    """
-    tenant_state = None  # TODO: get tenant_state from k8s resource
-    # Check if tenant exists with tenant id i.e. request.tenant_id if not create it with gen=0 with page server id
-    # i.e. request.node_id and save it
-    if request.node_id != "":
-        print(f'tenant_id: {request.tenant_id}, ps_id: {request.node_id}, generation: 1, issuing')
-    elif tenant_state.pageserver != "":
-        print(
-            f'tenant_id: {request.tenant_id}, ps_id: {tenant_state.pageserver}, generation: {tenant_state.generation}, dropping')
-    else:
-        print(f'tenant_id: {request.tenant_id}, no-op: tenant already has no pageserver')
-
-    response = AttachHookResponse(gen=1)
+async def attach_hook(request: AttachHookRequest) -> AttachHookResponse:
+    """
+    Attach hook is called to attach a tenant to a page server to acquire a new generation number, or to detach it
+    when no page server is given.
+    """
+    await loaded_tenants()
+    node_id = tenant_table.node_id_of(request.node_id)
+    location = await app.state.generations.attach(str(request.tenant_id), node_id)
+    if location is None:
+        raise HTTPException(status_code=404, detail=f"tenant {request.tenant_id} not found")
+    logger.info("Issuing generation" if node_id is not None else "Detached tenant",
+                extra={"tenant_id": location.tenant_id, "node_id": node_id, "generation": location.generation})
+
+    response = AttachHookResponse(gen=location.generation)
     return response
 
 
@@ -318,13 +458,18 @@ class GetRoleSecret(BaseModel):
 
 # Proxy Authentication Endpoints
 @app.get("/proxy_get_role_secret")
-def proxy_get_role_secret(session_id: str, application_name: str, project: Optional[str],
-                          role: Optional[str]) -> GetRoleSecret:
-    """
-    Proxy get role secret is called to get the role secret for a given role.
-    """
-    print(f"Getting role secret for role: {role}")
-    role_secret = GetRoleSecret(role_secret="test")
+async def proxy_get_role_secret(session_id: str, application_name: str, project: Optional[str],
+                                role: Optional[str]) -> GetRoleSecret:
+    """
+    Proxy get role secret is called to get the role secret for a given role, the project being the name of the
+    NeonTimeline owning the role.
+    """
+    logger.debug("Getting role secret", extra={"role": role, "project": project, "session_id": session_id})
+    timeline_role = await app.state.role_secrets.get(project, role) if project and role else None
+    if timeline_role is None or timeline_role.encrypted_password is None:
+        raise HTTPException(status_code=404, detail=f"role {role} not found in project {project}")
+    allowed_ips = list(timeline_role.allowed_ips) if timeline_role.allowed_ips is not None else None
+    role_secret = GetRoleSecret(role_secret=timeline_role.encrypted_password, allowed_ips=allowed_ips)
     return role_secret
 
 
@@ -365,149 +510,225 @@ class WakeCompute(BaseModel):
 
 
 @app.get("/proxy_wake_compute")
-def proxy_wake_compute(session_id: str, application_name: str, project: Optional[str],
-                       options: Optional[str]) -> WakeCompute:
-    """
-    Proxy wake compute is called to wake a compute node.
-    """
-    print(f"Waking compute node")
-    wake_compute = WakeCompute(address="test",
-                               aux=MetricsAuxInfo(endpoint_id="test", project_id="test", branch_id="test"))
+async def proxy_wake_compute(session_id: str, application_name: str, project: Optional[str],
+                             options: Optional[str]) -> WakeCompute:
+    """
+    Proxy wake compute is called to wake a compute node, the project being the name of the NeonTimeline the
+    compute serves. A NeonTimeline served by no compute is bound to an idle one of the warm pool.
+    """
+    logger.debug("Waking compute node", extra={"project": project, "session_id": session_id})
+    await loaded(app.state.compute_specs, "compute timelines")
+    await loaded(app.state.compute_pods, "compute nodes")
+    try:
+        pod = await app.state.compute_pool.wake(project) if project else None
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"no compute node available for project {project}")
+    if pod is None:
+        raise HTTPException(status_code=404, detail=f"project {project} not found")
+    # None when the NeonTimeline was deleted while its compute was woken, which serves the default timeline then.
+    timeline = app.state.compute_specs.named(project)
+    logger.info("Woke compute node", extra={"project": project, "compute_id": pod.compute_id})
+    wake_compute = WakeCompute(address=pod.address,
+                               aux=MetricsAuxInfo(endpoint_id=project, project_id=project,
+                                                  branch_id=timeline.timeline_id if timeline is not None
+                                                  else DEFAULT_TIMELINE_ID))
     return wake_compute
 
 
-@app.get("/compute/api/v2/computes/{compute_id}/spec")
-def get_compute_spec(compute_id: str) -> ControlPlaneSpecResponse:
+# The postgres settings of every compute, the ones depending on its resources and workload are added by
+# compute_settings.
+COMPUTE_SETTINGS = [
+    GenericOption(
+        name="fsync",
+        value="off",
+        vartype="bool"
+    ),
+    GenericOption(
+        name="wal_level",
+        value="logical",
+        vartype="enum"
+    ),
+    GenericOption(
+        name="wal_log_hints",
+        value="on",
+        vartype="bool"
+    ),
+    GenericOption(
+        name="log_connections",
+        value="on",
+        vartype="bool"
+    ),
+    GenericOption(
+        name="port",
+        value="55433",
+        vartype="integer"
+    ),
+    GenericOption(
+        name="listen_addresses",
+        value="0.0.0.0",
+        vartype="string"
+    ),
+    GenericOption(
+        name="max_wal_senders",
+        value="10",
+        vartype="integer"
+    ),
+    GenericOption(
+        name="max_replication_slots",
+        value="10",
+        vartype="integer"
+    ),
+    GenericOption(
+        name="wal_sender_timeout",
+        value="5s",
+        vartype="string"
+    ),
+    GenericOption(
+        name="wal_keep_size",
+        value="0",
+        vartype="integer"
+    ),
+    GenericOption(
+        name="password_encryption",
+        value="md5",
+        vartype="enum"
+    ),
+    GenericOption(
+        name="restart_after_crash",
+        value="off",
+        vartype="bool"
+    ),
+    GenericOption(
+        name="synchronous_standby_names",
+        value="walproposer",
+        vartype="string"
+    ),
+    GenericOption(
+        name="shared_preload_libraries",
+        value="neon",
+        vartype="string"
+    ),
+]
+# Dummy values for the computes serving no NeonTimeline, to get the compute-node pods running.
+DEFAULT_TENANT_ID = "9ef87a5bf0d92544f6fafeeb3239695c"
+DEFAULT_TIMELINE_ID = "de200bd42b49cc1814412c7e592dd6e9"
+
+
+def compute_roles(timeline: Optional[compute_specs.ComputeTimeline]) -> List[Role]:
+    """
+    The roles of the timeline a compute serves, the postgres role only for the computes serving none
+    """
+    if timeline is None or not timeline.roles:
+        return [Role(name="postgres")]
+    return [Role(name=role.name, encrypted_password=role.encrypted_password) for role in timeline.roles]
+
+
+def compute_settings(timeline: Optional[compute_specs.ComputeTimeline]) -> List[GenericOption]:
+    """
+    The postgres settings of a compute, from the resources of the compute pods and the settings profile, both of
+    which the NeonTimeline it serves can override
+    """
+    overrides = dict(COMPUTE_SETTINGS_OVERRIDES)
+    profile = COMPUTE_SETTINGS_PROFILE
+    if timeline is not None:
+        overrides.update(timeline.settings)
+        profile = timeline.settings_profile or profile
+    base = {option.name: (option.value, option.vartype) for option in COMPUTE_SETTINGS}
+    settings = settings_profiles.compute_settings(base, COMPUTE_CPU, COMPUTE_MEMORY, profile, overrides)
+    return [GenericOption(name=name, value=value, vartype=vartype) for name, (value, vartype) in settings.items()]
+
+
+def compute_databases(timeline: Optional[compute_specs.ComputeTimeline]) -> List[Database]:
+    """
+    The databases of the timeline a compute serves, a test database for the timelines listing none
+    """
+    if timeline is None or not timeline.databases:
+        return [Database(name="testdatabase", owner="postgres")]
+    return [Database(name=database.name, owner=database.owner) for database in timeline.databases]
+
+
+def pageserver_connstring(timeline: Optional[compute_specs.ComputeTimeline]) -> str:
+    """
+    The pageserver the tenant of a timeline is attached to, the pageserver service when it is not known. A sharded
+    tenant gets the pageserver of each shard, by shard number
     """
-    Get compute spec is called to get the compute spec for a given compute_id
-    """
-    print(f"Getting compute spec for compute_id: {compute_id}")
     namespace = os.getenv("NAMESPACE")
-    # TODO: get the compute deployment from k8s using compute_id
-    # Dummy values to get the compute-node pods running
+    node_ids = app.state.tenants.pageservers(timeline.tenant_id) if timeline is not None else [None]
+    return ",".join(f"host=pageserver.{namespace}.svc.cluster.local port=6400" if node_id is None
+                    else f"host=pageserver-{node_id}.pageserver.{namespace}.svc.cluster.local port=6400"
+                    for node_id in node_ids)
+
+
+def render_compute_spec(compute_id: str, timeline: Optional[compute_specs.ComputeTimeline],
+                        change: Optional[compute_catalogs.CatalogChange]) -> bytes:
+    """
+    Render the compute spec of a compute, serving the timeline of its NeonTimeline if any. A compute serving none
+    gets an empty spec, compute_ctl waiting for it to be attached, as in the warm pool.
+    :param change: The catalog of the timeline, its catalog updates skipped once applied, its renames and deletions
+        applied by compute_ctl before it updates the whole catalog otherwise
+    """
+    delta_operations = []
+    if change is not None and not change.applied:
+        delta_operations = [DeltaOperation(action=operation.action, name=operation.name,
+                                           new_name=operation.new_name) for operation in change.operations]
+    # The uuid of an empty spec only depends on its compute, keeping its ETag the same across workers.
+    operation_uuid = change.operation_uuid if change is not None else str(uuid.uuid5(uuid.NAMESPACE_OID, compute_id))
     response = ControlPlaneSpecResponse(
         spec=ComputeSpec(
             format_version=1.0,
-            tenant_id="9ef87a5bf0d92544f6fafeeb3239695c",
-            timeline_id="de200bd42b49cc1814412c7e592dd6e9",
+            operation_uuid=operation_uuid,
+            tenant_id=timeline.tenant_id if timeline is not None else DEFAULT_TENANT_ID,
+            timeline_id=timeline.timeline_id if timeline is not None else DEFAULT_TIMELINE_ID,
             cluster=Cluster(
-                roles=[
-                    Role(
-                        name="postgres"
-                    )
-                ],
-                databases=[
-                    Database(
-                        name="testdatabase",
-                        owner="postgres"
-                    )
-                ],
-                settings=[
-                    GenericOption(
-                        name="fsync",
-                        value="off",
-                        vartype="bool"
-                    ),
-                    GenericOption(
-                        name="wal_level",
-                        value="logical",
-                        vartype="enum"
-                    ),
-                    GenericOption(
-                        name="wal_log_hints",
-                        value="on",
-                        vartype="bool"
-                    ),
-                    GenericOption(
-                        name="log_connections",
-                        value="on",
-                        vartype="bool"
-                    ),
-                    GenericOption(
-                        name="port",
-                        value="55433",
-                        vartype="integer"
-                    ),
-                    GenericOption(
-                        name="shared_buffers",
-                        value="1MB",
-                        vartype="string"
-                    ),
-                    GenericOption(
-                        name="max_connections",
-                        value="100",
-                        vartype="integer"
-                    ),
-                    GenericOption(
-                        name="listen_addresses",
-                        value="0.0.0.0",
-                        vartype="string"
-                    ),
-                    GenericOption(
-                        name="max_wal_senders",
-                        value="10",
-                        vartype="integer"
-                    ),
-                    GenericOption(
-                        name="max_replication_slots",
-                        value="10",
-                        vartype="integer"
-                    ),
-                    GenericOption(
-                        name="wal_sender_timeout",
-                        value="5s",
-                        vartype="string"
-                    ),
-                    GenericOption(
-                        name="wal_keep_size",
-                        value="0",
-                        vartype="integer"
-                    ),
-                    GenericOption(
-                        name="password_encryption",
-                        value="md5",
-                        vartype="enum"
-                    ),
-                    GenericOption(
-                        name="restart_after_crash",
-                        value="off",
-                        vartype="bool"
-                    ),
-                    GenericOption(
-                        name="synchronous_standby_names",
-                        value="walproposer",
-                        vartype="string"
-                    ),
-                    GenericOption(
-                        name="shared_preload_libraries",
-                        value="neon",
-                        vartype="string"
-                    ),
-                    GenericOption(
-                        name="max_replication_write_lag",
-                        value="500MB",
-                        vartype="string"
-                    ),
-                    GenericOption(
-                        name="max_replication_flush_lag",
-                        value="10GB",
-                        vartype="string"
-                    ),
-                ]
+                roles=compute_roles(timeline),
+                databases=compute_databases(timeline),
+                settings=compute_settings(timeline),
             ),
-            skip_pg_catalog_updates=False,
-            pageserver_connstring=f"host=pageserver.{namespace}.svc.cluster.local port=6400",
-            safekeeper_connstrings=[
-                f"safekeeper-0.safekeeper.{namespace}.svc.cluster.local:5454",
-                f"safekeeper-1.safekeeper.{namespace}.svc.cluster.local:5454",
-                f"safekeeper-2.safekeeper.{namespace}.svc.cluster.local:5454"
-            ],
+            delta_operations=delta_operations or None,
+            skip_pg_catalog_updates=change is None or change.applied,
+            pageserver_connstring=pageserver_connstring(timeline),
+            shard_stripe_size=app.state.tenants.stripe_size(timeline.tenant_id) if timeline is not None else None,
+            safekeeper_connstrings=app.state.safekeepers.connstrings(compute_id),
             mode=ComputeMode.primary,
         ),
-        status=ControlPlaneComputeStatus.Empty
+        status=ControlPlaneComputeStatus.Attached if timeline is not None else ControlPlaneComputeStatus.Empty
     )
-    return response
+    return response.model_dump_json().encode()
+
+
+@app.get("/compute/api/v2/computes/{compute_id}/spec", response_model=ControlPlaneSpecResponse)
+async def get_compute_spec(compute_id: str, request: Request) -> Response:
+    """
+    Get compute spec is called to get the compute spec for a given compute_id, compute_ctl polls it with the ETag
+    of the spec it has and gets a 304 while the spec is unchanged.
+    """
+    specs = await loaded(app.state.compute_specs, "compute timelines")
+    spec = await specs.get(compute_id)
+    headers = {"ETag": spec.etag}
+    if spec.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    logger.debug("Getting compute spec", extra={"compute_id": compute_id, "etag": spec.etag})
+    await specs.delivered(compute_id, spec)
+    return Response(content=spec.content, media_type="application/json", headers=headers)
+
+
+def serve():
+    """
+    Serve the api with CONTROL_PLANE_WORKERS worker processes, uvloop and httptools being used when installed
+    """
+    logs.configure(os.getenv("LOG_LEVEL", "INFO"))
+    if WORKERS > 1:
+        control_plane_metrics.share(os.getenv("PROMETHEUS_MULTIPROC_DIR") or "/tmp/control-plane-metrics")
+    # Several workers are started by uvicorn from the import string of the app.
+    uvicorn.run("control-plane-server:app" if WORKERS > 1 else app,
+                host=os.getenv("CONTROL_PLANE_HOST", "0.0.0.0"),
+                port=int(os.getenv("CONTROL_PLANE_PORT", "1234")),
+                workers=WORKERS,
+                backlog=int(os.getenv("CONTROL_PLANE_BACKLOG", "2048")),
+                timeout_keep_alive=int(os.getenv("CONTROL_PLANE_KEEP_ALIVE_SECONDS", "75")),
+                access_log=os.getenv("CONTROL_PLANE_ACCESS_LOG", "false").lower() == "true",
+                log_config=None)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=1234)
+    serve()
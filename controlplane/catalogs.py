@@ -0,0 +1,317 @@
+# The catalog of each timeline: the roles and databases a compute serving it last confirmed applying to its postgres,
+# and the change of them the specs of its computes carry until one confirms it. Kept in the database of the
+# generation store, so that it survives a restart of the control plane and is shared by its workers: a spec skips the
+# catalog updates once its catalog is applied, every change gets its own operation uuid, and the roles and databases
+# dropped from a timeline are deleted from the catalog last applied, whenever that was.
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# The roles, with their password, and the databases, with their owner, compute_ctl creates or updates in postgres.
+Catalog = Tuple[Tuple[Tuple[str, Optional[str]], ...], Tuple[Tuple[str, str], ...]]
+# A timeline, by (tenant id, timeline id).
+TimelineKey = Tuple[str, str]
+
+
+@dataclass(frozen=True)
+class CatalogOperation:
+    """
+    A change of a role or database compute_ctl applies before the roles and databases of the spec, which it
+    creates or updates itself.
+
+    Attributes:
+        action (str): delete_role, rename_role, delete_db or rename_db.
+        name (str): The role or database.
+        new_name (Optional[str]): The new name, for the renames.
+    """
+    action: str
+    name: str
+    new_name: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class CatalogChange:
+    """
+    The catalog the specs of the computes of a timeline carry.
+
+    Attributes:
+        catalog (Catalog): The roles and databases of the timeline.
+        operations (Tuple[CatalogOperation, ...]): The renames and deletions since the catalog last applied.
+        operation_uuid (str): The uuid of the change, a new one for every change of the catalog.
+        applied (bool): Whether a compute confirmed applying the change, its specs then skipping the catalog updates.
+    """
+    catalog: Catalog
+    operations: Tuple[CatalogOperation, ...] = ()
+    operation_uuid: str = ""
+    applied: bool = False
+
+
+def catalog_json(catalog: Optional[Catalog]) -> Optional[str]:
+    return json.dumps(catalog) if catalog is not None else None
+
+
+def catalog_of_json(value: Optional[str]) -> Optional[Catalog]:
+    if value is None:
+        return None
+    roles, databases = json.loads(value)
+    return tuple((name, password) for name, password in roles), tuple((name, owner) for name, owner in databases)
+
+
+def operations_json(operations: Iterable[CatalogOperation]) -> str:
+    return json.dumps([[operation.action, operation.name, operation.new_name] for operation in operations])
+
+
+def operations_of_json(value: str) -> Tuple[CatalogOperation, ...]:
+    return tuple(CatalogOperation(action, name, new_name) for action, name, new_name in json.loads(value))
+
+
+class CatalogStore:
+    """
+    Where the catalogs of the timelines are kept, in memory only: with the status generation store, which needs a
+    single worker, a restart updates the whole catalog of every timeline again.
+    """
+
+    def __init__(self):
+        # The change of each timeline, with the catalog last applied.
+        self._changes: Dict[TimelineKey, Tuple[CatalogChange, Optional[Catalog]]] = {}
+        self._deliveries: Dict[str, Tuple[TimelineKey, str, float]] = {}
+
+    @staticmethod
+    def _next(current: Optional[Tuple[CatalogChange, Optional[Catalog]]], catalog: Catalog,
+              operations: Callable[[Optional[Catalog]], List[CatalogOperation]]) \
+            -> Tuple[CatalogChange, Optional[Catalog]]:
+        """
+        The change of a timeline to a catalog, with the catalog last applied
+        """
+        applied = None
+        if current is not None:
+            change, applied = current
+            if change.catalog == catalog:
+                return change, applied
+        if applied is not None and applied == catalog:
+            # Back to the catalog applied, which is not a change.
+            return CatalogChange(catalog=catalog, operation_uuid=str(uuid.uuid4()), applied=True), applied
+        return CatalogChange(catalog=catalog, operations=tuple(operations(applied)),
+                             operation_uuid=str(uuid.uuid4())), applied
+
+    async def change(self, key: TimelineKey, catalog: Catalog,
+                     operations: Callable[[Optional[Catalog]], List[CatalogOperation]]) -> CatalogChange:
+        """
+        The change of the catalog of a timeline to the given one, recorded with a new operation uuid unless it is
+        the current one
+        :param operations: The operations of the change from the catalog last applied, None if none was
+        """
+        current = self._changes.get(key)
+        change, applied = self._next(current, catalog, operations)
+        if current is None or current[0] != change:
+            self._changes[key] = (change, applied)
+            self._forget_deliveries({key})
+        return change
+
+    async def delivered(self, compute_id: str, key: TimelineKey, operation_uuid: str):
+        """
+        Record that compute_ctl got a spec carrying a change, which it confirms applying later on
+        """
+        self._deliveries[compute_id] = (key, operation_uuid, time.time())
+
+    async def confirm(self, key: TimelineKey, operation_uuid: str) -> bool:
+        """
+        Record a change as applied, unless the catalog changed again since
+        :return: Whether the change was recorded as applied
+        """
+        current = self._changes.get(key)
+        if current is None or current[0].operation_uuid != operation_uuid or current[0].applied:
+            return False
+        change = current[0]
+        self._changes[key] = (CatalogChange(catalog=change.catalog, operations=change.operations,
+                                            operation_uuid=operation_uuid, applied=True), change.catalog)
+        self._forget_deliveries({key})
+        return True
+
+    async def read_all(self) -> Dict[TimelineKey, CatalogChange]:
+        return {key: change for key, (change, _) in self._changes.items()}
+
+    async def deliveries(self) -> Dict[str, Tuple[TimelineKey, str, float]]:
+        """
+        The change last delivered to each compute, with the unix time it was delivered at
+        """
+        return dict(self._deliveries)
+
+    async def forget(self, keys: Iterable[TimelineKey]):
+        """
+        Drop the catalogs of deleted timelines and the deliveries of their changes
+        """
+        keys = set(keys)
+        for key in keys:
+            self._changes.pop(key, None)
+        self._forget_deliveries(keys)
+
+    def _forget_deliveries(self, keys: Set[TimelineKey]):
+        self._deliveries = {compute_id: delivery for compute_id, delivery in self._deliveries.items()
+                            if delivery[0] not in keys}
+
+    async def close(self):
+        pass
+
+
+class SqliteCatalogStore(CatalogStore):
+    """
+    Keeps the catalogs of the timelines in the SQLite database of the generation store, shared by the workers. A
+    change is recorded in a transaction, which SQLite serializes between processes, so that the workers rendering
+    the specs of the same change give it the same operation uuid.
+
+    Attributes:
+        path (str): The path of the database file.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        # The connection is used from the executor threads one at a time.
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.execute("CREATE TABLE IF NOT EXISTS catalogs ("
+                               "tenant_id TEXT NOT NULL, timeline_id TEXT NOT NULL, catalog TEXT NOT NULL, "
+                               "operations TEXT NOT NULL, operation_uuid TEXT NOT NULL, applied TEXT, "
+                               "applied_uuid TEXT, PRIMARY KEY (tenant_id, timeline_id))")
+            connection.execute("CREATE TABLE IF NOT EXISTS catalog_deliveries ("
+                               "compute_id TEXT PRIMARY KEY, tenant_id TEXT NOT NULL, timeline_id TEXT NOT NULL, "
+                               "operation_uuid TEXT NOT NULL, delivered_at REAL NOT NULL)")
+            self._connection = connection
+        return self._connection
+
+    @staticmethod
+    def _row(catalog: str, operations: str, operation_uuid: str, applied: Optional[str],
+             applied_uuid: Optional[str]) -> Tuple[CatalogChange, Optional[Catalog]]:
+        return CatalogChange(catalog=catalog_of_json(catalog), operations=operations_of_json(operations),
+                             operation_uuid=operation_uuid, applied=applied_uuid == operation_uuid), \
+            catalog_of_json(applied)
+
+    def _change(self, key: TimelineKey, catalog: Catalog,
+                operations: Callable[[Optional[Catalog]], List[CatalogOperation]]) -> CatalogChange:
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT catalog, operations, operation_uuid, applied, applied_uuid FROM catalogs "
+                    "WHERE tenant_id = ? AND timeline_id = ?", key).fetchone()
+                current = self._row(*row) if row is not None else None
+                change, applied = self._next(current, catalog, operations)
+                if current is None or current[0] != change:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO catalogs (tenant_id, timeline_id, catalog, operations, operation_uuid, "
+                        "applied, applied_uuid) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (*key, catalog_json(change.catalog), operations_json(change.operations),
+                         change.operation_uuid, catalog_json(applied),
+                         change.operation_uuid if change.applied else None))
+                    # The previous change is no longer confirmed.
+                    connection.execute("DELETE FROM catalog_deliveries WHERE tenant_id = ? AND timeline_id = ?", key)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return change
+
+    def _delivered(self, compute_id: str, key: TimelineKey, operation_uuid: str):
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO catalog_deliveries (compute_id, tenant_id, timeline_id, operation_uuid, "
+                "delivered_at) VALUES (?, ?, ?, ?, ?)", (compute_id, *key, operation_uuid, time.time()))
+
+    def _confirm(self, key: TimelineKey, operation_uuid: str) -> bool:
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = connection.execute(
+                    "UPDATE catalogs SET applied = catalog, applied_uuid = operation_uuid "
+                    "WHERE tenant_id = ? AND timeline_id = ? AND operation_uuid = ? "
+                    "AND applied_uuid IS NOT operation_uuid", (*key, operation_uuid))
+                confirmed = cursor.rowcount > 0
+                if confirmed:
+                    connection.execute("DELETE FROM catalog_deliveries WHERE tenant_id = ? AND timeline_id = ?", key)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return confirmed
+
+    def _read_all(self) -> Dict[TimelineKey, CatalogChange]:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT tenant_id, timeline_id, catalog, operations, operation_uuid, applied, applied_uuid "
+                "FROM catalogs").fetchall()
+        return {(tenant_id, timeline_id): self._row(*row)[0] for tenant_id, timeline_id, *row in rows}
+
+    def _read_deliveries(self) -> Dict[str, Tuple[TimelineKey, str, float]]:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT compute_id, tenant_id, timeline_id, operation_uuid, delivered_at "
+                "FROM catalog_deliveries").fetchall()
+        return {compute_id: ((tenant_id, timeline_id), operation_uuid, delivered_at)
+                for compute_id, tenant_id, timeline_id, operation_uuid, delivered_at in rows}
+
+    def _forget(self, keys: List[TimelineKey]):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany("DELETE FROM catalogs WHERE tenant_id = ? AND timeline_id = ?", keys)
+                connection.executemany("DELETE FROM catalog_deliveries WHERE tenant_id = ? AND timeline_id = ?",
+                                       keys)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    async def change(self, key: TimelineKey, catalog: Catalog,
+                     operations: Callable[[Optional[Catalog]], List[CatalogOperation]]) -> CatalogChange:
+        return await asyncio.to_thread(self._change, key, catalog, operations)
+
+    async def delivered(self, compute_id: str, key: TimelineKey, operation_uuid: str):
+        await asyncio.to_thread(self._delivered, compute_id, key, operation_uuid)
+
+    async def confirm(self, key: TimelineKey, operation_uuid: str) -> bool:
+        return await asyncio.to_thread(self._confirm, key, operation_uuid)
+
+    async def read_all(self) -> Dict[TimelineKey, CatalogChange]:
+        return await asyncio.to_thread(self._read_all)
+
+    async def deliveries(self) -> Dict[str, Tuple[TimelineKey, str, float]]:
+        return await asyncio.to_thread(self._read_deliveries)
+
+    async def forget(self, keys: Iterable[TimelineKey]):
+        await asyncio.to_thread(self._forget, list(keys))
+
+    async def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def catalog_store(kind: str = None, path: str = None) -> CatalogStore:
+    """
+    The catalog store next to the generation store configured by GENERATION_STORE: in its SQLite database, in
+    memory with the status store
+    """
+    kind = kind or os.getenv("GENERATION_STORE", "sqlite")
+    if kind == "sqlite":
+        return SqliteCatalogStore(path or os.getenv("GENERATION_STORE_PATH", "/data/generations.db"))
+    return CatalogStore()
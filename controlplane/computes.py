@@ -0,0 +1,366 @@
+# Watch-fed cache of the compute specs served to compute_ctl. A spec is rendered once per change of the NeonTimeline
+# its compute serves, and the polls of an unchanged spec are answered with its ETag only. The catalog of each timeline
+# comes from the catalog store, so that a spec skips the catalog updates once a compute confirmed applying them.
+import asyncio
+import hashlib
+import logging
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import kubernetes_asyncio
+
+from controlplane.catalogs import Catalog, CatalogChange, CatalogOperation, CatalogStore, TimelineKey
+from controlplane.roles import RoleSecrets, TimelineRole, roles_of
+from controlplane.watch import CustomObjectWatch
+
+PLURAL = "neontimelines"
+
+
+@dataclass(frozen=True)
+class TimelineDatabase:
+    """
+    A postgres database of a NeonTimeline, from its spec.databases.
+
+    Attributes:
+        name (str): The name of the database.
+        owner (str): The role owning the database.
+        renamed_from (Optional[str]): The previous name of the database, when it is renamed.
+    """
+    name: str
+    owner: str
+    renamed_from: Optional[str] = None
+
+
+def databases_of(body: dict) -> Tuple[TimelineDatabase, ...]:
+    return tuple(TimelineDatabase(name=database["name"], owner=database["owner"],
+                                  renamed_from=database.get("renamedFrom"))
+                 for database in (body.get("spec") or {}).get("databases") or [])
+
+
+@dataclass(frozen=True)
+class ComputeTimeline:
+    """
+    A NeonTimeline and the compute node serving it, pinned by its spec.computeId or bound on wake up in its
+    status.computeId.
+
+    Attributes:
+        compute_id (Optional[str]): The compute node, the index of its pod, None if no compute serves it.
+        tenant_id (str): The pageserver tenant id.
+        timeline_id (str): The pageserver timeline id.
+        roles (Tuple[TimelineRole, ...]): The postgres roles of the timeline.
+        databases (Tuple[TimelineDatabase, ...]): The postgres databases of the timeline.
+        settings_profile (Optional[str]): The workload profile of the postgres settings, None for the default one.
+        settings (Tuple[Tuple[str, str], ...]): The postgres settings set explicitly, by name.
+        pinned (bool): Whether the compute is pinned by the spec, and then never suspended.
+        suspend_timeout_seconds (Optional[int]): The idle time after which the compute is suspended, 0 for never,
+            None for the default of the control plane.
+    """
+    compute_id: Optional[str]
+    tenant_id: str
+    timeline_id: str
+    roles: Tuple[TimelineRole, ...] = ()
+    databases: Tuple[TimelineDatabase, ...] = ()
+    settings_profile: Optional[str] = None
+    settings: Tuple[Tuple[str, str], ...] = ()
+    pinned: bool = False
+    suspend_timeout_seconds: Optional[int] = None
+
+
+def compute_timeline_of(body: dict) -> Optional[ComputeTimeline]:
+    """
+    The compute timeline of a NeonTimeline, None if it has no tenant
+    """
+    spec = body.get("spec") or {}
+    status = body.get("status") or {}
+    if spec.get("tenant_id") is None:
+        return None
+    compute_id = spec.get("computeId")
+    pinned = compute_id not in (None, "")
+    if not pinned:
+        compute_id = status.get("computeId")
+    # The same timeline id the operator creates the timeline with.
+    timeline_id = status.get("timelineId") or spec.get("id") or uuid.UUID(body["metadata"]["uid"]).hex
+    return ComputeTimeline(compute_id=str(compute_id) if compute_id not in (None, "") else None,
+                           tenant_id=spec["tenant_id"], timeline_id=timeline_id, roles=roles_of(body),
+                           databases=databases_of(body), settings_profile=spec.get("settingsProfile"),
+                           settings=tuple(sorted((name, str(value)) for name, value in
+                                                 (spec.get("settings") or {}).items())), pinned=pinned,
+                           suspend_timeout_seconds=spec.get("suspendTimeoutSeconds"))
+
+
+def catalog_of(timeline: ComputeTimeline) -> Catalog:
+    return (tuple((role.name, role.encrypted_password) for role in timeline.roles),
+            tuple((database.name, database.owner) for database in timeline.databases))
+
+
+def catalog_operations(applied: Optional[Catalog], timeline: ComputeTimeline) -> List[CatalogOperation]:
+    """
+    The renames and deletions turning the roles and databases last applied to a timeline into its current ones,
+    none when none was applied yet: compute_ctl then creates or updates the whole catalog
+    """
+    if applied is None:
+        return []
+    operations = []
+    for kind, entries, applied_names in (("role", timeline.roles, [name for name, _ in applied[0]]),
+                                         ("db", timeline.databases, [name for name, _ in applied[1]])):
+        names = {entry.name for entry in entries}
+        renamed = set()
+        for entry in entries:
+            if entry.renamed_from in applied_names and entry.name not in applied_names \
+                    and entry.renamed_from not in names and entry.renamed_from not in renamed:
+                operations.append(CatalogOperation(f"rename_{kind}", entry.renamed_from, entry.name))
+                renamed.add(entry.renamed_from)
+        operations.extend(CatalogOperation(f"delete_{kind}", name) for name in applied_names
+                          if name not in names and name not in renamed)
+    return operations
+
+
+@dataclass(frozen=True)
+class RenderedSpec:
+    """
+    A compute spec rendered to the bytes of its response.
+
+    Attributes:
+        etag (str): The quoted ETag of the response, a digest of its content.
+        content (bytes): The JSON response.
+        aliases (Tuple[str, ...]): The ETags of the previous specs this one only differs from by skipping the
+            catalog updates they applied, a compute having one of them being answered with a 304.
+    """
+    etag: str
+    content: bytes
+    aliases: Tuple[str, ...] = ()
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """
+        Whether an If-None-Match header names this spec, in which case the poll is answered with a 304
+        """
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip().removeprefix("W/")
+            if tag == "*" or tag == self.etag or tag in self.aliases:
+                return True
+        return False
+
+
+def etag_of(content: bytes) -> str:
+    return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+def rendered(content: bytes, aliases: Tuple[str, ...] = ()) -> RenderedSpec:
+    return RenderedSpec(etag=etag_of(content), content=content, aliases=aliases)
+
+
+class ComputeSpecs:
+    """
+    The compute specs of a namespace, rendered on first use and cached per compute until the NeonTimeline the
+    compute serves changes.
+
+    A spec carries the whole catalog of its timeline. Once a compute confirmed applying it, as recorded in the
+    catalog store, the spec skips the catalog updates of compute_ctl, with the ETag of the spec it applied as an
+    alias so that the running computes are not reconfigured for it. A change carries the renames and deletions
+    since the catalog last applied, under the operation uuid the store gave it, the same for every worker. The
+    changes confirmed by the leader are followed from the store.
+
+    Attributes:
+        render (Callable): Renders the spec of a compute id, the timeline it serves, None for the computes serving
+            no timeline, and the change of its catalog to the bytes of the response.
+        catalogs (CatalogStore): Where the catalog of each timeline is kept.
+        ready (asyncio.Event): Set once the initial listing is loaded.
+    """
+
+    def __init__(self, render: Callable[[str, Optional[ComputeTimeline], Optional[CatalogChange]], bytes],
+                 catalogs: Optional[CatalogStore] = None):
+        self.render = render
+        self.catalogs = catalogs or CatalogStore()
+        self.ready = asyncio.Event()
+        self._timelines: Dict[str, ComputeTimeline] = {}
+        self._resource_versions: Dict[str, str] = {}
+        self._by_compute: Dict[str, Set[str]] = {}
+        self._specs: Dict[str, RenderedSpec] = {}
+        # The change of the catalog of each timeline, and the one each spec carrying a change delivers.
+        self._changes: Dict[TimelineKey, CatalogChange] = {}
+        self._delivering: Dict[str, Tuple[TimelineKey, str]] = {}
+        # Bumped by every invalidation, a spec rendered across one is not cached.
+        self._epoch = 0
+        self._logger = logging.getLogger(__name__)
+
+    def __len__(self) -> int:
+        return len(self._timelines)
+
+    async def get(self, compute_id: str) -> RenderedSpec:
+        spec = self._specs.get(compute_id)
+        if spec is None:
+            epoch = self._epoch
+            timeline = self.timeline(compute_id)
+            change, aliases = None, ()
+            if timeline is not None:
+                change = await self._change(timeline)
+                if change.applied:
+                    # The spec carrying the change, which the running computes have.
+                    aliases = (etag_of(self.render(compute_id, timeline, CatalogChange(
+                        catalog=change.catalog, operations=change.operations,
+                        operation_uuid=change.operation_uuid))),)
+            spec = rendered(self.render(compute_id, timeline, change), aliases)
+            if epoch == self._epoch:
+                self._specs[compute_id] = spec
+                if change is not None and not change.applied:
+                    self._delivering[compute_id] = ((timeline.tenant_id, timeline.timeline_id),
+                                                    change.operation_uuid)
+                else:
+                    self._delivering.pop(compute_id, None)
+        return spec
+
+    async def _change(self, timeline: ComputeTimeline) -> CatalogChange:
+        """
+        The change of the catalog of a timeline, recorded in the catalog store when the NeonTimeline changed it
+        """
+        key, catalog = (timeline.tenant_id, timeline.timeline_id), catalog_of(timeline)
+        change = self._changes.get(key)
+        if change is None or change.catalog != catalog:
+            change = await self.catalogs.change(key, catalog, lambda applied: catalog_operations(applied, timeline))
+            self._changes[key] = change
+        return change
+
+    async def delivered(self, compute_id: str, spec: RenderedSpec):
+        """
+        Record that compute_ctl got the spec of a compute, the leader confirming the change it carries once the
+        compute applied it
+        """
+        delivering = self._delivering.get(compute_id)
+        if delivering is not None and self._specs.get(compute_id) is spec:
+            await self.catalogs.delivered(compute_id, *delivering)
+
+    async def sync(self):
+        """
+        Follow the changes of the catalogs recorded by the other workers, rendering the specs of the computes of a
+        timeline again once a change of its catalog is confirmed
+        """
+        changes = await self.catalogs.read_all()
+        for key, change in list(self._changes.items()):
+            if changes.get(key) != change:
+                # Recorded again on the next poll when the leader forgot it.
+                if key in changes:
+                    self._changes[key] = changes[key]
+                else:
+                    del self._changes[key]
+                for compute_id, names in self._by_compute.items():
+                    if any((self._timelines[name].tenant_id, self._timelines[name].timeline_id) == key
+                           for name in names):
+                        self.invalidate(compute_id)
+
+    async def follow(self, interval_seconds: float = 5):
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.warning(f"Reading the catalogs failed: {e}")
+            await asyncio.sleep(interval_seconds)
+
+    def invalidate(self, compute_id: Optional[str] = None):
+        """
+        Render the spec of a compute again on its next poll, those of every compute without one, after a change of
+        what the specs are rendered from besides the NeonTimelines
+        """
+        self._epoch += 1
+        if compute_id is None:
+            self._specs.clear()
+        else:
+            self._specs.pop(compute_id, None)
+
+    def invalidate_tenant(self, tenant_id: str):
+        """
+        Render the specs of the computes serving a timeline of a tenant again, after the tenant moved to another
+        pageserver
+        """
+        self._epoch += 1
+        for compute_id, names in self._by_compute.items():
+            if any(self._timelines[name].tenant_id == tenant_id for name in names):
+                self._specs.pop(compute_id, None)
+
+    def timeline(self, compute_id: str) -> Optional[ComputeTimeline]:
+        """
+        The timeline a compute serves, the first one by name when several NeonTimelines name the same compute
+        """
+        names = self._by_compute.get(compute_id)
+        if not names:
+            return None
+        return self._timelines[min(names)]
+
+    def named(self, name: str) -> Optional[ComputeTimeline]:
+        return self._timelines.get(name)
+
+    def served(self) -> Dict[str, ComputeTimeline]:
+        """
+        The timelines a compute serves, by name
+        """
+        return {name: timeline for name, timeline in self._timelines.items() if timeline.compute_id is not None}
+
+    def keys(self) -> Set[TimelineKey]:
+        """
+        The (tenant id, timeline id) of every timeline
+        """
+        return {(timeline.tenant_id, timeline.timeline_id) for timeline in self._timelines.values()}
+
+    def resource_version(self, name: str) -> Optional[str]:
+        return self._resource_versions.get(name)
+
+    def bound(self) -> Set[str]:
+        """
+        The compute ids serving a timeline
+        """
+        return {compute_id for compute_id, names in self._by_compute.items() if names}
+
+    def upsert(self, body: dict):
+        name = body["metadata"]["name"]
+        timeline = compute_timeline_of(body)
+        current = self._timelines.get(name)
+        if current is not None and current == timeline:
+            # Status updates and changes the spec does not depend on keep the cached spec.
+            self._resource_versions[name] = body["metadata"].get("resourceVersion")
+            return
+        self._discard(name)
+        if timeline is not None:
+            self._timelines[name] = timeline
+            self._resource_versions[name] = body["metadata"].get("resourceVersion")
+            if timeline.compute_id is not None:
+                self._by_compute.setdefault(timeline.compute_id, set()).add(name)
+                self._specs.pop(timeline.compute_id, None)
+
+    def remove(self, body: dict):
+        timeline = self._timelines.get(body["metadata"]["name"])
+        self._discard(body["metadata"]["name"])
+        if timeline is not None and (timeline.tenant_id, timeline.timeline_id) not in self.keys():
+            self._changes.pop((timeline.tenant_id, timeline.timeline_id), None)
+
+    def replace(self, bodies: Iterable[dict]):
+        self._epoch += 1
+        self._timelines, self._resource_versions, self._by_compute, self._specs = {}, {}, {}, {}
+        for body in bodies:
+            self.upsert(body)
+        keys = self.keys()
+        self._changes = {key: change for key, change in self._changes.items() if key in keys}
+
+    def _discard(self, name: str):
+        self._epoch += 1
+        timeline = self._timelines.pop(name, None)
+        self._resource_versions.pop(name, None)
+        if timeline is None or timeline.compute_id is None:
+            return
+        self._by_compute.get(timeline.compute_id, set()).discard(name)
+        self._specs.pop(timeline.compute_id, None)
+
+
+class ComputeTimelineWatch(CustomObjectWatch):
+    """
+    Lists the NeonTimelines of a namespace into the compute specs, and the role secrets they invalidate, and keeps
+    them up to date with a watch.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str, specs: ComputeSpecs,
+                 role_secrets: Optional[RoleSecrets] = None, timeout_seconds: int = 300):
+        tables = [specs] if role_secrets is None else [specs, role_secrets]
+        super().__init__(kube_client, namespace, PLURAL, *tables, timeout_seconds=timeout_seconds)
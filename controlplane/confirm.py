@@ -0,0 +1,91 @@
+# Confirmation of the catalog changes delivered to the computes: the status compute_ctl reports on its http port is
+# polled, and a change is recorded as applied in the catalog store once a compute it was delivered to runs without
+# error, its specs skipping the catalog updates from then on.
+import asyncio
+import logging
+import time
+from typing import Set
+
+import aiohttp
+
+from controlplane.catalogs import CatalogStore, TimelineKey
+from controlplane.computes import ComputeSpecs
+from controlplane.pool import ComputePod, ComputePods
+from controlplane.suspend import COMPUTE_CTL_PORT
+
+
+class CatalogConfirmer:
+    """
+    Confirms the catalog changes delivered to the computes, and forgets the catalogs of the deleted timelines.
+
+    The status of compute_ctl does not name the operation it applied: a change is confirmed when a compute it was
+    delivered to reports running, without error, the timeline of the change, at least settle_seconds after the
+    delivery, compute_ctl applying a spec as soon as it polls it. A change failing to apply leaves compute_ctl
+    failed and is delivered again with the next spec.
+
+    Attributes:
+        catalogs (CatalogStore): Where the changes and their deliveries are recorded.
+        specs (ComputeSpecs): The timelines of the namespace.
+        pods (ComputePods): The compute pods polled.
+        interval_seconds (float): How often the deliveries are checked.
+        settle_seconds (float): How long after its delivery a change is confirmed.
+    """
+
+    def __init__(self, catalogs: CatalogStore, specs: ComputeSpecs, pods: ComputePods, interval_seconds: float = 5,
+                 settle_seconds: float = 5, timeout_seconds: float = 5):
+        self.catalogs = catalogs
+        self.specs = specs
+        self.pods = pods
+        self.interval_seconds = interval_seconds
+        self.settle_seconds = settle_seconds
+        self.timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        # The catalogs of no timeline at the previous check: one created by another worker is forgotten only if
+        # this worker still misses its timeline at the next one.
+        self._missing: Set[TimelineKey] = set()
+        self._logger = logging.getLogger(__name__)
+
+    async def run(self):
+        async with aiohttp.ClientSession(timeout=self.timeout) as session:
+            while True:
+                try:
+                    await self.check(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._logger.warning(f"Confirming the catalog changes failed: {e}")
+                await asyncio.sleep(self.interval_seconds)
+
+    async def check(self, session: aiohttp.ClientSession):
+        changes = await self.catalogs.read_all()
+        if self.specs.ready.is_set():
+            missing = set(changes) - self.specs.keys()
+            if missing & self._missing:
+                await self.catalogs.forget(missing & self._missing)
+            self._missing = missing - self._missing
+        now = time.time()
+        candidates = []
+        for compute_id, (key, operation_uuid, delivered_at) in (await self.catalogs.deliveries()).items():
+            change = changes.get(key)
+            pod = self.pods.get(compute_id)
+            if change is None or change.applied or change.operation_uuid != operation_uuid \
+                    or now - delivered_at < self.settle_seconds or pod is None or not pod.ready:
+                continue
+            candidates.append((key, operation_uuid, pod))
+        applied = await asyncio.gather(*(self.applied(session, pod, key) for key, _, pod in candidates))
+        for (key, operation_uuid, pod), confirmed in zip(candidates, applied):
+            if confirmed and await self.catalogs.confirm(key, operation_uuid):
+                self._logger.info(f"The compute {pod.name} applied the catalog {operation_uuid} of {key[1]}.")
+
+    async def applied(self, session: aiohttp.ClientSession, pod: ComputePod, key: TimelineKey) -> bool:
+        """
+        Whether a compute runs the timeline of a change without error
+        """
+        try:
+            async with session.get(f"http://{pod.ip}:{COMPUTE_CTL_PORT}/status") as response:
+                response.raise_for_status()
+                status = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self._logger.debug(f"Reading the status of the compute {pod.name} failed: {e}")
+            return False
+        return status.get("status") == "running" and not status.get("error") \
+            and (status.get("tenant"), status.get("timeline")) == key
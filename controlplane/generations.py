@@ -0,0 +1,449 @@
+# Issues tenant generations for /re-attach and /attach-hook. A generation is persisted in a generation store before
+# it is handed out, so that a restarted control plane never issues the same generation twice, and is mirrored to the
+# status of the NeonTenant in the background.
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import kubernetes_asyncio
+from kubernetes_asyncio.client import ApiException
+
+from controlplane.tenants import PLURAL, TenantLocation, TenantTable, attachment_status
+from controlplane.watch import GROUP, VERSION
+
+
+async def patch_attachments(kube_client: kubernetes_asyncio.client.ApiClient, namespace: str,
+                            locations: List[TenantLocation]) -> List[Optional[BaseException]]:
+    """
+    Write the attachments to the status of the NeonTenants, concurrently
+    :return: The error of each write in the same order, None for the stored ones and the deleted tenants
+    """
+    custom_client = kubernetes_asyncio.client.CustomObjectsApi(kube_client)
+    results = await asyncio.gather(*(custom_client.patch_namespaced_custom_object(
+        group=GROUP, version=VERSION, plural=PLURAL, namespace=namespace, name=location.name,
+        body={"status": attachment_status(location)},
+        _content_type="application/merge-patch+json",
+    ) for location in locations), return_exceptions=True)
+    errors = []
+    for result in results:
+        # A tenant deleted meanwhile needs no generation anymore.
+        if isinstance(result, ApiException) and result.status == 404:
+            errors.append(None)
+        elif isinstance(result, BaseException):
+            errors.append(result)
+        else:
+            errors.append(None)
+    return errors
+
+
+class GenerationStore:
+    """
+    Where issued generations are persisted before they are handed out.
+
+    Attributes:
+        shared (bool): Whether other control plane workers issue generations in the same store.
+    """
+    shared = False
+
+    async def load(self) -> List[TenantLocation]:
+        """
+        The attachments stored by a previous run
+        """
+        return []
+
+    async def read(self, tenant_ids: Optional[List[str]] = None,
+                   node_id: Optional[int] = None) -> List[TenantLocation]:
+        """
+        The stored attachments of the given tenants and of the tenants attached to the given pageserver, only
+        needed from a shared store
+        """
+        return []
+
+    async def read_all(self) -> List[TenantLocation]:
+        """
+        All the stored attachments, only needed from a shared store
+        """
+        return []
+
+    async def write(self, locations: List[TenantLocation]) -> List[TenantLocation]:
+        """
+        Persist the attachments, returning once all of them are durable
+        :return: The attachments as stored, a shared store raising the generations another worker already issued
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class StatusGenerationStore(GenerationStore):
+    """
+    Stores the generations in the status of the NeonTenants only, every write being a round trip to the
+    kubernetes api.
+
+    Attributes:
+        namespace (str): The namespace of the NeonTenants.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str):
+        self.kube_client = kube_client
+        self.namespace = namespace
+
+    async def write(self, locations: List[TenantLocation]) -> List[TenantLocation]:
+        """
+        :raises ApiException: if any of the writes failed
+        """
+        for error in await patch_attachments(self.kube_client, self.namespace, locations):
+            if error is not None:
+                raise error
+        return locations
+
+
+class SqliteGenerationStore(GenerationStore):
+    """
+    Stores the generations in a SQLite database in WAL mode on the volume of the pod.
+
+    Writes are group committed: the writes arriving while a transaction is being committed are queued and
+    committed together by the next one, so concurrent attaches share a single fsync.
+
+    A store shared by several workers resolves the generations inside the write transaction, which SQLite
+    serializes between processes: a bump to a generation another worker already stored is raised above it.
+
+    Attributes:
+        path (str): The path of the database file.
+        shared (bool): Whether other control plane workers issue generations in the same database.
+        commits (int): The number of transactions committed, for the benchmarks.
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self.commits = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._readers = threading.local()
+        self._pending: List[Tuple[List[TenantLocation], asyncio.Future]] = []
+        self._committer: Optional[asyncio.Task] = None
+
+    def _open(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Sync the WAL on every commit, a generation must survive a crash once handed out.
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        connection.execute("CREATE TABLE IF NOT EXISTS attachments ("
+                           "tenant_id TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                           "node_id INTEGER, generation INTEGER NOT NULL)")
+        return connection
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # Only ever used by one thread at a time: the loading one, then the committing one.
+            self._connection = self._open()
+        return self._connection
+
+    def _reader(self) -> sqlite3.Connection:
+        # Reads run on any executor thread, each one with its own connection.
+        connection = getattr(self._readers, "connection", None)
+        if connection is None:
+            connection = self._readers.connection = self._open()
+        return connection
+
+    def _load(self) -> List[TenantLocation]:
+        rows = self._connect().execute("SELECT tenant_id, name, node_id, generation FROM attachments")
+        return [TenantLocation(tenant_id=tenant_id, name=name, node_id=node_id, generation=generation)
+                for tenant_id, name, node_id, generation in rows]
+
+    def _read(self, tenant_ids: Optional[List[str]], node_id: Optional[int]) -> List[TenantLocation]:
+        rows = self._reader().execute(
+            "SELECT tenant_id, name, node_id, generation FROM attachments "
+            "WHERE tenant_id IN (SELECT value FROM json_each(?)) OR node_id = ?",
+            (json.dumps(tenant_ids or []), node_id))
+        return [TenantLocation(tenant_id=tenant_id, name=name, node_id=node_id, generation=generation)
+                for tenant_id, name, node_id, generation in rows]
+
+    def _read_all(self) -> List[TenantLocation]:
+        rows = self._reader().execute("SELECT tenant_id, name, node_id, generation FROM attachments")
+        return [TenantLocation(tenant_id=tenant_id, name=name, node_id=node_id, generation=generation)
+                for tenant_id, name, node_id, generation in rows]
+
+    def _commit(self, locations: List[TenantLocation]) -> List[TenantLocation]:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.shared:
+                locations = self._resolve(connection, locations)
+            # Generations only ever grow, a write racing with a newer one for the same tenant is dropped.
+            connection.executemany(
+                "INSERT INTO attachments (tenant_id, name, node_id, generation) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (tenant_id) DO UPDATE SET name = excluded.name, node_id = excluded.node_id, "
+                "generation = excluded.generation WHERE excluded.generation >= attachments.generation",
+                [(location.tenant_id, location.name, location.node_id, location.generation)
+                 for location in locations])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self.commits += 1
+        return locations
+
+    @staticmethod
+    def _resolve(connection: sqlite3.Connection, locations: List[TenantLocation]) -> List[TenantLocation]:
+        # Detaching keeps the generation, attaching issues one above any stored by another worker or earlier in
+        # the batch.
+        latest: Dict[str, int] = {}
+        resolved = []
+        for location in locations:
+            if location.tenant_id not in latest:
+                row = connection.execute("SELECT generation FROM attachments WHERE tenant_id = ?",
+                                         (location.tenant_id,)).fetchone()
+                latest[location.tenant_id] = row[0] if row is not None else 0
+            stored = latest[location.tenant_id]
+            if location.node_id is not None and stored >= location.generation:
+                location = dataclasses.replace(location, generation=stored + 1)
+            latest[location.tenant_id] = max(stored, location.generation)
+            resolved.append(location)
+        return resolved
+
+    async def load(self) -> List[TenantLocation]:
+        return await asyncio.to_thread(self._load)
+
+    async def read(self, tenant_ids: Optional[List[str]] = None,
+                   node_id: Optional[int] = None) -> List[TenantLocation]:
+        return await asyncio.to_thread(self._read, tenant_ids, node_id)
+
+    async def read_all(self) -> List[TenantLocation]:
+        return await asyncio.to_thread(self._read_all)
+
+    async def write(self, locations: List[TenantLocation]) -> List[TenantLocation]:
+        """
+        :raises sqlite3.Error: if the transaction holding the attachments failed
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((locations, future))
+        if self._committer is None or self._committer.done():
+            self._committer = asyncio.create_task(self._commit_pending())
+        return await future
+
+    async def _commit_pending(self):
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                stored = await asyncio.to_thread(self._commit,
+                                                 [location for locations, _ in batch for location in locations])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for locations, future in batch:
+                written, stored = stored[:len(locations)], stored[len(locations):]
+                if not future.done():
+                    future.set_result(written)
+
+    async def close(self):
+        if self._committer is not None:
+            await asyncio.gather(self._committer, return_exceptions=True)
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class StatusMirror:
+    """
+    Copies the generations persisted by a local store to the status of the NeonTenants in the background,
+    only the latest attachment of a tenant being written. A single worker runs it: those issued by the other
+    workers are followed from the shared store.
+
+    Attributes:
+        namespace (str): The namespace of the NeonTenants.
+        retry_seconds (float): How long to wait before writing the attachments again after a failure.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str,
+                 retry_seconds: float = 1):
+        self.kube_client = kube_client
+        self.namespace = namespace
+        self.retry_seconds = retry_seconds
+        self._pending: Dict[str, TenantLocation] = {}
+        # The attachment last written to the status of each tenant.
+        self._mirrored: Dict[str, Tuple[Optional[int], int]] = {}
+        self._wakeup = asyncio.Event()
+        self._logger = logging.getLogger(__name__)
+
+    def submit(self, locations: List[TenantLocation]):
+        for location in locations:
+            pending = self._pending.get(location.tenant_id)
+            if pending is None or pending.generation <= location.generation:
+                self._pending[location.tenant_id] = location
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            batch, self._pending = list(self._pending.values()), {}
+            try:
+                errors = await patch_attachments(self.kube_client, self.namespace, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                errors = [e] * len(batch)
+            for location, error in zip(batch, errors):
+                if error is None:
+                    self._mirrored[location.tenant_id] = (location.node_id, location.generation)
+            failed = [location for location, error in zip(batch, errors) if error is not None]
+            if failed:
+                self._logger.warning(f"Mirroring {len(failed)} generations to the tenants of {self.namespace} "
+                                     f"failed: {next(error for error in errors if error is not None)}")
+                # Submitted again unless a newer attachment is already pending.
+                self.submit(failed)
+                await asyncio.sleep(self.retry_seconds)
+
+    async def follow(self, store: GenerationStore, table: TenantTable, interval_seconds: float = 5):
+        """
+        Mirror the attachments stored by any worker which the status of their NeonTenant is behind, the deleted
+        tenants excepted, including those stored before this worker started mirroring
+        """
+        while True:
+            try:
+                locations = await store.read_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.warning(f"Reading the generations of {self.namespace} failed: {e}")
+                locations = []
+            behind = []
+            for location in locations:
+                stored = (location.node_id, location.generation)
+                observed = table.observed(location.tenant_id)
+                if observed is None or observed == stored or observed[1] > location.generation:
+                    continue
+                if self._mirrored.get(location.tenant_id) != stored:
+                    behind.append(location)
+            if behind:
+                self.submit(behind)
+            await asyncio.sleep(interval_seconds)
+
+
+class Generations:
+    """
+    Issues tenant generations: bumps them in the table and persists them in the store before they are handed out.
+
+    The generations are reserved in memory before being written, so that concurrent attaches never wait for each
+    other and their writes can be committed together. A generation whose write failed is never handed out nor
+    reused: generations only need to grow, not to be contiguous.
+    """
+
+    def __init__(self, table: TenantTable, store: GenerationStore, mirror: Optional[StatusMirror] = None):
+        self.table = table
+        self.store = store
+        self.mirror = mirror
+        self._issued: Dict[str, int] = {}
+
+    async def load(self):
+        """
+        Load the generations stored by a previous run, before the tenants are listed: the listing keeps the
+        generations newer than the status, which the mirror then catches up with
+        """
+        locations = await self.store.load()
+        for location in locations:
+            self._record(location)
+        if self.mirror is not None and locations:
+            self.mirror.submit(locations)
+
+    def _reserve(self, location: TenantLocation, node_id: Optional[int]) -> TenantLocation:
+        generation = max(location.generation, self._issued.get(location.tenant_id, 0)) + 1
+        self._issued[location.tenant_id] = generation
+        return TenantLocation(tenant_id=location.tenant_id, name=location.name, node_id=node_id,
+                              generation=generation)
+
+    def _record(self, location: TenantLocation):
+        current = self.table.get(location.tenant_id)
+        if current is None or current.generation <= location.generation:
+            self.table.set(location)
+
+    async def _refresh(self, tenant_ids: Optional[List[str]] = None, node_id: Optional[int] = None):
+        """
+        Catch up with the generations issued by the other workers sharing the store, which the table only learns
+        about once they are mirrored to the status
+        """
+        if not self.store.shared:
+            return
+        for location in await self.store.read(tenant_ids, node_id):
+            # The tenants deleted meanwhile are not brought back.
+            if self.table.get(location.tenant_id) is not None:
+                self._record(location)
+
+    async def _issue(self, locations: List[TenantLocation]) -> List[TenantLocation]:
+        # Written before being handed out or applied: a failed write leaves the issued generations unused.
+        locations = await self.store.write(locations)
+        for location in locations:
+            self._issued[location.tenant_id] = max(self._issued.get(location.tenant_id, 0), location.generation)
+            self._record(location)
+        if self.mirror is not None:
+            self.mirror.submit(locations)
+        return locations
+
+    async def validate(self, tenants: List[Tuple[str, int]]) -> List[Tuple[str, bool]]:
+        """
+        Check the generations a pageserver holds, only the latest generation of a tenant is valid
+        :param tenants: The (tenant id, generation) pairs to check
+        :return: The (tenant id, valid) pairs in the same order
+        """
+        await self._refresh(tenant_ids=[tenant_id for tenant_id, _ in tenants])
+        return self.table.validate(tenants)
+
+    async def re_attach(self, node_id: int) -> List[TenantLocation]:
+        """
+        Issue a new generation for every tenant attached to a restarting pageserver
+        :return: The tenants to attach with their new generation
+        """
+        await self._refresh(tenant_ids=[location.tenant_id for location in self.table.on_node(node_id)],
+                            node_id=node_id)
+        return await self._issue([self._reserve(location, node_id) for location in self.table.on_node(node_id)])
+
+    async def attach(self, tenant_id: str, node_id: Optional[int]) -> Optional[TenantLocation]:
+        """
+        Attach a tenant to a pageserver with a new generation, or detach it when no pageserver is given,
+        keeping its generation
+        :return: The attachment of the tenant, None if the tenant is unknown
+        """
+        await self._refresh(tenant_ids=[tenant_id])
+        location = self.table.get(tenant_id)
+        if location is None:
+            return None
+        if node_id is None:
+            if location.node_id is None:
+                return location
+            detached = TenantLocation(tenant_id=location.tenant_id, name=location.name, node_id=None,
+                                      generation=location.generation)
+            return (await self._issue([detached]))[0]
+        return (await self._issue([self._reserve(location, node_id)]))[0]
+
+
+def generation_store(kube_client: kubernetes_asyncio.client.ApiClient, namespace: str,
+                     kind: str = None, path: str = None,
+                     workers: int = 1) -> Tuple[GenerationStore, Optional[StatusMirror]]:
+    """
+    The generation store configured by GENERATION_STORE, "sqlite" (default) or "status", with the mirror to the
+    NeonTenant status it needs
+    :param workers: The number of control plane workers issuing generations in the store
+    """
+    kind = kind or os.getenv("GENERATION_STORE", "sqlite")
+    if kind == "status":
+        if workers > 1:
+            # Merge patches of the status have no compare-and-swap, two workers could issue the same generation.
+            raise ValueError("The status generation store needs a single control plane worker")
+        return StatusGenerationStore(kube_client, namespace), None
+    if kind == "sqlite":
+        path = path or os.getenv("GENERATION_STORE_PATH", "/data/generations.db")
+        return SqliteGenerationStore(path, shared=workers > 1), StatusMirror(kube_client, namespace)
+    raise ValueError(f"Unknown generation store: {kind}")
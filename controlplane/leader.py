@@ -0,0 +1,51 @@
+# Picks the worker process of the control plane pod which runs the background controllers: the one holding an
+# exclusive lock on a file of the pod's volume. The other workers only serve the api from their watch-fed tables.
+import asyncio
+import fcntl
+import os
+from typing import Optional
+
+
+class Leader:
+    """
+    An exclusive lock on a file shared by the worker processes of the pod, held by one of them at a time. The lock
+    is released when its process exits, another worker then takes it over.
+
+    Attributes:
+        path (str): The path of the lock file.
+        poll_seconds (float): How often a worker not holding the lock tries to take it.
+    """
+
+    def __init__(self, path: str, poll_seconds: float = 1):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self._fd: Optional[int] = None
+
+    @property
+    def leading(self) -> bool:
+        return self._fd is not None
+
+    def _try_acquire(self) -> bool:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    async def acquire(self):
+        """
+        Wait until this worker holds the lock
+        """
+        while not self.leading and not self._try_acquire():
+            await asyncio.sleep(self.poll_seconds)
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
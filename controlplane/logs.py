@@ -0,0 +1,72 @@
+# Structured logging for the control plane: records are formatted as JSON lines and written by a background thread,
+# so that the request handlers never block on stderr.
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Optional
+
+# The attributes every LogRecord has, anything else was passed with extra= and is logged as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object, with the fields passed with extra= next to the message.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only the message is rendered by the handler, the fields and the traceback are kept apart for the formatter.
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure(level: str = "INFO") -> logging.handlers.QueueListener:
+    """
+    Route the records of every logger through a queue to a JSON handler on stderr, stopped at exit. Configuring
+    again, as every worker process does on startup, keeps the first listener.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(records)]
+    root.setLevel(level)
+    # The uvicorn loggers log through the root logger instead of their own handlers.
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+    listener.start()
+    atexit.register(listener.stop)
+    _listener = listener
+    return listener
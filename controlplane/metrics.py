@@ -0,0 +1,54 @@
+# Prometheus metrics of the control plane, served on /metrics. Several worker processes share them through the files
+# of PROMETHEUS_MULTIPROC_DIR, so that every scrape gets the metrics of all of them.
+import os
+import shutil
+
+import prometheus_client
+from prometheus_client import multiprocess
+
+ROLE_SECRET_LOOKUPS = prometheus_client.Counter(
+    "neon_control_plane_role_secret_lookups_total",
+    "Role secret lookups of the proxy: hit, miss, or coalesced with a read in flight.", ["result"])
+ROLE_SECRET_INVALIDATIONS = prometheus_client.Counter(
+    "neon_control_plane_role_secret_invalidations_total", "Cached role secrets dropped by a NeonTimeline change.")
+ROLE_SECRET_ENTRIES = prometheus_client.Gauge(
+    "neon_control_plane_role_secret_entries", "Role secrets currently cached.", multiprocess_mode="livesum")
+WAKE_SECONDS = prometheus_client.Histogram(
+    "neon_control_plane_wake_seconds",
+    "Compute wake ups of the proxy: already bound, warm from the pool, cold waiting for a compute, or timed out.",
+    ["result"], buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+# Only set by the worker running the warm pool.
+IDLE_COMPUTES = prometheus_client.Gauge(
+    "neon_control_plane_idle_computes", "Ready compute nodes in the warm pool, bound to no timeline.",
+    multiprocess_mode="livemax")
+COMPUTE_SUSPENDS = prometheus_client.Counter(
+    "neon_control_plane_compute_suspends_total", "Computes suspended after the suspend timeout of their timeline.")
+
+
+def share(path: str):
+    """
+    Make the worker processes started next write their metrics to the files of a directory, emptied of those of the
+    previous run. Called before the workers import prometheus_client
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+
+
+def asgi_app():
+    """
+    The /metrics endpoint, serving the metrics of every worker process when they are shared
+    """
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return prometheus_client.make_asgi_app()
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.make_asgi_app(registry)
+
+
+def exited():
+    """
+    Drop the live gauges of this worker process once it exits
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
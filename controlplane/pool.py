@@ -0,0 +1,408 @@
+# The warm pool of compute nodes: compute_ctl pods already running and polling an empty spec, bound to a timeline
+# when the proxy wakes it up, the pool being refilled in the background.
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import kubernetes_asyncio
+from kubernetes_asyncio.client import ApiException
+
+from controlplane import metrics
+from controlplane.computes import ComputeSpecs
+from controlplane.watch import GROUP, VERSION
+
+# Set on a compute pod claimed for a timeline, before the timeline records the binding.
+CLAIM_ANNOTATION = "neon.tech/timeline"
+STATEFULSET = "compute-node"
+POSTGRES_PORT = 5432
+
+
+@dataclass(frozen=True)
+class ComputePod:
+    """
+    A pod of the compute node StatefulSet.
+
+    Attributes:
+        name (str): The name of the pod.
+        compute_id (str): The index of the pod, the compute id compute_ctl polls its spec with.
+        ip (Optional[str]): The pod ip, None until it is scheduled.
+        ready (bool): Whether compute_ctl is up.
+        claimed_by (Optional[str]): The NeonTimeline the pod was claimed for.
+        resource_version (str): The resource version the claim is conditioned on.
+        terminating (bool): Whether the pod is being deleted, such as a suspended compute.
+    """
+    name: str
+    compute_id: str
+    ip: Optional[str]
+    ready: bool
+    claimed_by: Optional[str]
+    resource_version: str
+    terminating: bool = False
+
+    @property
+    def address(self) -> str:
+        return f"{self.ip}:{POSTGRES_PORT}"
+
+
+def compute_pod_of(body: dict) -> ComputePod:
+    metadata = body["metadata"]
+    status = body.get("status") or {}
+    compute_id = (metadata.get("labels") or {}).get("apps.kubernetes.io/pod-index") \
+        or metadata["name"].rsplit("-", 1)[-1]
+    ready = any(condition.get("type") == "Ready" and condition.get("status") == "True"
+                for condition in status.get("conditions") or [])
+    return ComputePod(name=metadata["name"], compute_id=compute_id, ip=status.get("podIP"),
+                      ready=ready and metadata.get("deletionTimestamp") is None,
+                      claimed_by=(metadata.get("annotations") or {}).get(CLAIM_ANNOTATION),
+                      resource_version=metadata.get("resourceVersion"),
+                      terminating=metadata.get("deletionTimestamp") is not None)
+
+
+class ComputePods:
+    """
+    The compute node pods of a namespace by compute id, kept up to date by a watch.
+
+    Attributes:
+        ready (asyncio.Event): Set once the initial listing is loaded.
+    """
+
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self._pods: Dict[str, ComputePod] = {}
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._pods)
+
+    def get(self, compute_id: str) -> Optional[ComputePod]:
+        return self._pods.get(compute_id)
+
+    def all(self) -> List[ComputePod]:
+        return list(self._pods.values())
+
+    def upsert(self, body: dict):
+        pod = compute_pod_of(body)
+        self._pods[pod.compute_id] = pod
+        self._notify()
+
+    def remove(self, body: dict):
+        self._pods.pop(compute_pod_of(body).compute_id, None)
+        self._notify()
+
+    def replace(self, bodies: Iterable[dict]):
+        self._pods = {pod.compute_id: pod for pod in map(compute_pod_of, bodies)}
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def changed(self, timeout: float):
+        """
+        Wait for the next change of the pods, at most timeout seconds
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class ComputePool:
+    """
+    Binds compute nodes to timelines on wake up, taking an idle compute from the pool, and owns the replicas of the
+    compute node StatefulSet: the computes bound to a timeline, pinned or woken up, and size idle ones.
+
+    A compute is claimed with a write conditioned on the resource version of its pod, then bound with a write
+    conditioned on the resource version of the NeonTimeline, so that concurrent wake ups, from this worker or
+    another, never share a compute nor bind a timeline twice. A wake up finding no idle compute scales the
+    StatefulSet up itself, from whichever worker it runs in, while the resizing of the pool in the leading worker
+    only removes the computes which stayed free for scale_down_delay_seconds, the new ones being waited for.
+
+    Attributes:
+        namespace (str): The namespace of the computes.
+        size (int): The idle computes to keep, 0 starting computes on wake up only.
+        wake_timeout_seconds (float): How long a wake up waits for a compute when the pool is empty.
+        orphan_seconds (float): How long a claim without binding is kept before the compute is released.
+        scale_down_delay_seconds (float): How long a compute stays free before it is removed, the wake timeout by
+            default.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str, specs: ComputeSpecs,
+                 pods: ComputePods, size: int = 0, wake_timeout_seconds: float = 60, orphan_seconds: float = 60,
+                 scale_down_delay_seconds: Optional[float] = None):
+        self.kube_client = kube_client
+        self.namespace = namespace
+        self.specs = specs
+        self.pods = pods
+        self.size = size
+        self.wake_timeout_seconds = wake_timeout_seconds
+        self.orphan_seconds = orphan_seconds
+        self.scale_down_delay_seconds = wake_timeout_seconds if scale_down_delay_seconds is None \
+            else scale_down_delay_seconds
+        self._refill = asyncio.Event()
+        self._waking: Dict[str, asyncio.Future] = {}
+        # The wake ups of this worker waiting for a new compute.
+        self._cold: Set[str] = set()
+        self._orphans: Dict[str, float] = {}
+        # When each compute id below the replicas was first seen free, neither bound nor claimed.
+        self._free_since: Dict[int, float] = {}
+        # The suspended computes, free although still claimed until their pod is deleted.
+        self._released: Set[int] = set()
+        self._logger = logging.getLogger(__name__)
+
+    def idle(self) -> List[ComputePod]:
+        """
+        The ready computes neither bound to a timeline nor claimed, by compute id
+        """
+        bound = self.specs.bound()
+        return sorted((pod for pod in self.pods.all()
+                       if pod.ready and pod.claimed_by is None and pod.compute_id not in bound),
+                      key=lambda pod: int(pod.compute_id))
+
+    async def wake(self, name: str) -> Optional[ComputePod]:
+        """
+        The compute serving a NeonTimeline, binding an idle one if none does
+        :return: The compute, None if the NeonTimeline does not exist
+        :raises asyncio.TimeoutError: if no compute became available in time
+        """
+        waking = self._waking.get(name)
+        if waking is None:
+            waking = asyncio.ensure_future(self._wake(name))
+            self._waking[name] = waking
+            waking.add_done_callback(lambda _: self._waking.pop(name, None))
+        return await asyncio.shield(waking)
+
+    async def _wake(self, name: str) -> Optional[ComputePod]:
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.wake_timeout_seconds
+        result = None
+        try:
+            while True:
+                timeline = self.specs.named(name)
+                if timeline is None:
+                    result = "unknown"
+                    return None
+                if timeline.compute_id is not None:
+                    self._cold.discard(name)
+                    pod = self.pods.get(timeline.compute_id)
+                    if pod is not None and pod.ready:
+                        result = result or "bound"
+                        return pod
+                    # Bound to a compute which is not running, such as one scaled down.
+                    await self._scale_up()
+                else:
+                    pod = await self._claim(name)
+                    if pod is not None:
+                        result = result or "warm"
+                        self._refill.set()
+                        return pod
+                    # The pool is empty, the wake up waits for a new compute.
+                    result = "cold"
+                    self._cold.add(name)
+                    await self._scale_up()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    result = "timeout"
+                    raise asyncio.TimeoutError(f"No compute available for {name}")
+                await self.pods.changed(min(remaining, 1))
+        finally:
+            self._cold.discard(name)
+            metrics.WAKE_SECONDS.labels(result or "failure").observe(time.perf_counter() - started)
+
+    async def _claim(self, name: str) -> Optional[ComputePod]:
+        core_client = kubernetes_asyncio.client.CoreV1Api(self.kube_client)
+        for pod in self.idle():
+            try:
+                await core_client.patch_namespaced_pod(
+                    name=pod.name, namespace=self.namespace,
+                    body={"metadata": {"resourceVersion": pod.resource_version,
+                                       "annotations": {CLAIM_ANNOTATION: name}}},
+                    _content_type="application/merge-patch+json")
+            except ApiException as e:
+                if e.status in (404, 409):
+                    # Claimed by another worker, or gone.
+                    continue
+                raise
+            if await self._bind(name, pod):
+                return pod
+            await self._release(pod.name)
+            return None
+        return None
+
+    async def _bind(self, name: str, pod: ComputePod) -> bool:
+        """
+        Record the compute in the status of the NeonTimeline, unless it changed since it was last seen
+        """
+        return await self._record(name, pod.compute_id)
+
+    async def unbind(self, name: str, compute_id: str) -> bool:
+        """
+        Release the compute of a NeonTimeline, unless the NeonTimeline changed since it was last seen, the next wake
+        up binding it again
+        :return: Whether the compute was released
+        """
+        timeline = self.specs.named(name)
+        if timeline is None or timeline.pinned or timeline.compute_id != compute_id:
+            return False
+        return await self._record(name, None)
+
+    async def _record(self, name: str, compute_id: Optional[str]) -> bool:
+        custom_client = kubernetes_asyncio.client.CustomObjectsApi(self.kube_client)
+        try:
+            body = await custom_client.patch_namespaced_custom_object(
+                group=GROUP, version=VERSION, plural="neontimelines", namespace=self.namespace, name=name,
+                body={"metadata": {"resourceVersion": self.specs.resource_version(name)},
+                      "status": {"computeId": compute_id}},
+                _content_type="application/merge-patch+json")
+        except ApiException as e:
+            if e.status not in (404, 409):
+                raise
+            if e.status == 409:
+                # Changed meanwhile, possibly bound by another worker: read it again before the next try.
+                self.specs.upsert(await custom_client.get_namespaced_custom_object(
+                    group=GROUP, version=VERSION, plural="neontimelines", namespace=self.namespace, name=name))
+            return False
+        # Served right away, without waiting for the watch.
+        self.specs.upsert(body)
+        return True
+
+    async def _release(self, pod_name: str):
+        try:
+            await kubernetes_asyncio.client.CoreV1Api(self.kube_client).patch_namespaced_pod(
+                name=pod_name, namespace=self.namespace, body={"metadata": {"annotations": {CLAIM_ANNOTATION: None}}},
+                _content_type="application/merge-patch+json")
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+    def refill(self):
+        """
+        Resize the pool now rather than on the next periodic check
+        """
+        self._refill.set()
+
+    async def run(self):
+        """
+        Refill the pool whenever a compute is taken, and release the orphaned claims periodically. The computes
+        claimed by the wake ups of the other workers are seen as changes of the compute pods
+        """
+        while True:
+            waits = [asyncio.ensure_future(self._refill.wait()), asyncio.ensure_future(self.pods.changed(30))]
+            try:
+                await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for wait in waits:
+                    wait.cancel()
+            self._refill.clear()
+            try:
+                await self._release_orphans()
+                await self._resize()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.warning(f"Refilling the compute pool of {self.namespace} failed: {e}")
+                await asyncio.sleep(1)
+                self._refill.set()
+            metrics.IDLE_COMPUTES.set(len(self.idle()))
+
+    def _used(self) -> Set[int]:
+        """
+        The compute ids bound to a timeline or claimed for one, the suspended computes excepted
+        """
+        claimed = {int(pod.compute_id) for pod in self.pods.all()
+                   if pod.claimed_by is not None and not pod.terminating and pod.compute_id.isdigit()}
+        # Forgotten once the pod of the suspended compute is deleted, or restarted without a claim.
+        self._released &= claimed
+        bound = {int(compute_id) for compute_id in self.specs.bound() if compute_id.isdigit()}
+        return (bound | claimed) - self._released
+
+    async def _scale(self, desired: Callable[[int], int]) -> int:
+        """
+        Set the replicas of the compute node StatefulSet, with a write conditioned on the resource version of its
+        scale, so that a concurrent resize from another worker is read again first
+        :param desired: The replicas wanted from the current ones
+        :return: The replicas, those read when the write lost the race
+        """
+        apps_client = kubernetes_asyncio.client.AppsV1Api(self.kube_client)
+        scale = await apps_client.read_namespaced_stateful_set_scale(name=STATEFULSET, namespace=self.namespace)
+        replicas = scale.spec.replicas or 0
+        wanted = desired(replicas)
+        if wanted == replicas:
+            return replicas
+        self._logger.info(f"Scaling the compute nodes of {self.namespace} from {replicas} to {wanted}.")
+        try:
+            await apps_client.patch_namespaced_stateful_set_scale(
+                name=STATEFULSET, namespace=self.namespace,
+                body={"metadata": {"resourceVersion": scale.metadata.resource_version},
+                      "spec": {"replicas": wanted}},
+                _content_type="application/merge-patch+json")
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            return replicas
+        return wanted
+
+    async def _scale_up(self):
+        """
+        Add the computes the bound timelines and the cold wake ups of this worker are missing
+        """
+        def desired(replicas: int) -> int:
+            used = self._used()
+            free = len([index for index in range(replicas) if index not in used])
+            return max(replicas + max(len(self._cold) - free, 0), max(used, default=-1) + 1)
+
+        try:
+            await self._scale(desired)
+        except ApiException as e:
+            # Tried again at the next pass of the wake up.
+            self._logger.warning(f"Scaling up the compute nodes of {self.namespace} failed: {e}")
+
+    async def _resize(self) -> int:
+        return await self._scale(self.desired_replicas)
+
+    async def suspended(self, compute_id: str) -> bool:
+        """
+        Scale the compute node StatefulSet down after a compute was released from its timeline, which removes the
+        compute if it is the highest one in use
+        :return: Whether the compute was removed, otherwise it has to be restarted empty
+        """
+        self._released.add(int(compute_id))
+        return int(compute_id) >= await self._resize()
+
+    def desired_replicas(self, replicas: int) -> int:
+        """
+        The replicas keeping size free compute ids below them, free ids being neither bound nor claimed: the
+        StatefulSet only adds and removes the highest ones. A free compute id above them is kept until it was free for
+        scale_down_delay_seconds, a wake up may be waiting for it, unless it is a suspended compute
+        """
+        now = time.monotonic()
+        used = self._used()
+        self._free_since = {index: self._free_since.get(index, now) for index in range(replicas) if index not in used}
+        desired = max(used, default=-1) + 1
+        free = desired - len([index for index in used if index < desired])
+        desired += max(self.size - free, 0)
+        for index in range(desired, replicas):
+            if index not in self._released and now - self._free_since[index] < self.scale_down_delay_seconds:
+                desired = index + 1
+        return desired
+
+    async def _release_orphans(self):
+        """
+        Release the computes claimed for a timeline which never recorded them, after a crash between the two writes
+        """
+        now = time.monotonic()
+        orphans = {}
+        for pod in self.pods.all():
+            if pod.claimed_by is None:
+                continue
+            timeline = self.specs.named(pod.claimed_by)
+            if timeline is not None and timeline.compute_id == pod.compute_id:
+                continue
+            orphans[pod.name] = self._orphans.get(pod.name, now)
+            if now - orphans[pod.name] >= self.orphan_seconds:
+                self._logger.info(f"Releasing the compute {pod.name} claimed for {pod.claimed_by}.")
+                await self._release(pod.name)
+                del orphans[pod.name]
+        self._orphans = orphans
@@ -0,0 +1,103 @@
+# Postgres settings of the computes, derived from the cpu and memory of the compute pods and a workload profile:
+# oltp for many short transactions, analytics for few large queries, mixed in between.
+import math
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+# The settings, each with its vartype, a spec of compute_ctl gets.
+Settings = Dict[str, Tuple[str, str]]
+
+MIB = 2 ** 20
+GIB = 2 ** 30
+
+
+def megabytes(value: float) -> str:
+    return f"{max(int(value // MIB), 1)}MB"
+
+
+@dataclass(frozen=True)
+class Profile:
+    """
+    How a workload shares the memory and cpu of a compute.
+
+    Attributes:
+        shared_buffers (float): The share of the memory for shared_buffers.
+        file_cache (float): The share of the memory for the local file cache of neon, caching the pages read from
+            the pageserver beyond shared_buffers.
+        connections_per_gib (int): max_connections per GiB of memory, within min_connections and max_connections.
+        work_mem_divisor (int): work_mem is the memory left by shared_buffers over max_connections and this, the
+            sorts and hashes a query runs at once.
+        gather_per_cpu (float): max_parallel_workers_per_gather per cpu, within max_gather.
+        write_lag (float): max_replication_write_lag as a share of the memory, how far the pageserver may fall
+            behind before writes are throttled.
+        flush_lag (int): max_replication_flush_lag in bytes.
+    """
+    shared_buffers: float
+    file_cache: float
+    connections_per_gib: int
+    min_connections: int
+    max_connections: int
+    work_mem_divisor: int
+    gather_per_cpu: float
+    max_gather: int
+    write_lag: float
+    flush_lag: int
+
+
+PROFILES = {
+    "oltp": Profile(shared_buffers=0.25, file_cache=0.5, connections_per_gib=200, min_connections=100,
+                    max_connections=5000, work_mem_divisor=3, gather_per_cpu=0.25, max_gather=2,
+                    write_lag=0.125, flush_lag=10 * GIB),
+    "analytics": Profile(shared_buffers=0.15, file_cache=0.6, connections_per_gib=25, min_connections=20,
+                         max_connections=500, work_mem_divisor=1, gather_per_cpu=1, max_gather=8,
+                         write_lag=0.5, flush_lag=20 * GIB),
+    "mixed": Profile(shared_buffers=0.2, file_cache=0.55, connections_per_gib=100, min_connections=50,
+                     max_connections=2000, work_mem_divisor=2, gather_per_cpu=0.5, max_gather=4,
+                     write_lag=0.25, flush_lag=10 * GIB),
+}
+DEFAULT_PROFILE = "mixed"
+
+
+def profile_settings(cpu: float, memory: int, profile: str = DEFAULT_PROFILE) -> Settings:
+    """
+    The settings of a compute with cpu cores and memory bytes running a workload profile
+    :raises ValueError: if the profile is unknown
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown settings profile {profile}, expected one of {', '.join(PROFILES)}")
+    sizing = PROFILES[profile]
+    cpus = max(math.ceil(cpu), 1)
+    shared_buffers = memory * sizing.shared_buffers
+    file_cache = memory * sizing.file_cache
+    connections = min(max(int(memory / GIB * sizing.connections_per_gib), sizing.min_connections),
+                      sizing.max_connections)
+    work_mem = max((memory - shared_buffers) / (connections * sizing.work_mem_divisor), MIB)
+    write_lag = min(max(memory * sizing.write_lag, 15 * MIB), 4 * GIB)
+    return {
+        "shared_buffers": (megabytes(shared_buffers), "string"),
+        "effective_cache_size": (megabytes(shared_buffers + file_cache), "string"),
+        "work_mem": (f"{int(work_mem // 1024)}kB", "string"),
+        "maintenance_work_mem": (megabytes(min(memory / 16, 2 * GIB)), "string"),
+        "max_connections": (str(connections), "integer"),
+        "max_parallel_workers": (str(cpus), "integer"),
+        "max_parallel_workers_per_gather": (str(min(int(cpus * sizing.gather_per_cpu), sizing.max_gather)),
+                                            "integer"),
+        # The parallel workers, and the background workers of neon and the extensions.
+        "max_worker_processes": (str(cpus + 8), "integer"),
+        "neon.max_file_cache_size": (megabytes(file_cache), "string"),
+        "neon.file_cache_size_limit": (megabytes(file_cache), "string"),
+        "max_replication_write_lag": (megabytes(write_lag), "string"),
+        "max_replication_flush_lag": (megabytes(sizing.flush_lag), "string"),
+    }
+
+
+def compute_settings(base: Settings, cpu: float, memory: int, profile: Optional[str] = None,
+                     overrides: Optional[Dict[str, str]] = None) -> Settings:
+    """
+    The base settings, those of the profile, then the overrides, each replacing the previous ones by name
+    :param overrides: The values set explicitly, keeping the vartype of the setting they replace
+    """
+    settings = {**base, **profile_settings(cpu, memory, profile or DEFAULT_PROFILE)}
+    for name, value in (overrides or {}).items():
+        settings[name] = (str(value), settings.get(name, (None, "string"))[1])
+    return settings
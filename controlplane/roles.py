@@ -0,0 +1,199 @@
+# The roles of the NeonTimelines, and the bounded cache of role secrets the proxy asks for on every new client
+# connection. The cache is filled from the NeonTimeline on a miss and invalidated by the NeonTimeline watch.
+import asyncio
+import collections
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+import kubernetes_asyncio
+from kubernetes_asyncio.client import ApiException
+
+from controlplane import metrics
+from controlplane.watch import GROUP, VERSION
+
+
+@dataclass(frozen=True)
+class TimelineRole:
+    """
+    A postgres role of a NeonTimeline, from its spec.roles.
+
+    Attributes:
+        name (str): The name of the role.
+        encrypted_password (Optional[str]): The SCRAM-SHA-256 or md5 verifier of the password, never the password.
+        allowed_ips (Optional[Tuple[str, ...]]): The addresses the proxy lets the role connect from, None for any.
+        renamed_from (Optional[str]): The previous name of the role, when it is renamed.
+    """
+    name: str
+    encrypted_password: Optional[str] = None
+    allowed_ips: Optional[Tuple[str, ...]] = None
+    renamed_from: Optional[str] = None
+
+
+def roles_of(body: dict) -> Tuple[TimelineRole, ...]:
+    """
+    The roles of a NeonTimeline, in the order of its spec
+    """
+    roles = []
+    for role in (body.get("spec") or {}).get("roles") or []:
+        allowed_ips = role.get("allowedIps")
+        roles.append(TimelineRole(name=role["name"], encrypted_password=role.get("encryptedPassword"),
+                                  allowed_ips=tuple(allowed_ips) if allowed_ips is not None else None,
+                                  renamed_from=role.get("renamedFrom")))
+    return tuple(roles)
+
+
+def role_of(body: Optional[dict], role: str) -> Optional[TimelineRole]:
+    if body is None:
+        return None
+    return next((timeline_role for timeline_role in roles_of(body) if timeline_role.name == role), None)
+
+
+def timeline_reader(kube_client: kubernetes_asyncio.client.ApiClient,
+                    namespace: str) -> Callable[[str], Awaitable[Optional[dict]]]:
+    """
+    Reads the NeonTimelines of a namespace by name, for the role secrets cache
+    """
+    custom_client = kubernetes_asyncio.client.CustomObjectsApi(kube_client)
+
+    async def read(name: str) -> Optional[dict]:
+        try:
+            return await custom_client.get_namespaced_custom_object(group=GROUP, version=VERSION,
+                                                                    namespace=namespace, plural="neontimelines",
+                                                                    name=name)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+    return read
+
+
+class RoleSecrets:
+    """
+    Role secrets keyed by (project, role), the project being the name of the NeonTimeline owning the role.
+
+    A bounded LRU whose entries expire after a TTL, unknown roles being cached too so that a storm of failing
+    connections does not turn into a storm of reads. Concurrent misses of the same key share a single read, and
+    a change of the NeonTimeline drops its changed entries right away.
+
+    Attributes:
+        fetch (Callable): Reads a NeonTimeline by name, None if it does not exist.
+        max_size (int): The maximum number of cached entries.
+        ttl_seconds (float): How long an entry is served without being read again.
+    """
+
+    def __init__(self, fetch: Callable[[str], Awaitable[Optional[dict]]], max_size: int = 10000,
+                 ttl_seconds: float = 60):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.ready = asyncio.Event()
+        self._entries: collections.OrderedDict[Tuple[str, str], Tuple[float, Optional[TimelineRole]]] = \
+            collections.OrderedDict()
+        self._by_project: Dict[str, Set[str]] = {}
+        # Bumped by every invalidation and recorded for the invalidated project while reads of it are in flight, or
+        # for the whole cache when it is cleared: a read started before the invalidation of its project is returned
+        # but not cached.
+        self._epoch = 0
+        self._cleared = 0
+        self._invalidated: Dict[str, int] = {}
+        self._reading: Dict[str, int] = {}
+        # The roles of each NeonTimeline as last seen by the watch, the events not changing them keep the cache.
+        self._roles: Dict[str, Tuple[TimelineRole, ...]] = {}
+        self._loading: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, project: str, role: str) -> Optional[TimelineRole]:
+        """
+        The role of a project, None if the project or the role does not exist
+        """
+        key = (project, role)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            metrics.ROLE_SECRET_LOOKUPS.labels("hit").inc()
+            return entry[1]
+        loading = self._loading.get(key)
+        if loading is None:
+            metrics.ROLE_SECRET_LOOKUPS.labels("miss").inc()
+            loading = asyncio.ensure_future(self._load(project, role))
+            self._loading[key] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+        else:
+            metrics.ROLE_SECRET_LOOKUPS.labels("coalesced").inc()
+        # Shielded: a caller giving up does not cancel the read the others wait for.
+        return await asyncio.shield(loading)
+
+    def _version(self, project: str) -> Tuple[int, int]:
+        return self._cleared, self._invalidated.get(project, 0)
+
+    async def _load(self, project: str, role: str) -> Optional[TimelineRole]:
+        version = self._version(project)
+        self._reading[project] = self._reading.get(project, 0) + 1
+        try:
+            timeline_role = role_of(await self.fetch(project), role)
+            if self._version(project) == version:
+                self._put((project, role), timeline_role)
+            return timeline_role
+        finally:
+            self._reading[project] -= 1
+            if not self._reading[project]:
+                # Only the reads in flight compare the epoch of their project, it is forgotten with the last one.
+                del self._reading[project]
+                self._invalidated.pop(project, None)
+
+    def _put(self, key: Tuple[str, str], timeline_role: Optional[TimelineRole]):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, timeline_role)
+        self._entries.move_to_end(key)
+        self._by_project.setdefault(key[0], set()).add(key[1])
+        while len(self._entries) > self.max_size:
+            (project, role), _ = self._entries.popitem(last=False)
+            self._forget(project, role)
+        metrics.ROLE_SECRET_ENTRIES.set(len(self._entries))
+
+    def _forget(self, project: str, role: str):
+        roles = self._by_project.get(project)
+        if roles is not None:
+            roles.discard(role)
+            if not roles:
+                del self._by_project[project]
+
+    def invalidate(self, project: str, body: Optional[dict] = None):
+        """
+        Drop the entries of a project which differ from its NeonTimeline, all of them without one. Nothing is
+        dropped while the roles of the NeonTimeline are unchanged, such as on the updates of its status
+        """
+        roles = roles_of(body) if body is not None else None
+        if roles is not None and self._roles.get(project) == roles:
+            return
+        if roles is None:
+            self._roles.pop(project, None)
+        else:
+            self._roles[project] = roles
+        self._epoch += 1
+        if project in self._reading:
+            self._invalidated[project] = self._epoch
+        for role in list(self._by_project.get(project, ())):
+            if body is not None and self._entries[(project, role)][1] == role_of(body, role):
+                continue
+            del self._entries[(project, role)]
+            self._forget(project, role)
+            metrics.ROLE_SECRET_INVALIDATIONS.inc()
+        metrics.ROLE_SECRET_ENTRIES.set(len(self._entries))
+
+    def upsert(self, body: dict):
+        self.invalidate(body["metadata"]["name"], body)
+
+    def remove(self, body: dict):
+        self.invalidate(body["metadata"]["name"])
+
+    def replace(self, bodies: Iterable[dict]):
+        # Relisted after missing events, any entry may be stale.
+        self._epoch += 1
+        self._cleared = self._epoch
+        self._roles = {body["metadata"]["name"]: roles_of(body) for body in bodies}
+        self._entries.clear()
+        self._by_project.clear()
+        metrics.ROLE_SECRET_ENTRIES.set(0)
@@ -0,0 +1,128 @@
+# The safekeepers the computes stream their WAL to, from the EndpointSlices of the safekeeper service: a quorum of 3,
+# or of 5 when there are enough safekeepers, picked among the ready ones in the zone of the compute first.
+import asyncio
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+SAFEKEEPER_SERVICE = "safekeeper"
+COMPUTE_SERVICE = "compute-node"
+SAFEKEEPER_PORT = 5454
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    """
+    A pod of a service, from its EndpointSlices.
+
+    Attributes:
+        name (str): The name of the pod, or its hostname.
+        index (int): The index of the pod in its StatefulSet.
+        zone (Optional[str]): The zone of the node of the pod.
+        ready (bool): Whether the pod is ready and not terminating.
+    """
+    name: str
+    index: int
+    zone: Optional[str]
+    ready: bool
+
+
+def endpoints_of(body: dict) -> Tuple[Optional[str], List[Endpoint]]:
+    """
+    The service of an EndpointSlice and its pods
+    """
+    service = (body["metadata"].get("labels") or {}).get("kubernetes.io/service-name")
+    endpoints = []
+    for endpoint in body.get("endpoints") or []:
+        name = endpoint.get("hostname") or (endpoint.get("targetRef") or {}).get("name")
+        if not name or not name.rsplit("-", 1)[-1].isdigit():
+            continue
+        conditions = endpoint.get("conditions") or {}
+        ready = conditions.get("ready") is not False and not conditions.get("terminating")
+        endpoints.append(Endpoint(name=name, index=int(name.rsplit("-", 1)[-1]), zone=endpoint.get("zone"),
+                                  ready=ready))
+    return service, endpoints
+
+
+def quorum_size(safekeepers: int) -> int:
+    """
+    The safekeepers a timeline is replicated to, 5 tolerating two failures once there are enough of them
+    """
+    return 5 if safekeepers >= 5 else 3
+
+
+class Safekeepers:
+    """
+    The safekeepers of a namespace and the zones of its computes, kept up to date by an EndpointSlice watch.
+
+    The safekeepers of a compute are the quorum of ready safekeepers closest to it, those in its zone first, then
+    by index. Safekeepers which are not ready only complete a quorum missing ready ones, and the fixed
+    safekeeper-0 to safekeeper-2 are used until the safekeepers are known.
+
+    Attributes:
+        namespace (str): The namespace of the safekeepers.
+        changed (Callable): Called with a compute id when the safekeepers of that compute may change, with None
+            when those of every compute may.
+        ready (asyncio.Event): Set once the initial listing is loaded.
+    """
+
+    def __init__(self, namespace: str, changed: Optional[Callable[[Optional[str]], None]] = None):
+        self.namespace = namespace
+        self.changed = changed or (lambda compute_id: None)
+        self.ready = asyncio.Event()
+        self._slices: Dict[str, Tuple[Optional[str], List[Endpoint]]] = {}
+        self._safekeepers: Tuple[Endpoint, ...] = ()
+        self._compute_zones: Dict[str, Optional[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._safekeepers)
+
+    def connstring(self, name: str) -> str:
+        return f"{name}.{SAFEKEEPER_SERVICE}.{self.namespace}.svc.cluster.local:{SAFEKEEPER_PORT}"
+
+    def connstrings(self, compute_id: Optional[str] = None) -> List[str]:
+        """
+        The safekeepers a compute streams its WAL to, closest first
+        """
+        if not self._safekeepers:
+            return [self.connstring(f"{SAFEKEEPER_SERVICE}-{index}") for index in range(3)]
+        zone = self._compute_zones.get(compute_id)
+        closest = sorted(self._safekeepers, key=lambda safekeeper: (not safekeeper.ready,
+                                                                    zone is None or safekeeper.zone != zone,
+                                                                    safekeeper.index))
+        return [self.connstring(safekeeper.name) for safekeeper in closest[:quorum_size(len(self._safekeepers))]]
+
+    def upsert(self, body: dict):
+        self._slices[body["metadata"]["name"]] = endpoints_of(body)
+        self._refresh()
+
+    def remove(self, body: dict):
+        self._slices.pop(body["metadata"]["name"], None)
+        self._refresh()
+
+    def replace(self, bodies: Iterable[dict]):
+        self._slices = {body["metadata"]["name"]: endpoints_of(body) for body in bodies}
+        self._refresh()
+
+    def _refresh(self):
+        safekeepers: Dict[str, Endpoint] = {}
+        compute_zones: Dict[str, Optional[str]] = {}
+        for service, endpoints in self._slices.values():
+            for endpoint in endpoints:
+                if service == SAFEKEEPER_SERVICE:
+                    # A pod moving between slices is listed twice for a moment, ready in either is ready.
+                    current = safekeepers.get(endpoint.name)
+                    if current is None or endpoint.ready and not current.ready:
+                        safekeepers[endpoint.name] = endpoint
+                elif service == COMPUTE_SERVICE and endpoint.zone is not None:
+                    compute_zones[str(endpoint.index)] = endpoint.zone
+        safekeepers = tuple(sorted(safekeepers.values(), key=lambda safekeeper: safekeeper.index))
+        if safekeepers != self._safekeepers:
+            self._safekeepers = safekeepers
+            self._compute_zones = compute_zones
+            self.changed(None)
+            return
+        moved = {compute_id for compute_id in compute_zones.keys() | self._compute_zones.keys()
+                 if compute_zones.get(compute_id) != self._compute_zones.get(compute_id)}
+        self._compute_zones = compute_zones
+        for compute_id in moved:
+            self.changed(compute_id)
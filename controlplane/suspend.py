@@ -0,0 +1,134 @@
+# Scale to zero of the idle computes: the activity compute_ctl reports on its http port is polled, and a compute idle
+# for longer than the suspend timeout of its NeonTimeline is released and removed from the compute node StatefulSet,
+# the next connection of the proxy waking the timeline up on another compute.
+import asyncio
+import datetime
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+import kubernetes_asyncio
+from kubernetes_asyncio.client import ApiException
+
+from controlplane import metrics
+from controlplane.computes import ComputeTimeline
+from controlplane.pool import ComputePod, ComputePool
+
+COMPUTE_CTL_PORT = 3080
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """
+    The unix time of an RFC 3339 timestamp of compute_ctl, which has nanoseconds
+    """
+    if not value:
+        return None
+    value = value.replace("Z", "+00:00")
+    if "." in value:
+        # Only microseconds are parsed.
+        seconds, fraction = value.split(".", 1)
+        digits = len(fraction) - len(fraction.lstrip("0123456789"))
+        value = f"{seconds}.{fraction[:min(digits, 6)]}{fraction[digits:]}"
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class Suspender:
+    """
+    Suspends the computes bound to a NeonTimeline once they are idle: no connection nor query since the suspend
+    timeout of the NeonTimeline, as reported by the last_active of compute_ctl.
+
+    A compute is suspended by releasing it from its NeonTimeline with a write conditioned on the resource version of
+    the NeonTimeline, a concurrent wake up or another worker winning, then by scaling the compute node StatefulSet
+    down through its scale subresource, with or without a warm pool. The StatefulSet only removes its highest
+    computes: a lower one is deleted instead and restarts empty, as compute_ctl waiting for a spec without postgres,
+    and takes the next wake up, the lowest idle compute being taken first.
+
+    The computes pinned by the spec.computeId of their NeonTimeline are excluded: the binding is set by the user, and
+    the compute id stays in use and running until it is removed from the spec.
+
+    Attributes:
+        pool (ComputePool): The warm pool the computes are bound by.
+        default_timeout_seconds (int): The suspend timeout of the NeonTimelines without one, 0 for never.
+        interval_seconds (float): How often the activity of the computes is polled.
+    """
+
+    def __init__(self, pool: ComputePool, default_timeout_seconds: int = 300, interval_seconds: float = 15,
+                 timeout_seconds: float = 5):
+        self.pool = pool
+        self.default_timeout_seconds = default_timeout_seconds
+        self.interval_seconds = interval_seconds
+        self.timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        # When each binding was first seen: a compute taken from the pool reports the activity it had before.
+        self._bound_since: Dict[Tuple[str, str], float] = {}
+        self._logger = logging.getLogger(__name__)
+
+    def timeout_of(self, timeline: ComputeTimeline) -> int:
+        if timeline.suspend_timeout_seconds is None:
+            return self.default_timeout_seconds
+        return timeline.suspend_timeout_seconds
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=32)
+        async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+            while True:
+                try:
+                    await self.check(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._logger.warning(f"Checking the idle computes of {self.pool.namespace} failed: {e}")
+                await asyncio.sleep(self.interval_seconds)
+
+    async def check(self, session: aiohttp.ClientSession):
+        """
+        Suspend the computes idle for longer than the suspend timeout of their NeonTimeline
+        """
+        now = time.time()
+        candidates = []
+        bound_since = {}
+        for name, timeline in self.pool.specs.served().items():
+            key = (name, timeline.compute_id)
+            bound_since[key] = self._bound_since.get(key, now)
+            timeout = self.timeout_of(timeline)
+            pod = self.pool.pods.get(timeline.compute_id)
+            if timeline.pinned or timeout <= 0 or pod is None or not pod.ready or pod.claimed_by != name:
+                continue
+            if now - bound_since[key] >= timeout:
+                candidates.append((name, timeline, pod, timeout))
+        self._bound_since = bound_since
+        last_active = await asyncio.gather(*(self.last_active(session, pod) for _, _, pod, _ in candidates))
+        for (name, timeline, pod, timeout), active in zip(candidates, last_active):
+            if active is None or now - max(active, bound_since[(name, timeline.compute_id)]) < timeout:
+                continue
+            await self.suspend(name, timeline, pod)
+
+    async def last_active(self, session: aiohttp.ClientSession, pod: ComputePod) -> Optional[float]:
+        """
+        The unix time of the last activity of a running compute, None if it is not running or did not answer
+        """
+        try:
+            async with session.get(f"http://{pod.ip}:{COMPUTE_CTL_PORT}/status") as response:
+                response.raise_for_status()
+                status = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self._logger.debug(f"Reading the status of the compute {pod.name} failed: {e}")
+            return None
+        if status.get("status") != "running":
+            # Still starting, or applying a spec: not idle.
+            return None
+        return parse_time(status.get("last_active")) or parse_time(status.get("start_time"))
+
+    async def suspend(self, name: str, timeline: ComputeTimeline, pod: ComputePod):
+        if not await self.pool.unbind(name, timeline.compute_id):
+            return
+        self._logger.info(f"Suspending the compute {pod.name} of {name}, idle for {self.timeout_of(timeline)}s.")
+        metrics.COMPUTE_SUSPENDS.inc()
+        if await self.pool.suspended(timeline.compute_id):
+            return
+        try:
+            await kubernetes_asyncio.client.CoreV1Api(self.pool.kube_client).delete_namespaced_pod(
+                name=pod.name, namespace=self.pool.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
@@ -0,0 +1,255 @@
+# Watch-fed table of the NeonTenants of the namespace: which pageserver each tenant, or each shard of a sharded
+# tenant, is attached to, and with which generation. /validate and /re-attach are answered from it without calling
+# the kubernetes api.
+import asyncio
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import kubernetes_asyncio
+
+from controlplane.watch import CustomObjectWatch
+from resources.pageserver_api import DEFAULT_STRIPE_SIZE, tenant_of, tenant_shard_ids
+
+PLURAL = "neontenants"
+
+
+@dataclass
+class TenantLocation:
+    """
+    Where a tenant or a shard is attached, as recorded in the status.attachment of its NeonTenant, or in
+    status.attachments by shard id for a sharded tenant.
+
+    Attributes:
+        tenant_id (str): The pageserver tenant id, the shard id for a shard.
+        name (str): The name of the NeonTenant object.
+        node_id (Optional[int]): The pageserver the tenant is attached to, None if not attached yet.
+        generation (int): The last generation issued for the tenant, 0 if none was issued yet.
+    """
+    tenant_id: str
+    name: str
+    node_id: Optional[int] = None
+    generation: int = 0
+
+
+def tenant_id_of(body: dict) -> str:
+    """
+    The pageserver tenant id of a NeonTenant, the same one the operator creates the tenant with
+    """
+    return (body.get("status") or {}).get("tenantId") or (body.get("spec") or {}).get("id") \
+        or uuid.UUID(body["metadata"]["uid"]).hex
+
+
+def attachment_status(location: TenantLocation) -> dict:
+    """
+    The status of a NeonTenant recording an attachment
+    """
+    attachment = {"nodeId": location.node_id, "generation": location.generation}
+    if tenant_of(location.tenant_id) != location.tenant_id:
+        return {"attachments": {location.tenant_id: attachment}}
+    return {"attachment": attachment}
+
+
+def node_id_of(node_id) -> Optional[int]:
+    """
+    Normalize the node id sent by a pageserver, which is the index of its pod
+    """
+    if node_id is None or node_id == "":
+        return None
+    return int(node_id)
+
+
+class TenantTable:
+    """
+    The tenants of a namespace indexed by tenant id and by pageserver, kept up to date by a watch. Each shard of a
+    sharded tenant (spec.shardCount) is an entry of its own, by shard id, with its own pageserver and generation.
+
+    Generations only ever grow: events carrying an older generation than the one in memory, such as the
+    echo of a write still in flight, never lower it.
+
+    Attributes:
+        default_node_id (int): The pageserver owning the tenants which were never attached, those the operator
+            created before it placed the tenants.
+        changed (Callable): Called with a tenant id when the pageserver of that tenant, or of one of its shards,
+            changes.
+        ready (asyncio.Event): Set once the initial listing is loaded.
+    """
+
+    def __init__(self, default_node_id: int = 0, changed: Optional[Callable[[str], None]] = None):
+        self.default_node_id = default_node_id
+        self.changed = changed or (lambda tenant_id: None)
+        self.ready = asyncio.Event()
+        self._tenants: Dict[str, TenantLocation] = {}
+        self._by_name: Dict[str, Set[str]] = {}
+        self._by_node: Dict[Optional[int], Set[str]] = {}
+        # The pageserver the operator points the computes of each tenant at, status.pageserver, which stays the
+        # source of a migration until the target caught up, or status.pageservers by shard number.
+        self._serving: Dict[str, int] = {}
+        # The shard ids of each tenant by shard number, and the stripe size of the sharded ones.
+        self._shards: Dict[str, Tuple[str, ...]] = {}
+        self._stripe_sizes: Dict[str, int] = {}
+        # The attachment of each tenant as last seen in its status, which the issued generations may be ahead of.
+        self._observed: Dict[str, Tuple[Optional[int], int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    def get(self, tenant_id: str) -> Optional[TenantLocation]:
+        return self._tenants.get(tenant_id)
+
+    def node_of(self, tenant_id: str) -> Optional[int]:
+        """
+        The pageserver serving a tenant: the one the operator recorded, else the one it is attached to, the default
+        one for the never attached tenants, None if it is detached or unknown
+        """
+        location = self._tenants.get(tenant_id)
+        if location is None:
+            return None
+        if tenant_id in self._serving:
+            return self._serving[tenant_id]
+        if location.node_id is None and location.generation == 0:
+            return self.default_node_id
+        return location.node_id
+
+    def observed(self, tenant_id: str) -> Optional[Tuple[Optional[int], int]]:
+        """
+        The pageserver and generation recorded in the status of a tenant, None if it is unknown
+        """
+        return self._observed.get(tenant_id)
+
+    def pageservers(self, tenant_id: str) -> List[Optional[int]]:
+        """
+        The pageservers serving the shards of a tenant by shard number, a single one for an unsharded tenant
+        """
+        return [self.node_of(shard_id) for shard_id in self._shards.get(tenant_id, (tenant_id,))]
+
+    def stripe_size(self, tenant_id: str) -> Optional[int]:
+        """
+        The stripe size of a sharded tenant, None for an unsharded one
+        """
+        return self._stripe_sizes.get(tenant_id)
+
+    def on_node(self, node_id: int) -> List[TenantLocation]:
+        """
+        The tenants attached to a pageserver, including the never attached ones for the default pageserver
+        """
+        tenant_ids = set(self._by_node.get(node_id, ()))
+        if node_id == self.default_node_id:
+            # The detached tenants keep their generation and stay detached.
+            tenant_ids |= {tenant_id for tenant_id in self._by_node.get(None, ())
+                           if self._tenants[tenant_id].generation == 0}
+        return [self._tenants[tenant_id] for tenant_id in tenant_ids]
+
+    def upsert(self, body: dict):
+        """
+        Add or update a tenant, or the shards of a sharded tenant, from its NeonTenant
+        """
+        name = body["metadata"]["name"]
+        tenant_id = tenant_id_of(body)
+        spec, status = body.get("spec") or {}, body.get("status") or {}
+        shard_count = int(spec.get("shardCount") or 0)
+        shard_ids = tenant_shard_ids(tenant_id, shard_count)
+        for previous_id in self._by_name.get(name, set()) - set(shard_ids):
+            self._discard(previous_id)
+        self._shards[tenant_id] = tuple(shard_ids)
+        if len(shard_ids) > 1:
+            self._stripe_sizes[tenant_id] = int(spec.get("stripeSize") or DEFAULT_STRIPE_SIZE)
+            serving = status.get("pageservers") or []
+            attachments = status.get("attachments") or {}
+            for number, shard_id in enumerate(shard_ids):
+                self._upsert(name, shard_id, attachments.get(shard_id) or {},
+                             serving[number] if number < len(serving) else None)
+        else:
+            self._stripe_sizes.pop(tenant_id, None)
+            self._upsert(name, tenant_id, status.get("attachment") or {}, status.get("pageserver"))
+
+    def _upsert(self, name: str, tenant_id: str, attachment: dict, serving):
+        previous_node_id = self.node_of(tenant_id)
+        serving = node_id_of(serving)
+        if serving is None:
+            self._serving.pop(tenant_id, None)
+        else:
+            self._serving[tenant_id] = serving
+        if tenant_id in self._tenants and self.node_of(tenant_id) != previous_node_id:
+            self.changed(tenant_of(tenant_id))
+        current = self._tenants.get(tenant_id)
+        generation = int(attachment.get("generation") or 0)
+        self._observed[tenant_id] = (node_id_of(attachment.get("nodeId")), generation)
+        if current is not None and current.generation > generation:
+            return
+        self.set(TenantLocation(tenant_id=tenant_id, name=name, node_id=node_id_of(attachment.get("nodeId")),
+                                generation=generation))
+
+    def remove(self, body: dict):
+        for tenant_id in list(self._by_name.get(body["metadata"]["name"], ())):
+            self._discard(tenant_id)
+
+    def set(self, location: TenantLocation):
+        current = self._tenants.get(location.tenant_id)
+        previous_node_id = self.node_of(location.tenant_id)
+        if current is not None:
+            self._by_node.get(current.node_id, set()).discard(location.tenant_id)
+        self._tenants[location.tenant_id] = location
+        self._by_name.setdefault(location.name, set()).add(location.tenant_id)
+        self._by_node.setdefault(location.node_id, set()).add(location.tenant_id)
+        if current is None or self.node_of(location.tenant_id) != previous_node_id:
+            self.changed(tenant_of(location.tenant_id))
+
+    def replace(self, bodies: Iterable[dict]):
+        """
+        Reload the table from a full listing, keeping the generations issued since the listing was taken
+        """
+        previous = self._tenants
+        previous_nodes = {tenant_id: self.node_of(tenant_id) for tenant_id in previous}
+        changed, self.changed = self.changed, lambda tenant_id: None
+        try:
+            self._tenants, self._by_name, self._by_node, self._serving = {}, {}, {}, {}
+            self._shards, self._stripe_sizes, self._observed = {}, {}, {}
+            for body in bodies:
+                self.upsert(body)
+            for tenant_id, location in self._tenants.items():
+                known = previous.get(tenant_id)
+                if known is not None and known.generation > location.generation:
+                    self.set(known)
+        finally:
+            self.changed = changed
+        for tenant_id in {tenant_of(shard_id) for shard_id in self._tenants.keys() | previous_nodes.keys()
+                          if self.node_of(shard_id) != previous_nodes.get(shard_id)}:
+            self.changed(tenant_id)
+
+    def _discard(self, tenant_id: str):
+        location = self._tenants.pop(tenant_id, None)
+        if location is None:
+            return
+        shards = self._by_name.get(location.name, set())
+        shards.discard(tenant_id)
+        if not shards:
+            self._by_name.pop(location.name, None)
+        self._by_node.get(location.node_id, set()).discard(tenant_id)
+        self._serving.pop(tenant_id, None)
+        self._observed.pop(tenant_id, None)
+        if not any(shard_id in self._tenants for shard_id in self._shards.get(tenant_of(tenant_id), ())):
+            self._shards.pop(tenant_of(tenant_id), None)
+            self._stripe_sizes.pop(tenant_of(tenant_id), None)
+
+    def validate(self, tenants: Iterable[Tuple[str, int]]) -> List[Tuple[str, bool]]:
+        """
+        Check the generations a pageserver holds, only the latest generation of a tenant is valid
+        :param tenants: The (tenant id, generation) pairs to check
+        :return: The (tenant id, valid) pairs in the same order
+        """
+        results = []
+        for tenant_id, generation in tenants:
+            location = self._tenants.get(tenant_id)
+            results.append((tenant_id, location is not None and location.generation == int(generation)))
+        return results
+
+
+class TenantWatch(CustomObjectWatch):
+    """
+    Lists the NeonTenants of a namespace into a table and keeps it up to date with a watch.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str, table: TenantTable,
+                 timeout_seconds: int = 300):
+        super().__init__(kube_client, namespace, PLURAL, table, timeout_seconds=timeout_seconds)
@@ -0,0 +1,162 @@
+# Keeps in-memory tables of the objects of a namespace up to date with a list and a watch.
+import asyncio
+import json
+import logging
+from typing import Callable, Iterable
+
+import kubernetes_asyncio
+from kubernetes_asyncio.client import ApiException
+
+GROUP = "neon.tech"
+VERSION = "v1alpha1"
+
+
+class ObjectWatch:
+    """
+    Lists objects of a namespace into tables and keeps them up to date with a watch, re-listing when the watch
+    falls too far behind.
+
+    A table is anything with replace(bodies), upsert(body), remove(body), a ready event set once the first
+    listing is loaded, and a length.
+
+    Attributes:
+        namespace (str): The namespace of the objects.
+        kind (str): What is watched, for the logs.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str, kind: str, *tables,
+                 timeout_seconds: int = 300):
+        self.kube_client = kube_client
+        self.namespace = namespace
+        self.kind = kind
+        self.tables = tables
+        self.timeout_seconds = timeout_seconds
+        self._logger = logging.getLogger(__name__)
+
+    def _list_function(self) -> Callable:
+        """
+        The api method listing the objects, also used by the watch
+        """
+        raise NotImplementedError
+
+    def _list_kwargs(self) -> dict:
+        return {}
+
+    async def _list(self) -> dict:
+        """
+        The listing of the objects as a plain dict, as the watch events are
+        """
+        return await self._list_function()(**self._list_kwargs())
+
+    async def run(self):
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    listing = await self._list()
+                    items = listing.get("items") or []
+                    for table in self.tables:
+                        table.replace(items)
+                        table.ready.set()
+                    resource_version = listing["metadata"]["resourceVersion"]
+                    self._logger.info(f"Loaded {len(items)} {self.kind} of {self.namespace}.")
+                resource_version = await self._watch(resource_version)
+            except ApiException as e:
+                if e.status == 410:
+                    # The resource version is too old to resume from.
+                    resource_version = None
+                    continue
+                self._logger.warning(f"Watching the {self.kind} of {self.namespace} failed: {e.status} {e.reason}")
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.warning(f"Watching the {self.kind} of {self.namespace} failed: {e}")
+                await asyncio.sleep(1)
+
+    async def _watch(self, resource_version: str) -> str:
+        async with kubernetes_asyncio.watch.Watch() as watch:
+            async for event in watch.stream(self._list_function(), **self._list_kwargs(),
+                                            resource_version=resource_version, allow_watch_bookmarks=True,
+                                            timeout_seconds=self.timeout_seconds):
+                # Error events, like an expired resource version, are raised by the watch as ApiException.
+                body = event["raw_object"]
+                resource_version = body["metadata"].get("resourceVersion", resource_version)
+                for table in self.tables:
+                    if event["type"] in ("ADDED", "MODIFIED"):
+                        table.upsert(body)
+                    elif event["type"] == "DELETED":
+                        table.remove(body)
+        return resource_version
+
+
+class CustomObjectWatch(ObjectWatch):
+    """
+    Watches the neon.tech custom objects of a namespace.
+
+    Attributes:
+        plural (str): The plural name of the neon.tech custom resource.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str, plural: str, *tables,
+                 timeout_seconds: int = 300):
+        super().__init__(kube_client, namespace, plural, *tables, timeout_seconds=timeout_seconds)
+        self.plural = plural
+
+    def _list_function(self) -> Callable:
+        return kubernetes_asyncio.client.CustomObjectsApi(self.kube_client).list_namespaced_custom_object
+
+    def _list_kwargs(self) -> dict:
+        return {"group": GROUP, "version": VERSION, "namespace": self.namespace, "plural": self.plural}
+
+
+class PodWatch(ObjectWatch):
+    """
+    Watches the pods of a namespace matching a label selector.
+
+    Attributes:
+        label_selector (str): The selector of the pods, such as "app=compute-node".
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str, label_selector: str,
+                 *tables, timeout_seconds: int = 300):
+        super().__init__(kube_client, namespace, f"pods {label_selector}", *tables, timeout_seconds=timeout_seconds)
+        self.label_selector = label_selector
+
+    def _list_function(self) -> Callable:
+        return kubernetes_asyncio.client.CoreV1Api(self.kube_client).list_namespaced_pod
+
+    def _list_kwargs(self) -> dict:
+        return {"namespace": self.namespace, "label_selector": self.label_selector}
+
+    async def _list(self) -> dict:
+        # Read as plain json, the tables handle the raw objects the watch events carry.
+        response = await self._list_function()(**self._list_kwargs(), _preload_content=False)
+        return json.loads(await response.read())
+
+
+class EndpointSliceWatch(ObjectWatch):
+    """
+    Watches the EndpointSlices of services of a namespace, which tell the ready pods of each service and their
+    zones.
+
+    Attributes:
+        services (Tuple[str, ...]): The names of the services.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, namespace: str, services: Iterable[str],
+                 *tables, timeout_seconds: int = 300):
+        self.services = tuple(services)
+        super().__init__(kube_client, namespace, f"endpoints of {', '.join(self.services)}", *tables,
+                         timeout_seconds=timeout_seconds)
+
+    def _list_function(self) -> Callable:
+        return kubernetes_asyncio.client.DiscoveryV1Api(self.kube_client).list_namespaced_endpoint_slice
+
+    def _list_kwargs(self) -> dict:
+        return {"namespace": self.namespace,
+                "label_selector": f"kubernetes.io/service-name in ({','.join(self.services)})"}
+
+    async def _list(self) -> dict:
+        response = await self._list_function()(**self._list_kwargs(), _preload_content=False)
+        return json.loads(await response.read())
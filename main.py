@@ -1,15 +1,32 @@
+import asyncio
+import contextlib
+import functools
 import logging
+import os
+import socket
+import uuid
+from typing import List, Optional, Tuple
 
+import aiohttp
 import kopf
 import kubernetes
-import requests
+import kubernetes_asyncio
 
+import resources.apply
 import resources.autoscaler_agent
 import resources.common
 import resources.compute_node
 import resources.control_plane
+import resources.failover
+import resources.metrics
+import resources.migration
 import resources.pageserver
+import resources.pageserver_api
+import resources.placement
+import resources.retry
+import resources.rollout
 import resources.safekeeper
+import resources.sharding
 import resources.storage_broker
 
 
@@ -20,6 +37,11 @@ def configure(settings: kopf.OperatorSettings, **_):
     settings.networking.request_timeout = 60
     settings.watching.server_timeout = 10 * 60
     settings.persistence.finalizer = 'neon.tech/neon-finalizer'
+    if sharding_enabled():
+        # Every replica owns its finalizer, so that replicas never release objects reconciled by another one.
+        settings.persistence.finalizer = resources.sharding.finalizer(shard_member())
+        settings.persistence.diffbase_storage = kopf.AnnotationsDiffBaseStorage(
+            ignored_fields=[('metadata', 'annotations', resources.sharding.OWNER_ANNOTATION)])
     settings.persistence.progress_storage = kopf.MultiProgressStorage([
         kopf.AnnotationsProgressStorage(prefix='neon.tech'),
         kopf.StatusProgressStorage(field='status.neon-operator'),
@@ -27,10 +49,69 @@ def configure(settings: kopf.OperatorSettings, **_):
 
 
 @kopf.on.startup()
-async def startup(logger, **kwargs):
+async def startup(logger, memo: kopf.Memo, **kwargs):
+    # One pooled api client for the whole operator, instead of one per event.
+    memo.kube_client = resources.metrics.instrument(await resources.common.kube_api_client(
+        pool_maxsize=int(os.getenv("KUBE_CLIENT_POOL_SIZE", "32"))))
+    memo.retry_policy = resources.retry.RetryPolicy(max_delay=float(os.getenv("RETRY_MAX_DELAY_SECONDS", "60")))
+    memo.retry_limiter = resources.retry.NamespaceLimiter(int(os.getenv("RETRY_CONCURRENCY_PER_NAMESPACE", "4")))
+    memo.pre_requisite_wakeups = resources.retry.Wakeups()
+    memo.pageserver_api = resources.pageserver_api.PageserverClient(
+        pool_size=int(os.getenv("PAGESERVER_POOL_SIZE", "16")),
+        max_concurrency=int(os.getenv("PAGESERVER_MAX_CONCURRENCY", "64")),
+        total_timeout=float(os.getenv("PAGESERVER_TIMEOUT_SECONDS", "30")),
+        # The attached locations upload the heatmap their secondary locations download.
+        tenant_config={"heatmap_period": HEATMAP_PERIOD} if HEATMAP_PERIOD else None)
+    memo.placement = resources.placement.Placement(
+        memo.pageserver_api, PAGESERVER_NODE_URL,
+        hot_cpu=float(os.getenv("PAGESERVER_HOT_CPU", "0.8")),
+        max_tenants=int(os.getenv("PAGESERVER_MAX_TENANTS", "0")),
+        ttl_seconds=float(os.getenv("PAGESERVER_LOAD_TTL_SECONDS", "10")))
+    memo.migrations = resources.migration.Migrations(
+        memo.pageserver_api,
+        warmup_timeout_seconds=float(os.getenv("MIGRATION_WARMUP_TIMEOUT_SECONDS", "300")),
+        settle_seconds=float(os.getenv("MIGRATION_SETTLE_SECONDS", "30")))
+    memo.failover = resources.failover.Failover(
+        memo.pageserver_api, PAGESERVER_NODE_URL,
+        grace_seconds=float(os.getenv("FAILOVER_GRACE_SECONDS", "30")))
+    if sharding_enabled():
+        memo.shard = resources.sharding.Shard(memo.kube_client, shard_member(),
+                                              os.getenv("POD_NAMESPACE", "neon-operator"))
+        await memo.shard.join()
+        memo.shard_task = asyncio.create_task(memo.shard.run())
+        logger.info(f"Joined the operator shards as {memo.shard.member}, members: {memo.shard.ring.members}.")
+    resources.metrics.serve(int(os.getenv("METRICS_PORT", "9090")))
     logger.info("Startup completed.")
 
 
+def sharding_enabled() -> bool:
+    return os.getenv("OPERATOR_SHARDING", "false").lower() == "true"
+
+
+def shard_member() -> str:
+    return os.getenv("POD_NAME", socket.gethostname())
+
+
+# The pageserver http api of a namespace, overridable to point the handlers at a stand-in pageserver.
+PAGESERVER_URL = os.getenv("PAGESERVER_URL", "http://pageserver.{namespace}.svc.cluster.local:9898")
+# The http api of the pageserver of a node id, the index of its pod.
+PAGESERVER_NODE_URL = os.getenv("PAGESERVER_NODE_URL",
+                                "http://pageserver-{node_id}.pageserver.{namespace}.svc.cluster.local:9898")
+# The control plane api of a namespace, issuing the generations of the tenants.
+CONTROL_PLANE_URL = os.getenv("CONTROL_PLANE_URL", "http://control-plane.{namespace}.svc.cluster.local:1234")
+# The postgres major version of new timelines, matching the default compute node image.
+DEFAULT_PG_VERSION = 16
+# How often the load of the pageservers of a NeonDeployment is compared, and the difference of the scores of the most
+# and least loaded pageservers above which a tenant is moved, 0 disabling the rebalancing.
+REBALANCE_INTERVAL_SECONDS = float(os.getenv("REBALANCE_INTERVAL_SECONDS", "300"))
+REBALANCE_SKEW = float(os.getenv("REBALANCE_SKEW", "0.5"))
+# Whether every tenant shard gets a warm secondary location, promoted when its pageserver dies, how often the
+# pageservers of a NeonDeployment are checked, and how often the attached locations upload their heatmap.
+SECONDARY_LOCATIONS = os.getenv("SECONDARY_LOCATIONS", "true").lower() == "true"
+FAILOVER_INTERVAL_SECONDS = float(os.getenv("FAILOVER_INTERVAL_SECONDS", "10"))
+HEATMAP_PERIOD = os.getenv("HEATMAP_PERIOD", "60s")
+
+
 def default_resource_limits():
     return kubernetes.client.V1ResourceRequirements(
         requests={
@@ -44,199 +125,308 @@ def default_resource_limits():
     )
 
 
-@kopf.on.create("neontenants")
-def create_tenant(spec, name, namespace, **_):
+@kopf.on.create("neontenants", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def create_tenant(spec, status, name, namespace, uid, retry, memo: kopf.Memo, patch: kopf.Patch,
+                        ready_statefulsets: kopf.Index, ready_deployments: kopf.Index,
+                        pre_requisite_services: kopf.Index, pageserver_pods: kopf.Index, **_):
     kopf.info(spec, reason='CreatingTenant', message=f'Creating {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
-    check_for_pre_requisites(kube_client, namespace, name)
-    # TODO: Get the NeonDeployment object linked to this tenant
-    # Get the storage credentials from the NeonDeployment object
-    # Get the resource limits from the NeonDeployment object
-    # neon_deployment = (kubernetes.client
-    #                       .ApiextensionsV1Api(kube_client)
-    #                     (name="neon-deployment", namespace=namespace))
-    pageserver_resources = spec.get('pageServer').get('resources')
-    if pageserver_resources is None:
-        pageserver_resources = default_resource_limits()
-    remote_storage_bucket_endpoint = spec.get('storageConfig').get('endpoint')
-    remote_storage_bucket_name = spec.get('storageConfig').get('bucketName')
-    remote_storage_bucket_region = spec.get('storageConfig').get('bucketRegion')
-    remote_storage_prefix_in_bucket = spec.get('storageConfig').get('prefixInBucket')
-    compute_node_resources = spec.get('computeNode').get('resources')
-    if compute_node_resources is None:
-        compute_node_resources = default_resource_limits()
-    # TODO: Update the tenant crd with the tenant id
-    # Deploy the pageserver
-    resources.pageserver.deploy_pageserver(kube_client=kube_client,
-                                           namespace=namespace,
-                                           resources=pageserver_resources,
-                                           remote_storage_endpoint=remote_storage_bucket_endpoint,
-                                           remote_storage_bucket_name=remote_storage_bucket_name,
-                                           remote_storage_bucket_region=remote_storage_bucket_region,
-                                           remote_storage_prefix_in_bucket=remote_storage_prefix_in_bucket)
-    # Deploy the compute nodes
-    resources.compute_node.deploy_compute_node(kube_client=kube_client,
-                                               namespace=namespace,
-                                               resources=compute_node_resources)
-    pageserver_url = f"http://pageserver.{namespace}.svc.cluster.local:6400"
-    # Call the api to create the tenant using requests post method to pageserver_url/v1/tenant
-    # If the response is not 200, raise kopf.PermanentError(f"Failed to create tenant {namespace}/{name}")
-    # If the response is 200, kopf.adopt the tenant
-    request = {
-
-    }
-    response = requests.post(f"{pageserver_url}/v1/tenant", json=request)
-    if response.status_code != 200:
-        raise kopf.PermanentError(f"Failed to create tenant {namespace}/{name}")
-    else:
-        tenant_id = response.text
+    tenant_id = pageserver_tenant_id(spec, uid)
+    async with memo.retry_limiter.slot(namespace, retry):
+        await wait_for_pre_requisites(namespace, name, retry, memo, ready_statefulsets, ready_deployments,
+                                      pre_requisite_services)
+        shard_count = int(spec.get('shardCount') or 0)
+        shard_ids = resources.pageserver_api.tenant_shard_ids(tenant_id, shard_count)
+        # The pageserver and compute nodes are rolled out by the NeonDeployment of this namespace. A retry keeps
+        # the pageservers the first attempt picked, spec.pageserver asks for one for an unsharded tenant.
+        if len(shard_ids) > 1:
+            node_ids = status.get('pageservers')
+        else:
+            node_id = status.get('pageserver', spec.get('pageserver'))
+            node_ids = [node_id] if node_id is not None else None
+        with pageserver_errors(f"place tenant {namespace}/{name}", retry, memo):
+            if node_ids is None:
+                node_ids = await memo.placement.place_shards(namespace, list(pageserver_pods.get(namespace, [])),
+                                                             len(shard_ids))
+            if len(shard_ids) > 1:
+                patch.status['pageservers'] = node_ids
+            else:
+                patch.status['pageserver'] = node_ids[0]
+        for shard_id, node_id in zip(shard_ids, node_ids):
+            with pageserver_errors(f"attach tenant {namespace}/{name} to pageserver {node_id}", retry, memo):
+                generation = await memo.pageserver_api.attach_hook(CONTROL_PLANE_URL.format(namespace=namespace),
+                                                                   shard_id, node_id)
+            if generation is None:
+                # The watch of the control plane has not seen the NeonTenant yet.
+                raise memo.retry_policy.transient(f"Tenant {namespace}/{name} is not known to the control plane "
+                                                  f"yet", retry)
+            with pageserver_errors(f"create tenant {namespace}/{name}", retry, memo):
+                await memo.pageserver_api.location_config(
+                    pageserver_url(namespace, node_id), shard_id, "AttachedSingle", generation=generation,
+                    shard_count=shard_count if len(shard_ids) > 1 else 0,
+                    stripe_size=int(spec.get('stripeSize') or resources.pageserver_api.DEFAULT_STRIPE_SIZE))
+    patch.status['tenantId'] = tenant_id
     kopf.info(spec, reason='CreatingTenant', message=f'Created {namespace}/{name}/{tenant_id}.')
-    kopf.adopt(spec)
 
 
-@kopf.on.update("neontenants")
-def update_tenant(spec, name, namespace, **_):
+@kopf.on.update("neontenants", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def update_tenant(spec, status, name, namespace, uid, retry, memo: kopf.Memo, ready_statefulsets: kopf.Index,
+                        ready_deployments: kopf.Index, pre_requisite_services: kopf.Index, **_):
     kopf.info(spec, reason='UpdatingTenant', message=f'Updating {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
-    check_for_pre_requisites(kube_client, namespace, name)
-    pageserver_url = f"http://pageserver.{namespace}.svc.cluster.local:6400"
-    # Call the api to update the tenant
-    request = {}
-    response = requests.put(f"{pageserver_url}/v1/tenant/config", json=request)
-
-
-@kopf.on.delete("neontenants")
-def delete_tenant(spec, name, namespace, **_):
+    async with memo.retry_limiter.slot(namespace, retry):
+        await wait_for_pre_requisites(namespace, name, retry, memo, ready_statefulsets, ready_deployments,
+                                      pre_requisite_services)
+        # The config of a tenant applies to all its shards on a pageserver.
+        tenant_id = pageserver_tenant_id(spec, uid)
+        for node_id in {node_id for _, node_id in tenant_shards_of(tenant_id, spec, status)}:
+            with pageserver_errors(f"update tenant {namespace}/{name}", retry, memo):
+                await memo.pageserver_api.set_tenant_config(pageserver_url(namespace, node_id), tenant_id)
+
+
+@kopf.on.field("neontenants", field="spec.pageserver", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def migrate_tenant(spec, status, name, namespace, retry, memo: kopf.Memo, patch: kopf.Patch,
+                         pageserver_pods: kopf.Index, **_):
+    target, source = spec.get('pageserver'), status.get('pageserver')
+    migration = status.get('migration') or {}
+    if migration.get('target') == target and migration.get('source') is not None \
+            and migration.get('durationSeconds') is None:
+        # Switched to the target already by an attempt which failed afterwards, the source still being attached.
+        source = migration['source']
+    # Tenants being created are placed on spec.pageserver directly, the shards of a sharded tenant are not moved.
+    if status.get('pageservers') or target is None or source is None or status.get('tenantId') is None \
+            or target == source:
+        return
+    if not any(pod.node_id == target and pod.ready for pod in pageserver_pods.get(namespace, [])):
+        raise memo.retry_policy.transient(f"Pageserver {target} of NeonTenant {namespace}/{name} is not ready",
+                                          retry)
+    kopf.info(spec, reason='MigratingTenant', message=f'Migrating {namespace}/{name} from pageserver {source} '
+                                                      f'to {target}.')
+
+    async def switch():
+        # Written right away rather than with the patch of the handler: the control plane points the computes at
+        # the target as soon as it sees it, while the source is still attached.
+        await kubernetes_asyncio.client.CustomObjectsApi(memo.kube_client).patch_namespaced_custom_object(
+            group="neon.tech", version="v1alpha1", plural="neontenants", namespace=namespace, name=name,
+            body={"status": {"pageserver": target,
+                             "migration": {"source": source, "target": target, "durationSeconds": None}}},
+            _content_type="application/merge-patch+json")
+
+    async with memo.retry_limiter.slot(namespace, retry):
+        with pageserver_errors(f"migrate tenant {namespace}/{name} to pageserver {target}", retry, memo):
+            try:
+                report = await memo.migrations.migrate(status['tenantId'], source, target,
+                                                       pageserver_url(namespace, source),
+                                                       pageserver_url(namespace, target),
+                                                       CONTROL_PLANE_URL.format(namespace=namespace), switch)
+            except resources.migration.MigrationError as e:
+                raise memo.retry_policy.transient(str(e), retry)
+    patch.status['pageserver'] = target
+    patch.status['migration'] = report.status()
+    kopf.info(spec, reason='MigratingTenant', message=f'Migrated {namespace}/{name} to pageserver {target} in '
+                                                      f'{report.duration_seconds:.1f}s.')
+
+
+@kopf.on.delete("neontenants", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def delete_tenant(spec, status, name, namespace, uid, retry, memo: kopf.Memo, ready_statefulsets: kopf.Index,
+                        **_):
     kopf.info(spec, reason='DeletingTenant', message=f'Deleting {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
-    check_for_pre_requisites(kube_client, namespace, name)
-    pageserver_url = f"http://pageserver.{namespace}.svc.cluster.local:6400"
-
-
-@kopf.on.create("neontimelines")
-def create_timeline(spec, name, namespace, **_):
+    # Not waited for: the pageserver may be gone for good when the whole namespace is being deleted.
+    if (namespace, "pageserver") not in ready_statefulsets:
+        return
+    for shard_id, node_id in tenant_shards_of(pageserver_tenant_id(spec, uid), spec, status):
+        with pageserver_errors(f"delete tenant {namespace}/{name}", retry, memo):
+            await memo.pageserver_api.delete_tenant(pageserver_url(namespace, node_id), shard_id)
+    standby = resources.failover.standby_tenant_of(name, spec, status)
+    for shard_id, _, secondary in standby.shards if standby is not None else ():
+        if secondary is not None:
+            with pageserver_errors(f"detach the secondary of tenant {namespace}/{name}", retry, memo):
+                await memo.pageserver_api.location_config(pageserver_url(namespace, secondary), shard_id,
+                                                          "Detached")
+
+
+@kopf.on.create("neontimelines", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def create_timeline(spec, name, namespace, uid, retry, memo: kopf.Memo, patch: kopf.Patch,
+                          ready_statefulsets: kopf.Index, ready_deployments: kopf.Index,
+                          pre_requisite_services: kopf.Index, tenant_pageservers: kopf.Index, **_):
     kopf.info(spec, reason='CreatingTimeline', message=f'Creating {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
-    check_for_pre_requisites(kube_client, namespace, name)
-    pageserver_url = f"http://pageserver.{namespace}.svc.cluster.local:6400"
-    # Call the api to create the timeline
-    request = {}
-    response = requests.post(f"{pageserver_url}/v1/timeline", json=request)
-    if response.status_code != 200:
-        raise kopf.PermanentError(f"Failed to create timeline {namespace}/{name}")
-    else:
-        timeline_id = response.text
-    kopf.info(spec, reason='CreatingTimeline', message=f'Created {namespace}/{name}/{timeline_id}.')
-    kopf.adopt(spec)
-
-
-@kopf.on.update("neontimelines")
-def update_timeline(spec, name, namespace, **_):
+    if spec.get('tenant_id') is None:
+        raise kopf.PermanentError(f"Tenant id is missing for NeonTimeline {namespace}/{name}")
+    async with memo.retry_limiter.slot(namespace, retry):
+        await wait_for_pre_requisites(namespace, name, retry, memo, ready_statefulsets, ready_deployments,
+                                      pre_requisite_services)
+        if (namespace, spec['tenant_id']) not in tenant_pageservers:
+            raise memo.retry_policy.transient(f"Tenant {spec['tenant_id']} of NeonTimeline {namespace}/{name} is not "
+                                              f"created yet", retry)
+        timeline_id = pageserver_timeline_id(spec, uid)
+        # Shard 0 first, like the storage controller of neon: it holds the metadata the other shards rely on.
+        (first_id, first_node), *others = tenant_shards(tenant_pageservers, namespace, spec['tenant_id'])
+        with pageserver_errors(f"create timeline {namespace}/{name}", retry, memo):
+            timeline = await memo.pageserver_api.create_timeline(pageserver_url(namespace, first_node), first_id,
+                                                                 timeline_id, pg_version=DEFAULT_PG_VERSION)
+            await asyncio.gather(*(memo.pageserver_api.create_timeline(pageserver_url(namespace, node_id), shard_id,
+                                                                       timeline_id, pg_version=DEFAULT_PG_VERSION)
+                                   for shard_id, node_id in others))
+    patch.status['timelineId'] = timeline.timeline_id
+    kopf.info(spec, reason='CreatingTimeline', message=f'Created {namespace}/{name}/{timeline.timeline_id}.')
+
+
+@kopf.on.update("neontimelines", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def update_timeline(spec, name, namespace, retry, memo: kopf.Memo, ready_statefulsets: kopf.Index,
+                          ready_deployments: kopf.Index, pre_requisite_services: kopf.Index, **_):
     kopf.info(spec, reason='UpdatingTimeline', message=f'Updating {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
-    check_for_pre_requisites(kube_client, namespace, name)
-    pageserver_url = f"http://pageserver.{namespace}.svc.cluster.local:6400"
-    # Call the api to update the timeline
-    request = {}
-    response = requests.put(f"{pageserver_url}/v1/timeline", json=request)
+    async with memo.retry_limiter.slot(namespace, retry):
+        await wait_for_pre_requisites(namespace, name, retry, memo, ready_statefulsets, ready_deployments,
+                                      pre_requisite_services)
 
 
-@kopf.on.delete("neontimelines")
-def delete_timeline(spec, name, namespace, **_):
+@kopf.on.delete("neontimelines", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def delete_timeline(spec, name, namespace, uid, retry, memo: kopf.Memo, ready_statefulsets: kopf.Index,
+                          tenant_pageservers: kopf.Index, **_):
     kopf.info(spec, reason='DeletingTimeline', message=f'Deleting {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
+    if spec.get('tenant_id') is None or (namespace, "pageserver") not in ready_statefulsets:
+        return
+    with pageserver_errors(f"delete timeline {namespace}/{name}", retry, memo):
+        await asyncio.gather(*(memo.pageserver_api.delete_timeline(pageserver_url(namespace, node_id), shard_id,
+                                                                   pageserver_timeline_id(spec, uid))
+                               for shard_id, node_id in tenant_shards(tenant_pageservers, namespace,
+                                                                      spec['tenant_id'])))
 
 
-@kopf.on.create("neondeployments")
-def create_deployment(spec, name, namespace, **_):
-    kopf.info(spec, reason='CreatingDeployment', message=f'Creating {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
-    aws_access_key_id = spec.get('storageConfig').get('credentials').get('awsAccessKeyID')
-    aws_secret_access_key = spec.get('storageConfig').get('credentials').get('awsSecretAccessKey')
+def pageserver_tenant_id(spec, uid: str) -> str:
+    """
+    The pageserver id of a NeonTenant: its spec.id, or one derived from the object's uid so that retries
+    and re-creations of the same object always target the same tenant
+    """
+    return spec.get('id') or uuid.UUID(uid).hex
 
-    if aws_access_key_id is None or aws_secret_access_key is None:
-        raise kopf.PermanentError(f"Storage credentials are missing for NeonDeployment {namespace}/{name}")
 
-    # Assign resource requests and limits
-    compute_node_resources = spec.get('computeNode').get('resources')
-    if compute_node_resources is None:
-        compute_node_resources = default_resource_limits()
+def pageserver_timeline_id(spec, uid: str) -> str:
+    return spec.get('id') or uuid.UUID(uid).hex
 
-    storage_broker_resources = spec.get('storageBroker').get('resources')
-    if storage_broker_resources is None:
-        storage_broker_resources = default_resource_limits()
 
-    control_plane_resources = spec.get('controlPlane').get('resources')
-    if control_plane_resources is None:
-        control_plane_resources = default_resource_limits()
+def pageserver_url(namespace: str, node_id: Optional[int]) -> str:
+    """
+    The http api of the pageserver a tenant is placed on, the pageserver service for the tenants created before
+    they were placed
+    """
+    if node_id is None:
+        return PAGESERVER_URL.format(namespace=namespace)
+    return PAGESERVER_NODE_URL.format(namespace=namespace, node_id=node_id)
 
-    pageserver_resources = spec.get('pageServer').get('resources')
-    if pageserver_resources is None:
-        pageserver_resources = default_resource_limits()
 
-    safekeeper_resources = spec.get('safeKeeper').get('resources')
-    if safekeeper_resources is None:
-        safekeeper_resources = default_resource_limits()
+def tenant_shards_of(tenant_id: str, spec, status) -> List[Tuple[str, Optional[int]]]:
+    """
+    The shard ids of a NeonTenant with the pageserver each shard is placed on, by shard number, a single one with
+    the tenant id for an unsharded tenant
+    """
+    shard_ids = resources.pageserver_api.tenant_shard_ids(tenant_id, int(spec.get('shardCount') or 0))
+    if len(shard_ids) == 1:
+        return [(tenant_id, status.get('pageserver'))]
+    node_ids = list(status.get('pageservers') or [])
+    return [(shard_id, node_ids[number] if number < len(node_ids) else None)
+            for number, shard_id in enumerate(shard_ids)]
 
-    # Storage Configuration
-    remote_storage_bucket_endpoint = spec.get('storageConfig').get('endpoint')
-    remote_storage_bucket_name = spec.get('storageConfig').get('bucketName')
-    remote_storage_bucket_region = spec.get('storageConfig').get('bucketRegion')
-    remote_storage_prefix_in_bucket = spec.get('storageConfig').get('prefixInBucket')
 
-    # All of the above must be present
-    if remote_storage_bucket_endpoint is None or remote_storage_bucket_name is None or remote_storage_bucket_region is None or remote_storage_prefix_in_bucket is None:
-        raise kopf.PermanentError(f"Storage configuration is missing for NeonDeployment {namespace}/{name}")
+def tenant_shards(tenant_pageservers: kopf.Index, namespace: str, tenant_id: str) -> List[Tuple[str, Optional[int]]]:
+    """
+    The shards of a tenant with their pageserver, from the index of the NeonTenants, the tenant itself on the
+    pageserver service when it is not known
+    """
+    for shards in tenant_pageservers.get((namespace, tenant_id), []):
+        return list(shards)
+    return [(tenant_id, None)]
+
 
+@contextlib.contextmanager
+def pageserver_errors(action: str, retry: int, memo: kopf.Memo):
+    """
+    Turn the failures of a pageserver call into kopf errors, retrying with backoff while the pageserver
+    is unreachable or overloaded
+    """
+    try:
+        yield
+    except (resources.pageserver_api.PageserverApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if resources.retry.is_transient(e):
+            raise memo.retry_policy.transient(f"Failed to {action}: {e}", retry)
+        raise kopf.PermanentError(f"Failed to {action}: {e}")
+
+
+@kopf.on.create("neondeployments", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def create_deployment(spec, name, namespace, memo: kopf.Memo, patch: kopf.Patch, **_):
+    kopf.info(spec, reason='CreatingDeployment', message=f'Creating {namespace}/{name}.')
+    desired_state = resources.apply.DesiredState()
+    steps = deployment_steps(spec, name, namespace, memo.kube_client, desired_state)
     try:
-        # Deploy the storage credentials secret
-        resources.common.deploy_secret(kube_client, namespace, aws_access_key_id, aws_secret_access_key)
-        # Deploy the storage broker
-        resources.storage_broker.deploy_storage_broker(kube_client, namespace)
-        # Deploy the safekeeper
-        resources.safekeeper.deploy_safekeeper(kube_client=kube_client,
-                                               namespace=namespace,
-                                               resources=safekeeper_resources,
-                                               remote_storage_bucket_endpoint=remote_storage_bucket_endpoint,
-                                               remote_storage_bucket_name=remote_storage_bucket_name,
-                                               remote_storage_bucket_region=remote_storage_bucket_region,
-                                               remote_storage_prefix_in_bucket=remote_storage_prefix_in_bucket)
-        # Deploy the control plane
-        resources.control_plane.deploy_control_plane(kube_client=kube_client,
-                                                     namespace=namespace,
-                                                     resources=control_plane_resources)
-
-    except Exception as e:
+        phases = await resources.rollout.run(steps)
+    except resources.rollout.RolloutError as e:
+        patch.status['rollout'] = {'phases': e.phases}
         raise kopf.PermanentError(f"Failed to create NeonDeployment {namespace}/{name}: {e}")
+    finally:
+        patch.status['desiredHashes'] = desired_state.hashes
+        patch.status['patches'] = {'applied': desired_state.applied, 'skipped': desired_state.skipped}
+    patch.status['rollout'] = {'phases': phases}
 
 
-@kopf.on.update("neondeployments")
-def update_deployment(spec, name, namespace, **_):
+@kopf.on.update("neondeployments", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def update_deployment(spec, status, name, namespace, memo: kopf.Memo, patch: kopf.Patch, **_):
     kopf.info(spec, reason='UpdatingDeployment', message=f'Updating {namespace}/{name}.')
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
+    # Only the objects whose desired-state hash differs from the last applied one are written.
+    desired_state = resources.apply.DesiredState(status.get('desiredHashes'))
+    steps = deployment_steps(spec, name, namespace, memo.kube_client, desired_state)
+    try:
+        phases = await resources.rollout.run(steps)
+    except resources.rollout.RolloutError as e:
+        patch.status['rollout'] = {'phases': e.phases}
+        raise kopf.PermanentError(f"Failed to update NeonDeployment {namespace}/{name}: {e}")
+    finally:
+        patch.status['desiredHashes'] = desired_state.hashes
+        patch.status['patches'] = {'applied': desired_state.applied, 'skipped': desired_state.skipped}
+    patch.status['rollout'] = {'phases': phases}
+
+
+def deployment_steps(spec, name, namespace, kube_client,
+                     desired_state: resources.apply.DesiredState) -> list:
+    """
+    Build the rollout steps applying every component of a NeonDeployment, used for both creates and updates
+    :param spec: The NeonDeployment spec
+    :param name: The name of the NeonDeployment
+    :param namespace: The namespace of the NeonDeployment
+    :param kube_client: The shared kubernetes api client
+    :param desired_state: The hashes of the objects applied so far, updated in place by the steps
+    :return: The steps to pass to resources.rollout.run
+    """
     aws_access_key_id = spec.get('storageConfig').get('credentials').get('awsAccessKeyID')
     aws_secret_access_key = spec.get('storageConfig').get('credentials').get('awsSecretAccessKey')
 
     if aws_access_key_id is None or aws_secret_access_key is None:
         raise kopf.PermanentError(f"Storage credentials are missing for NeonDeployment {namespace}/{name}")
 
-    # Preassign resource requests and limits
+    # Assign resource requests and limits
     compute_node_resources = spec.get('computeNode').get('resources')
     if compute_node_resources is None:
         compute_node_resources = default_resource_limits()
+    compute_cpu = resources.common.resource_quantity(compute_node_resources, 'cpu')
+    compute_memory = resources.common.resource_quantity(compute_node_resources, 'memory')
 
     storage_broker_resources = spec.get('storageBroker').get('resources')
     if storage_broker_resources is None:
         storage_broker_resources = default_resource_limits()
 
+    # Idle compute nodes the control plane keeps running, 0 starting them on wake up only.
+    warm_pool_size = spec.get('computeNode').get('warmPoolSize') or 0
+    # Idle time after which a compute is suspended, unless its NeonTimeline sets its own, 0 for never.
+    suspend_timeout_seconds = spec.get('computeNode').get('suspendTimeoutSeconds')
+    if suspend_timeout_seconds is None:
+        suspend_timeout_seconds = 300
+
     control_plane_resources = spec.get('controlPlane').get('resources')
     if control_plane_resources is None:
         control_plane_resources = default_resource_limits()
@@ -254,50 +444,149 @@ def update_deployment(spec, name, namespace, **_):
     remote_storage_bucket_name = spec.get('storageConfig').get('bucketName')
     remote_storage_bucket_region = spec.get('storageConfig').get('bucketRegion')
     remote_storage_prefix_in_bucket = spec.get('storageConfig').get('prefixInBucket')
+
     # All of the above must be present
     if remote_storage_bucket_endpoint is None or remote_storage_bucket_name is None or remote_storage_bucket_region is None or remote_storage_prefix_in_bucket is None:
         raise kopf.PermanentError(f"Storage configuration is missing for NeonDeployment {namespace}/{name}")
 
-    try:
-        # Update the storage credentials secret
-        resources.common.update_secret(kube_client, namespace, aws_access_key_id, aws_secret_access_key)
-        # Update the storage broker
-        resources.storage_broker.update_storage_broker(kube_client, namespace)
-        # Update the safekeeper
-        resources.safekeeper.update_safekeeper(kube_client, namespace, safekeeper_resources,
-                                               remote_storage_bucket_endpoint,
-                                               remote_storage_bucket_name,
-                                               remote_storage_bucket_region,
-                                               remote_storage_prefix_in_bucket
-                                               )
-        # Update the control plane
-        resources.control_plane.update_control_plane(kube_client, namespace, control_plane_resources)
-        # Update the pageserver
-        resources.pageserver.update_pageserver(kube_client, namespace, pageserver_resources)
-        # Update the compute nodes
-        resources.compute_node.update_compute_node(kube_client, namespace, compute_node_resources)
-    except Exception as e:
-        raise kopf.PermanentError(f"Failed to update NeonDeployment {namespace}/{name}: {e}")
-
-
-@kopf.on.delete("neondeployments")
-def delete_deployment(spec, name, namespace, **_):
+    # Each component waits only for the components it actually talks to.
+    return [
+        resources.rollout.Step(
+            name="secret",
+            action=functools.partial(resources.common.apply_secret, kube_client, namespace,
+                                     aws_access_key_id, aws_secret_access_key,
+                                     desired_state=desired_state)),
+        resources.rollout.Step(
+            name="storage-broker",
+            action=functools.partial(resources.storage_broker.apply_storage_broker, kube_client, namespace,
+                                     resources=storage_broker_resources,
+                                     desired_state=desired_state)),
+        resources.rollout.Step(
+            name="control-plane",
+            action=functools.partial(resources.control_plane.apply_control_plane,
+                                     kube_client=kube_client,
+                                     namespace=namespace,
+                                     resources=control_plane_resources,
+                                     warm_pool_size=warm_pool_size,
+                                     suspend_timeout_seconds=suspend_timeout_seconds,
+                                     compute_cpu=compute_cpu,
+                                     compute_memory=compute_memory,
+                                     settings_profile=spec.get('computeNode').get('settingsProfile'),
+                                     settings=spec.get('computeNode').get('settings'),
+                                     desired_state=desired_state)),
+        resources.rollout.Step(
+            name="safekeeper",
+            after=["secret", "storage-broker"],
+            action=functools.partial(resources.safekeeper.apply_safekeeper,
+                                     kube_client=kube_client,
+                                     namespace=namespace,
+                                     resources=safekeeper_resources,
+                                     replicas=spec.get('safeKeeper').get('replicas') or 3,
+                                     remote_storage_bucket_endpoint=remote_storage_bucket_endpoint,
+                                     remote_storage_bucket_name=remote_storage_bucket_name,
+                                     remote_storage_bucket_region=remote_storage_bucket_region,
+                                     remote_storage_prefix_in_bucket=remote_storage_prefix_in_bucket,
+                                     desired_state=desired_state)),
+        resources.rollout.Step(
+            name="pageserver",
+            after=["secret", "storage-broker", "control-plane"],
+            action=functools.partial(resources.pageserver.apply_pageserver,
+                                     kube_client=kube_client,
+                                     namespace=namespace,
+                                     resources=pageserver_resources,
+                                     replicas=spec.get('pageServer').get('replicas') or 1,
+                                     tuning=spec.get('pageServer').get('tuning'),
+                                     remote_storage_endpoint=remote_storage_bucket_endpoint,
+                                     remote_storage_bucket_name=remote_storage_bucket_name,
+                                     remote_storage_bucket_region=remote_storage_bucket_region,
+                                     remote_storage_prefix_in_bucket=remote_storage_prefix_in_bucket,
+                                     desired_state=desired_state)),
+        resources.rollout.Step(
+            name="compute-node",
+            after=["control-plane", "pageserver", "safekeeper"],
+            action=functools.partial(resources.compute_node.apply_compute_node,
+                                     kube_client=kube_client,
+                                     namespace=namespace,
+                                     resources=compute_node_resources,
+                                     desired_state=desired_state)),
+    ]
+
+
+@kopf.on.delete("neondeployments", when=resources.sharding.owns_namespace)
+@resources.metrics.reconcile
+async def delete_deployment(spec, name, namespace, memo: kopf.Memo, **_):
     kopf.info(spec, reason='DeletingDeployment', message=f'Deleting {namespace}/{name}.')
-    # We delete all the deployments and services
-    kubernetes.config.load_incluster_config()
-    kube_client = kubernetes.client.ApiClient()
-    # Delete the compute nodes
-    resources.compute_node.delete_compute_node(kube_client, namespace)
-    # Delete the pageserver
-    resources.pageserver.delete_pageserver(kube_client, namespace)
-    # Delete the control plane
-    resources.control_plane.delete_control_plane(kube_client, namespace)
-    # Delete the safekeeper
-    resources.safekeeper.delete_safekeeper(kube_client, namespace)
-    # Delete the storage broker
-    resources.storage_broker.delete_storage_broker(kube_client, namespace)
-    # Delete the storage credentials secret
-    resources.common.delete_secret(kube_client, namespace)
+    # We delete all the deployments and services, each one as soon as nothing depends on it anymore
+    kube_client = memo.kube_client
+    steps = [
+        resources.rollout.Step(
+            name="compute-node",
+            action=functools.partial(resources.compute_node.delete_compute_node, kube_client, namespace)),
+        resources.rollout.Step(
+            name="pageserver",
+            after=["compute-node"],
+            action=functools.partial(resources.pageserver.delete_pageserver, kube_client, namespace)),
+        resources.rollout.Step(
+            name="safekeeper",
+            after=["compute-node"],
+            action=functools.partial(resources.safekeeper.delete_safekeeper, kube_client, namespace)),
+        resources.rollout.Step(
+            name="control-plane",
+            after=["compute-node", "pageserver"],
+            action=functools.partial(resources.control_plane.delete_control_plane, kube_client, namespace)),
+        resources.rollout.Step(
+            name="storage-broker",
+            after=["pageserver", "safekeeper"],
+            action=functools.partial(resources.storage_broker.delete_storage_broker, kube_client, namespace)),
+        resources.rollout.Step(
+            name="secret",
+            after=["pageserver", "safekeeper"],
+            action=functools.partial(resources.common.delete_secret, kube_client, namespace)),
+    ]
+    try:
+        await resources.rollout.run(steps)
+    except resources.rollout.RolloutError as e:
+        raise kopf.PermanentError(f"Failed to delete NeonDeployment {namespace}/{name}: {e}")
+
+
+@kopf.timer("neondeployments", interval=REBALANCE_INTERVAL_SECONDS, initial_delay=REBALANCE_INTERVAL_SECONDS,
+            when=resources.sharding.owns_namespace)
+async def rebalance_pageservers(namespace, logger, memo: kopf.Memo, pageserver_pods: kopf.Index,
+                                placed_tenants: kopf.Index, **_):
+    if REBALANCE_SKEW <= 0:
+        return
+    move = await memo.placement.rebalance(namespace, list(pageserver_pods.get(namespace, [])),
+                                          list(placed_tenants.get(namespace, [])), REBALANCE_SKEW)
+    if move is None:
+        return
+    tenant, target = move
+    logger.info(f"Moving NeonTenant {namespace}/{tenant.name} from pageserver {tenant.node_id} to {target}.")
+    resources.metrics.REBALANCE_MIGRATIONS.inc()
+    # The migration itself is run by migrate_tenant, like the ones asked for by hand.
+    await kubernetes_asyncio.client.CustomObjectsApi(memo.kube_client).patch_namespaced_custom_object(
+        group="neon.tech", version="v1alpha1", plural="neontenants", namespace=namespace, name=tenant.name,
+        body={"spec": {"pageserver": target}}, _content_type="application/merge-patch+json")
+
+
+@kopf.timer("neondeployments", interval=FAILOVER_INTERVAL_SECONDS, when=resources.sharding.owns_namespace)
+async def failover_pageservers(namespace, logger, memo: kopf.Memo, pageserver_pods: kopf.Index,
+                               standby_tenants: kopf.Index, **_):
+    if not SECONDARY_LOCATIONS:
+        return
+    pods = list(pageserver_pods.get(namespace, []))
+
+    async def place(attached: int) -> int:
+        return (await memo.placement.place_shards(namespace, pods, 1, exclude={attached}))[0]
+
+    async def patch(tenant: resources.failover.StandbyTenant, body: dict):
+        await kubernetes_asyncio.client.CustomObjectsApi(memo.kube_client).patch_namespaced_custom_object(
+            group="neon.tech", version="v1alpha1", plural="neontenants", namespace=namespace, name=tenant.name,
+            body=body, _content_type="application/merge-patch+json")
+
+    dead = await memo.failover.reconcile(namespace, pods, list(standby_tenants.get(namespace, [])),
+                                         CONTROL_PLANE_URL.format(namespace=namespace), place, patch)
+    if dead:
+        logger.warning(f"Pageservers {sorted(dead)} of {namespace} are dead.")
 
 
 @kopf.on.login()
@@ -306,35 +595,123 @@ def login(**kwargs):
 
 
 @kopf.on.cleanup()
-async def cleanup_fn(logger, **kwargs):
+async def cleanup_fn(logger, memo: kopf.Memo, **kwargs):
+    shard_task = memo.get('shard_task')
+    if shard_task is not None:
+        shard_task.cancel()
+        await memo.shard.leave()
+    pageserver_api = memo.get('pageserver_api')
+    if pageserver_api is not None:
+        await pageserver_api.close()
+    kube_client = memo.get('kube_client')
+    if kube_client is not None:
+        await kube_client.close()
     logger.info("Cleanup completed.")
-    pass
 
 
-def check_for_pre_requisites(kube_client, namespace, name):
+# Components whose readiness gates NeonTenant and NeonTimeline handling. The indexes below are fed by
+# kopf's watches, so the prerequisite checks never read from the api server.
+PRE_REQUISITE_COMPONENTS = {"safekeeper", "pageserver", "storage-broker"}
+# How long a handler waits for the pre-requisites to become ready before backing off.
+PRE_REQUISITE_WAIT_SECONDS = float(os.getenv("PRE_REQUISITE_WAIT_SECONDS", "30"))
+
+
+def _is_pre_requisite(value, **_):
+    return value in PRE_REQUISITE_COMPONENTS
+
+
+@kopf.index("statefulsets", labels={"app": _is_pre_requisite})
+def ready_statefulsets(namespace, name, status, **_):
+    return {(namespace, name): status.get('readyReplicas') or 0}
+
+
+@kopf.index("deployments", labels={"app": _is_pre_requisite})
+def ready_deployments(namespace, name, status, **_):
+    return {(namespace, name): status.get('readyReplicas') or 0}
+
+
+@kopf.index("services", labels={"app": _is_pre_requisite})
+def pre_requisite_services(namespace, name, **_):
+    return {(namespace, name): True}
+
+
+@kopf.index("pods", labels={"app": "pageserver"})
+def pageserver_pods(namespace, name, labels, spec, status, **_):
+    pod = resources.placement.pageserver_pod_of(name, labels, spec, status)
+    return {namespace: pod} if pod is not None else None
+
+
+@kopf.index("neontenants")
+def tenant_pageservers(namespace, spec, status, uid, **_):
+    # The shards of each created tenant with their pageserver, None for those created before they were placed.
+    if status.get('tenantId') is None and status.get('pageserver') is None and not status.get('pageservers'):
+        return None
+    tenant_id = status.get('tenantId') or pageserver_tenant_id(spec, uid)
+    return {(namespace, tenant_id): tuple(tenant_shards_of(tenant_id, spec, status))}
+
+
+@kopf.index("neontenants")
+def placed_tenants(namespace, name, spec, status, **_):
+    if status.get('tenantId') is None or status.get('pageserver') is None:
+        return None
+    return {namespace: resources.placement.PlacedTenant(name=name, tenant_id=status['tenantId'],
+                                                         node_id=status['pageserver'],
+                                                         target=spec.get('pageserver'))}
+
+
+@kopf.index("neontenants")
+def standby_tenants(namespace, name, spec, status, **_):
+    tenant = resources.failover.standby_tenant_of(name, spec, status)
+    return {namespace: tenant} if tenant is not None else None
+
+
+# Event handlers run after the indexes are updated, so the woken up handlers see the new state.
+@kopf.on.event("statefulsets", labels={"app": _is_pre_requisite})
+@kopf.on.event("deployments", labels={"app": _is_pre_requisite})
+@kopf.on.event("services", labels={"app": _is_pre_requisite})
+async def pre_requisite_changed(namespace, memo: kopf.Memo, **_):
+    memo.pre_requisite_wakeups.notify(namespace)
+
+
+def missing_pre_requisite(namespace, name, ready_statefulsets: kopf.Index, ready_deployments: kopf.Index,
+                          pre_requisite_services: kopf.Index) -> Optional[str]:
     """
-    Check for the pre-requisites for NeonTenant deployment
+    Check for the pre-requisites for NeonTenant deployment from the in-memory indexes
+    :return: The first missing pre-requisite, None if all of them are ready
     """
-    safekeepker_statefulset = (kubernetes.client
-                               .AppsV1Api(kube_client)
-                               .read_namespaced_stateful_set(name="safekeeper", namespace=namespace))
-    if safekeepker_statefulset is None:
-        raise kopf.PermanentError(f"Safekeeper statefulset is missing for NeonTenant {namespace}/{name}")
-    if safekeepker_statefulset['status']['ready_replicas'] is None:
-        raise kopf.PermanentError(f"Safekeeper statefulset is not ready for NeonTenant {namespace}/{name}")
-    safekeepker_svc = kubernetes.client.CoreV1Api(kube_client).read_namespaced_service(name="pageserver",
-                                                                                       safekeeper=namespace)
-    if safekeepker_svc is None:
-        raise kopf.PermanentError(f"Safekeeper service is missing for NeonTenant {namespace}/{name}")
+    if (namespace, "safekeeper") not in ready_statefulsets:
+        return f"Safekeeper statefulset is missing for NeonTenant {namespace}/{name}"
+    if not max(ready_statefulsets[(namespace, "safekeeper")], default=0):
+        return f"Safekeeper statefulset is not ready for NeonTenant {namespace}/{name}"
+    if (namespace, "pageserver") not in ready_statefulsets:
+        return f"Pageserver statefulset is missing for NeonTenant {namespace}/{name}"
+    if not max(ready_statefulsets[(namespace, "pageserver")], default=0):
+        return f"Pageserver statefulset is not ready for NeonTenant {namespace}/{name}"
+    if (namespace, "pageserver") not in pre_requisite_services:
+        return f"Pageserver service is missing for NeonTenant {namespace}/{name}"
     # Check for storage_broker deployment
-    storage_broker_deployment = (kubernetes.client
-                                 .AppsV1Api(kube_client)
-                                 .read_namespaced_deployment(name="storage-broker", namespace=namespace))
-    if storage_broker_deployment is None:
-        raise kopf.PermanentError(f"Storage broker deployment is missing for NeonTenant {namespace}/{name}")
-    if storage_broker_deployment['status']['ready_replicas'] is None:
-        raise kopf.PermanentError(f"Storage broker deployment is not ready for NeonTenant {namespace}/{name}")
-    storage_broker_svc = kubernetes.client.CoreV1Api(kube_client).read_namespaced_service(name="storage-broker",
-                                                                                          namespace=namespace)
-    if storage_broker_svc is None:
-        raise kopf.PermanentError(f"Storage broker service is missing for NeonTenant {namespace}/{name}")
+    if (namespace, "storage-broker") not in ready_deployments:
+        return f"Storage broker deployment is missing for NeonTenant {namespace}/{name}"
+    if not max(ready_deployments[(namespace, "storage-broker")], default=0):
+        return f"Storage broker deployment is not ready for NeonTenant {namespace}/{name}"
+    if (namespace, "storage-broker") not in pre_requisite_services:
+        return f"Storage broker service is missing for NeonTenant {namespace}/{name}"
+    return None
+
+
+async def wait_for_pre_requisites(namespace, name, retry: int, memo: kopf.Memo, ready_statefulsets: kopf.Index,
+                                  ready_deployments: kopf.Index, pre_requisite_services: kopf.Index):
+    """
+    Wait until the pre-requisites of the namespace are ready, re-checking whenever one of them changes
+    :raises kopf.TemporaryError: if they are still not ready after the wait, so kopf retries with backoff
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PRE_REQUISITE_WAIT_SECONDS
+    while True:
+        missing = missing_pre_requisite(namespace, name, ready_statefulsets, ready_deployments,
+                                        pre_requisite_services)
+        if missing is None:
+            return
+        remaining = deadline - loop.time()
+        if remaining <= 0 or not await memo.pre_requisite_wakeups.wait(namespace, remaining):
+            raise memo.retry_policy.transient(missing, retry)
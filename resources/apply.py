@@ -0,0 +1,250 @@
+# Server-side apply engine shared by every resource module.
+import asyncio
+import functools
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import kubernetes
+import kubernetes_asyncio
+from kubernetes_asyncio.client import ApiException
+
+from resources import metrics
+
+FIELD_MANAGER = "neon-operator"
+DESIRED_HASH_ANNOTATION = "neon.tech/desired-hash"
+
+
+@functools.lru_cache(maxsize=None)
+def _serializer() -> kubernetes.client.ApiClient:
+    # Only its serialization is used, created on the first hash rather than on import.
+    return kubernetes.client.ApiClient()
+
+
+def desired_hash(obj) -> str:
+    """
+    Compute a stable content hash of a desired object and store it in its annotations
+    :param obj: The kubernetes object built by one of the resource builders
+    :return: The hex digest of the object's serialized content
+    """
+    body = _serializer().sanitize_for_serialization(obj)
+    body.get("metadata", {}).get("annotations", {}).pop(DESIRED_HASH_ANNOTATION, None)
+    digest = hashlib.sha256(json.dumps(body, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+    if obj.metadata.annotations is None:
+        obj.metadata.annotations = {}
+    obj.metadata.annotations[DESIRED_HASH_ANNOTATION] = digest
+    return digest
+
+
+class DesiredState:
+    """
+    Tracks the desired-state hashes of the objects of a NeonDeployment across reconciles.
+
+    Attributes:
+        hashes (Dict[str, str]): The last successfully applied hash per object, keyed by "Kind/name".
+        applied (int): The number of objects written during this reconcile.
+        skipped (int): The number of objects left alone because their desired state did not change.
+    """
+
+    def __init__(self, hashes: Optional[Dict[str, str]] = None):
+        self.hashes = dict(hashes or {})
+        self.applied = 0
+        self.skipped = 0
+
+    def is_current(self, obj) -> bool:
+        """
+        Check whether the object was already applied with the same desired state, counting it as skipped if so
+        """
+        digest = (obj.metadata.annotations or {}).get(DESIRED_HASH_ANNOTATION)
+        if digest is not None and self.hashes.get(_object_key(obj)) == digest:
+            self.skipped += 1
+            return True
+        return False
+
+    def record(self, obj):
+        """
+        Record the object as applied with its current desired state
+        """
+        self.hashes[_object_key(obj)] = obj.metadata.annotations[DESIRED_HASH_ANNOTATION]
+        self.applied += 1
+
+
+def _object_key(obj) -> str:
+    return f"{obj.kind}/{obj.metadata.name}"
+
+
+# The api class and method suffix used for each kind of object the builders produce.
+_APIS = {
+    "ConfigMap": (kubernetes_asyncio.client.CoreV1Api, "namespaced_config_map"),
+    "CronJob": (kubernetes_asyncio.client.BatchV1Api, "namespaced_cron_job"),
+    "Deployment": (kubernetes_asyncio.client.AppsV1Api, "namespaced_deployment"),
+    "PersistentVolumeClaim": (kubernetes_asyncio.client.CoreV1Api, "namespaced_persistent_volume_claim"),
+    "Role": (kubernetes_asyncio.client.RbacAuthorizationV1Api, "namespaced_role"),
+    "RoleBinding": (kubernetes_asyncio.client.RbacAuthorizationV1Api, "namespaced_role_binding"),
+    "Secret": (kubernetes_asyncio.client.CoreV1Api, "namespaced_secret"),
+    "Service": (kubernetes_asyncio.client.CoreV1Api, "namespaced_service"),
+    "ServiceAccount": (kubernetes_asyncio.client.CoreV1Api, "namespaced_service_account"),
+    "StatefulSet": (kubernetes_asyncio.client.AppsV1Api, "namespaced_stateful_set"),
+}
+
+
+@dataclass
+class ApplyResult:
+    """
+    The outcome of writing a single object.
+
+    Attributes:
+        kind (str): The kind of the object.
+        name (str): The name of the object.
+        action (str): One of applied, skipped, created, exists, deleted, absent or failed.
+        error (Optional[str]): The api error for failed objects.
+    """
+    kind: str
+    name: str
+    action: str
+    error: Optional[str] = None
+
+
+class ApplyError(Exception):
+    """
+    Raised when at least one object of a component could not be written.
+
+    Attributes:
+        results (List[ApplyResult]): The results of all objects of the request, including the successful ones.
+    """
+
+    def __init__(self, results: List[ApplyResult]):
+        self.results = results
+        failed = [f"{r.kind}/{r.name}: {r.error}" for r in results if r.action == "failed"]
+        super().__init__("; ".join(failed))
+
+
+async def apply(
+        kube_client: kubernetes_asyncio.client.ApiClient,
+        namespace: str,
+        objects: Iterable,
+        desired_state: DesiredState = None,
+) -> List[ApplyResult]:
+    """
+    Server-side apply the objects of a component concurrently, creating or updating them in a single write each
+    :param kube_client: The shared kubernetes api client
+    :param namespace: The namespace of the objects
+    :param objects: The objects built by the component's builders
+    :param desired_state: The hashes of the objects applied so far; objects whose hash is current are skipped
+    :return: One result per object
+    :raises ApplyError: if any object failed
+    """
+    return _check(await asyncio.gather(*(_apply(kube_client, namespace, obj, desired_state) for obj in objects)))
+
+
+async def create(
+        kube_client: kubernetes_asyncio.client.ApiClient,
+        namespace: str,
+        objects: Iterable,
+        desired_state: DesiredState = None,
+) -> List[ApplyResult]:
+    """
+    Create the objects that do not exist yet and leave existing ones untouched, for objects holding generated data
+    :param kube_client: The shared kubernetes api client
+    :param namespace: The namespace of the objects
+    :param objects: The objects built by the component's builders
+    :param desired_state: The hashes of the objects applied so far; objects whose hash is current are skipped
+    :return: One result per object, existing objects are reported as exists
+    :raises ApplyError: if any object failed
+    """
+    return _check(await asyncio.gather(*(_create(kube_client, namespace, obj, desired_state) for obj in objects)))
+
+
+async def delete(
+        kube_client: kubernetes_asyncio.client.ApiClient,
+        namespace: str,
+        refs: Iterable[Tuple[str, str]],
+) -> List[ApplyResult]:
+    """
+    Delete the objects of a component concurrently, objects which are already gone are reported as absent
+    :param kube_client: The shared kubernetes api client
+    :param namespace: The namespace of the objects
+    :param refs: The (kind, name) of each object to delete
+    :return: One result per object
+    :raises ApplyError: if any object failed
+    """
+    return _check(await asyncio.gather(*(_delete(kube_client, namespace, kind, name) for kind, name in refs)))
+
+
+async def _apply(kube_client, namespace, obj, desired_state: Optional[DesiredState]) -> ApplyResult:
+    kind, name = obj.kind, obj.metadata.name
+    if desired_state is not None and desired_state.is_current(obj):
+        return ApplyResult(kind, name, "skipped")
+    api, suffix = _APIS[kind]
+    try:
+        await getattr(api(kube_client), f"patch_{suffix}")(
+            name=name,
+            namespace=namespace,
+            body=kube_client.sanitize_for_serialization(obj),
+            field_manager=FIELD_MANAGER,
+            force=True,
+            _content_type="application/apply-patch+yaml",
+        )
+    except ApiException as e:
+        if e.status == 422 and kind == "Service" and await _unheadless_deleted(kube_client, namespace, obj):
+            return await _apply(kube_client, namespace, obj, desired_state)
+        return ApplyResult(kind, name, "failed", error=f"{e.status} {e.reason}")
+    if desired_state is not None:
+        desired_state.record(obj)
+    return ApplyResult(kind, name, "applied")
+
+
+async def _unheadless_deleted(kube_client, namespace, service) -> bool:
+    """
+    Delete the live service of a headless one when it has a cluster ip, which cannot be removed in place, so that
+    it is created again as a headless service
+    :return: Whether the service was deleted
+    """
+    if service.spec.cluster_ip != "None":
+        return False
+    api = kubernetes_asyncio.client.CoreV1Api(kube_client)
+    try:
+        live = await api.read_namespaced_service(name=service.metadata.name, namespace=namespace)
+        if live.spec.cluster_ip in (None, "None"):
+            return False
+        await api.delete_namespaced_service(name=service.metadata.name, namespace=namespace)
+    except ApiException:
+        return False
+    return True
+
+
+async def _create(kube_client, namespace, obj, desired_state: Optional[DesiredState]) -> ApplyResult:
+    kind, name = obj.kind, obj.metadata.name
+    if desired_state is not None and desired_state.is_current(obj):
+        return ApplyResult(kind, name, "skipped")
+    api, suffix = _APIS[kind]
+    try:
+        await getattr(api(kube_client), f"create_{suffix}")(namespace=namespace, body=obj,
+                                                            field_manager=FIELD_MANAGER)
+    except ApiException as e:
+        if e.status == 409:
+            return ApplyResult(kind, name, "exists")
+        return ApplyResult(kind, name, "failed", error=f"{e.status} {e.reason}")
+    if desired_state is not None:
+        desired_state.record(obj)
+    return ApplyResult(kind, name, "created")
+
+
+async def _delete(kube_client, namespace, kind: str, name: str) -> ApplyResult:
+    api, suffix = _APIS[kind]
+    try:
+        await getattr(api(kube_client), f"delete_{suffix}")(name=name, namespace=namespace)
+    except ApiException as e:
+        if e.status == 404:
+            return ApplyResult(kind, name, "absent")
+        return ApplyResult(kind, name, "failed", error=f"{e.status} {e.reason}")
+    return ApplyResult(kind, name, "deleted")
+
+
+def _check(results: List[ApplyResult]) -> List[ApplyResult]:
+    for result in results:
+        metrics.OBJECTS.labels(result.kind, result.action).inc()
+    if any(result.action == "failed" for result in results):
+        raise ApplyError(results)
+    return results
@@ -1,59 +1,40 @@
+from typing import List
+
 import kopf
 import kubernetes
-from kubernetes.client import ApiException
+import kubernetes_asyncio
+
+from resources import apply, metrics
 
 
-def deploy_autoscaler_agent(
-        kube_client: kubernetes.client.CoreV1Api,
+async def apply_autoscaler_agent(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
         image: str = "neondatabase/neon:latest",
         replicas: int = 1,
-):
+) -> List[apply.ApplyResult]:
     """
-    Deploy the autoscaler agent to the cluster
+    Create or update the autoscaler agent in the cluster with server-side apply
     :param kube_client: The kubernetes client to use
     :param namespace: The namespace to deploy to
     :param image: The image to use for the deployment
     :param replicas: The number of replicas to deploy
-    :return:
+    :return: The result of each applied object
     """
     deployment = autoscaler_agent_deployment(replicas, image)
     kopf.adopt(deployment)
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-
-    try:
-        apps_client.create_namespaced_deployment(namespace=namespace, body=deployment)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
-
-
-def update_autoscaler_agent(
-        kube_client: kubernetes.client.CoreV1Api,
-        namespace: str,
-        image: str = "neondatabase/neon:latest",
-        replicas: int = 1,
-):
-    deployment = autoscaler_agent_deployment(replicas, image)
-    kopf.adopt(deployment)
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
 
-    try:
-        apps_client.patch_namespaced_deployment(namespace=namespace, name="autoscaler-agent", body=deployment)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [deployment])
 
 
-def delete_autoscaler_agent(
-        kube_client: kubernetes.client.CoreV1Api,
+async def delete_autoscaler_agent(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    try:
-        apps_client.delete_namespaced_deployment(namespace=namespace, name="autoscaler-agent")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [("Deployment", "autoscaler-agent")])
 
 
+@metrics.builder
 def autoscaler_agent_deployment(
         replicas: int,
         image: str,
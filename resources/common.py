@@ -1,52 +1,105 @@
 import base64
-from typing import Optional
+from typing import List, Optional
 
 import jwt
 import kopf
 import kubernetes
+import kubernetes_asyncio
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
-from kubernetes.client import ApiException
 
+from resources import apply, metrics
 
-def deploy_secret(
-        kube_client: kubernetes.client.ApiClient,
-        namespace: str,
-        aws_access_key_id: str,
-        aws_secret_access_key: str,
-):
-    secret = neon_secret(namespace, aws_access_key_id, aws_secret_access_key)
-    kopf.adopt(secret)
-    api_instance = kubernetes.client.CoreV1Api(kube_client)
+
+_MEMORY_UNITS = {"Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40,
+                 "k": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9, "T": 10 ** 12}
+
+
+def parse_cpu(quantity: Optional[str], default: float = 1.0) -> float:
+    """
+    The cores of a kubernetes cpu quantity, such as 500m or 2
+    """
+    if quantity is None or str(quantity) == "":
+        return default
+    quantity = str(quantity)
+    if quantity.endswith("m"):
+        return float(quantity[:-1]) / 1000
+    return float(quantity)
+
+
+def parse_memory(quantity: Optional[str], default: int = 2 ** 30) -> int:
+    """
+    The bytes of a kubernetes memory quantity, such as 512Mi or 1G
+    """
+    if quantity is None or str(quantity) == "":
+        return default
+    quantity = str(quantity)
+    for unit, factor in _MEMORY_UNITS.items():
+        if quantity.endswith(unit):
+            return int(float(quantity[:-len(unit)]) * factor)
+    return int(float(quantity))
+
+
+def resource_quantity(resource_requirements, name: str) -> Optional[str]:
+    """
+    The limit of a resource, or its request without a limit, from the resources of a NeonDeployment component
+    """
+    if resource_requirements is None:
+        return None
+    if isinstance(resource_requirements, kubernetes.client.V1ResourceRequirements):
+        limits, requests = resource_requirements.limits, resource_requirements.requests
+    else:
+        limits, requests = resource_requirements.get('limits'), resource_requirements.get('requests')
+    return (limits or {}).get(name) or (requests or {}).get(name)
+
+
+async def kube_api_client(pool_maxsize: int = 32) -> kubernetes_asyncio.client.ApiClient:
+    """
+    Create the long-lived async kubernetes api client shared by all handlers
+    :param pool_maxsize: The maximum number of pooled connections to the api server
+    :return: An async kubernetes api client
+    """
+    configuration = kubernetes_asyncio.client.Configuration()
     try:
-        api_instance.create_namespaced_secret(namespace=namespace, body=secret)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+        kubernetes_asyncio.config.load_incluster_config(client_configuration=configuration)
+    except kubernetes_asyncio.config.ConfigException:
+        await kubernetes_asyncio.config.load_kube_config(client_configuration=configuration)
+    configuration.connection_pool_maxsize = pool_maxsize
+    return kubernetes_asyncio.client.ApiClient(configuration=configuration)
 
 
-def update_secret(
-        kube_client: kubernetes.client.ApiClient,
+async def apply_secret(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
         aws_access_key_id: str,
         aws_secret_access_key: str,
-):
+        desired_state: apply.DesiredState = None,
+) -> List[apply.ApplyResult]:
+    """
+    Create the storage credentials secret, or update the credentials of an existing one
+    :param kube_client: The shared kubernetes api client
+    :param namespace: The namespace to deploy to
+    :param aws_access_key_id: The AWS access key ID
+    :param aws_secret_access_key: The AWS secret access key
+    :param desired_state: The hashes of the objects applied so far, updated in place
+    :return: The apply results
+    """
     secret = neon_secret(namespace, aws_access_key_id, aws_secret_access_key)
-    api_instance = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        api_instance.patch_namespaced_secret(namespace=namespace, name="neon-storage-credentials", body=secret)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    kopf.adopt(secret)
+    results = await apply.create(kube_client, namespace, [secret], desired_state)
+    if results[0].action != "exists":
+        return results
+    # The auth keys generated on creation are kept, only the storage credentials are applied.
+    credentials = neon_secret(namespace, aws_access_key_id, aws_secret_access_key, with_auth_keys=False)
+    kopf.adopt(credentials)
+    return await apply.apply(kube_client, namespace, [credentials], desired_state)
 
 
-def delete_secret(
-        kube_client: kubernetes.client.ApiClient,
+async def delete_secret(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    api_instance = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        api_instance.delete_namespaced_secret(namespace=namespace, name="neon-storage-credentials")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [("Secret", "neon-storage-credentials")])
 
 
 def generate_jwt(private_key: Ed25519PrivateKey, claims: Optional[dict] = None) -> str:
@@ -60,18 +113,37 @@ def generate_jwt(private_key: Ed25519PrivateKey, claims: Optional[dict] = None)
     return jwt_token
 
 
+@metrics.builder
 def neon_secret(
         namespace: str,
         aws_access_key_id: str,
         aws_secret_access_key: str,
+        with_auth_keys: bool = True,
 ) -> kubernetes.client.V1Secret:
     """
     Create a secret for Neon storage credentials
     :param namespace: The namespace to create the secret in
     :param aws_access_key_id: The AWS access key ID
     :param aws_secret_access_key: The AWS secret access key
+    :param with_auth_keys: Whether to generate a new auth key pair and proxy token (default: True)
     :return: A kubernetes secret object
     """
+    secret = kubernetes.client.V1Secret(
+        api_version="v1",
+        kind="Secret",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="neon-storage-credentials",
+            namespace=namespace,
+        ),
+        data={
+            "AWS_ACCESS_KEY_ID": base64.b64encode(aws_access_key_id.encode("utf-8")).decode("utf-8"),
+            "AWS_SECRET_ACCESS_KEY": base64.b64encode(aws_secret_access_key.encode("utf-8")).decode("utf-8"),
+        },
+    )
+    # The generated keys differ on every call, so only the storage credentials count towards the desired state.
+    apply.desired_hash(secret)
+    if not with_auth_keys:
+        return secret
 
     private_key = Ed25519PrivateKey.generate()
     public_key = private_key.public_key()
@@ -87,19 +159,9 @@ def neon_secret(
         format=serialization.PublicFormat.SubjectPublicKeyInfo,
     )
 
-    secret = kubernetes.client.V1Secret(
-        api_version="v1",
-        kind="Secret",
-        metadata=kubernetes.client.V1ObjectMeta(
-            name="neon-storage-credentials",
-            namespace=namespace,
-        ),
-        data={
-            "AWS_ACCESS_KEY_ID": base64.b64encode(aws_access_key_id.encode("utf-8")).decode("utf-8"),
-            "AWS_SECRET_ACCESS_KEY": base64.b64encode(aws_secret_access_key.encode("utf-8")).decode("utf-8"),
-            "AUTH_PRIVATE_KEY": base64.b64encode(private_key_pem).decode("utf-8"),
-            "AUTH_PUBLIC_KEY": base64.b64encode(public_key_pem).decode("utf-8"),
-            "NEON_PROXY_TO_CONTROLPLANE_TOKEN": base64.b64encode("NEED_TODO_REPLACE_WITH_JWT".encode()).decode("utf-8"),
-        },
-    )
+    secret.data.update({
+        "AUTH_PRIVATE_KEY": base64.b64encode(private_key_pem).decode("utf-8"),
+        "AUTH_PUBLIC_KEY": base64.b64encode(public_key_pem).decode("utf-8"),
+        "NEON_PROXY_TO_CONTROLPLANE_TOKEN": base64.b64encode("NEED_TODO_REPLACE_WITH_JWT".encode()).decode("utf-8"),
+    })
     return secret
@@ -1,83 +1,47 @@
-# Create compute-node deployment with 3 replicas
+# Create the compute-node StatefulSet, the control plane owning its replicas.
+from typing import List, Optional
+
 import kopf
 import kubernetes
-from kubernetes.client import V1ResourceRequirements, ApiException, V1StatefulSet
+import kubernetes_asyncio
+from kubernetes.client import V1ResourceRequirements, V1StatefulSet
+
+from resources import apply, metrics
 
 
-def deploy_compute_node(
-        kube_client: kubernetes.client.ApiClient,
+async def apply_compute_node(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-        # replicas: int = 3,
         image: str = "neondatabase/compute-node-v16:latest",
         image_pull_policy: str = "IfNotPresent",
         extensions_bucket: str = "neon-dev-extensions-eu-central-1",
         extensions_bucket_region: str = "eu-central-1",
         resources: V1ResourceRequirements = None,
-):
+        desired_state: apply.DesiredState = None,
+) -> List[apply.ApplyResult]:
     statefulset: V1StatefulSet = compute_node_deployment(namespace=namespace,
                                                          image=image,
                                                          image_pull_policy=image_pull_policy,
                                                          extensions_bucket=extensions_bucket,
-                                                         # replicas=replicas,
                                                          extensions_bucket_region=extensions_bucket_region,
-                                                         resources=resources)
-    kopf.adopt(statefulset)
-    service = compute_node_service(namespace)
-    kopf.adopt(service)
-
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.create_namespaced_stateful_set(namespace=namespace, body=statefulset)
-        core_client.create_namespaced_service(namespace=namespace, body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
-
-
-def update_compute_node(
-        kube_client: kubernetes.client.ApiClient,
-        namespace: str,
-        # replicas: int = 3,
-        image: str = "neondatabase/compute-node-v16:latest",
-        image_pull_policy: str = "IfNotPresent",
-        extensions_bucket: str = "neon-dev-extensions-eu-central-1",
-        extensions_bucket_region: str = "eu-central-1",
-        resources: V1ResourceRequirements = None,
-):
-    statefulset = compute_node_deployment(namespace=namespace,
-                                          image=image,
-                                          image_pull_policy=image_pull_policy,
-                                          extensions_bucket=extensions_bucket,
-                                          # replicas=replicas,
-                                          extensions_bucket_region=extensions_bucket_region,
-                                          resources=resources)
+                                                         resources=resources,
+                                                         # Scaled by the control plane through statefulsets/scale.
+                                                         replicas=None)
     kopf.adopt(statefulset)
     service = compute_node_service(namespace)
     kopf.adopt(service)
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.patch_namespaced_stateful_set(namespace=namespace, name="compute-node", body=statefulset)
-        core_client.patch_namespaced_service(namespace=namespace, name="compute-node", body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [statefulset, service], desired_state)
 
 
-def delete_compute_node(
-        kube_client: kubernetes.client.ApiClient,
+async def delete_compute_node(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.delete_namespaced_deployment(namespace=namespace, name="compute-node")
-        core_client.delete_namespaced_config_map(namespace=namespace, name="compute-node-config")
-        core_client.delete_namespaced_service(namespace=namespace, name="compute-node")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [("StatefulSet", "compute-node"), ("Service", "compute-node")])
 
 
+@metrics.builder
 def compute_node_deployment(
         namespace: str,
         image: str,
@@ -85,7 +49,7 @@ def compute_node_deployment(
         extensions_bucket: str,
         extensions_bucket_region: str,
         resources: V1ResourceRequirements = None,
-        replicas: int = 3,
+        replicas: Optional[int] = 3,
         storage_capacity: str = "1Gi",
 ) -> kubernetes.client.V1StatefulSet:
     statefulset = kubernetes.client.V1StatefulSet(
@@ -187,7 +151,7 @@ def compute_node_deployment(
                     ),
                     spec=kubernetes.client.V1PersistentVolumeClaimSpec(
                         access_modes=["ReadWriteOnce"],
-                        resources=kubernetes.client.V1ResourceRequirements(
+                        resources=kubernetes.client.V1VolumeResourceRequirements(
                             requests={"storage": storage_capacity},
                         ),
                     ),
@@ -196,9 +160,11 @@ def compute_node_deployment(
         ),
     )
 
+    apply.desired_hash(statefulset)
     return statefulset
 
 
+@metrics.builder
 def compute_node_service(
         namespace: str,
 ) -> kubernetes.client.V1Service:
@@ -227,4 +193,5 @@ def compute_node_service(
         ),
     )
 
+    apply.desired_hash(service)
     return service
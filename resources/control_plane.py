@@ -1,73 +1,82 @@
-# A control plane api deployment with a service.
+# A control plane api deployment with a service, and the persistent volume claim of its generation store.
+import json
+from typing import Dict, List, Optional
+
 import kopf
 import kubernetes
-from kubernetes.client import V1ResourceRequirements, ApiException
-
-
-def deploy_control_plane(
-        kube_client: kubernetes.client.ApiClient,
-        namespace: str,
-        replicas: int = 1,
-        image: str = "ghcr.io/itsbalamurali/neon-operator:main",
-        image_pull_policy: str = "IfNotPresent",
-        resources: V1ResourceRequirements = None,
-):
-    deployment = control_plane_deployment(namespace, replicas, image, image_pull_policy, resources)
-    kopf.adopt(deployment)
-    service = control_plane_service(namespace)
-    kopf.adopt(service)
+import kubernetes_asyncio
+from kubernetes.client import V1ResourceRequirements
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.create_namespaced_deployment(namespace=namespace, body=deployment)
-        core_client.create_namespaced_service(namespace=namespace, body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+from resources import apply, metrics
 
 
-def update_control_plane(
-        kube_client: kubernetes.client.ApiClient,
+async def apply_control_plane(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
         replicas: int = 1,
         image: str = "ghcr.io/itsbalamurali/neon-operator:main",
         image_pull_policy: str = "IfNotPresent",
         resources: V1ResourceRequirements = None,
-):
-    deployment = control_plane_deployment(namespace, replicas, image, image_pull_policy, resources)
+        warm_pool_size: int = 0,
+        suspend_timeout_seconds: int = 300,
+        compute_cpu: Optional[str] = None,
+        compute_memory: Optional[str] = None,
+        settings_profile: Optional[str] = None,
+        settings: Optional[Dict[str, str]] = None,
+        desired_state: apply.DesiredState = None,
+) -> List[apply.ApplyResult]:
+    deployment = control_plane_deployment(namespace, replicas, image, image_pull_policy, resources, warm_pool_size,
+                                          suspend_timeout_seconds, compute_cpu=compute_cpu,
+                                          compute_memory=compute_memory, settings_profile=settings_profile,
+                                          settings=settings)
     kopf.adopt(deployment)
     service = control_plane_service(namespace)
     kopf.adopt(service)
+    access = control_plane_access(namespace)
+    for obj in access:
+        kopf.adopt(obj)
+    pvc = control_plane_pvc(namespace)
+    kopf.adopt(pvc)
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.patch_namespaced_deployment(namespace=namespace, name="control-plane", body=deployment)
-        core_client.patch_namespaced_service(namespace=namespace, name="control-plane", body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [*access, pvc, deployment, service], desired_state)
 
 
-def delete_control_plane(
-        kube_client: kubernetes.client.ApiClient,
+async def delete_control_plane(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.delete_namespaced_deployment(namespace=namespace, name="control-plane")
-        core_client.delete_namespaced_service(namespace=namespace, name="control-plane")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [
+        ("Deployment", "control-plane"),
+        ("Service", "control-plane"),
+        ("RoleBinding", "control-plane"),
+        ("Role", "control-plane"),
+        ("ServiceAccount", "control-plane"),
+        ("PersistentVolumeClaim", "control-plane-data"),
+    ])
 
 
+@metrics.builder
 def control_plane_deployment(
         namespace: str,
         replicas: int,
         image: str,
         image_pull_policy: str,
         resources: V1ResourceRequirements,
+        warm_pool_size: int = 0,
+        suspend_timeout_seconds: int = 300,
+        compute_cpu: Optional[str] = None,
+        compute_memory: Optional[str] = None,
+        settings_profile: Optional[str] = None,
+        settings: Optional[Dict[str, str]] = None,
 ) -> kubernetes.client.V1Deployment:
+    # The postgres settings of the computes are derived from their resources and the settings profile.
+    compute_settings_env = [
+        kubernetes.client.V1EnvVar(name=name, value=value)
+        for name, value in (("COMPUTE_CPU", compute_cpu), ("COMPUTE_MEMORY", compute_memory),
+                            ("COMPUTE_SETTINGS_PROFILE", settings_profile),
+                            ("COMPUTE_SETTINGS_OVERRIDES", json.dumps(settings, sort_keys=True) if settings else None))
+        if value is not None
+    ]
     deployment = kubernetes.client.V1Deployment(
         api_version="apps/v1",
         kind="Deployment",
@@ -78,6 +87,9 @@ def control_plane_deployment(
         ),
         spec=kubernetes.client.V1DeploymentSpec(
             # replicas=replicas,
+            # The old pod stops before the new one opens the generation store, so that two pods never issue
+            # generations from it at the same time.
+            strategy=kubernetes.client.V1DeploymentStrategy(type="Recreate"),
             selector=kubernetes.client.V1LabelSelector(
                 match_labels={"app": "control-plane"},
             ),
@@ -86,6 +98,7 @@ def control_plane_deployment(
                     labels={"app": "control-plane"},
                 ),
                 spec=kubernetes.client.V1PodSpec(
+                    service_account_name="control-plane",
                     containers=[
                         kubernetes.client.V1Container(
                             name="control-plane",
@@ -107,18 +120,49 @@ def control_plane_deployment(
                                         ),
                                     ),
                                 ),
+                                kubernetes.client.V1EnvVar(
+                                    name="GENERATION_STORE_PATH",
+                                    value="/data/generations.db",
+                                ),
+                                kubernetes.client.V1EnvVar(
+                                    name="COMPUTE_WARM_POOL_SIZE",
+                                    value=str(warm_pool_size),
+                                ),
+                                kubernetes.client.V1EnvVar(
+                                    name="COMPUTE_SUSPEND_TIMEOUT_SECONDS",
+                                    value=str(suspend_timeout_seconds),
+                                ),
+                                *compute_settings_env,
+                            ],
+                            volume_mounts=[
+                                kubernetes.client.V1VolumeMount(
+                                    name="data",
+                                    mount_path="/data",
+                                ),
                             ],
                             resources=resources,
                         ),
                     ],
+                    # The generation store, kept across restarts and reschedules of the pod: the generations it
+                    # issued may not be mirrored to the NeonTenant status yet.
+                    volumes=[
+                        kubernetes.client.V1Volume(
+                            name="data",
+                            persistent_volume_claim=kubernetes.client.V1PersistentVolumeClaimVolumeSource(
+                                claim_name="control-plane-data",
+                            ),
+                        ),
+                    ],
                 ),
             ),
         ),
     )
 
+    apply.desired_hash(deployment)
     return deployment
 
 
+@metrics.builder
 def control_plane_service(
         namespace: str,
 ) -> kubernetes.client.V1Service:
@@ -142,4 +186,93 @@ def control_plane_service(
         ),
     )
 
+    apply.desired_hash(service)
     return service
+
+
+@metrics.builder
+def control_plane_pvc(
+        namespace: str,
+        storage: str = "1Gi",
+) -> kubernetes.client.V1PersistentVolumeClaim:
+    pvc = kubernetes.client.V1PersistentVolumeClaim(
+        api_version="v1",
+        kind="PersistentVolumeClaim",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="control-plane-data",
+            namespace=namespace,
+            labels={"app": "control-plane"},
+        ),
+        spec=kubernetes.client.V1PersistentVolumeClaimSpec(
+            access_modes=["ReadWriteOnce"],
+            resources=kubernetes.client.V1VolumeResourceRequirements(
+                requests={"storage": storage},
+            ),
+        ),
+    )
+
+    apply.desired_hash(pvc)
+    return pvc
+
+
+@metrics.builder
+def control_plane_access(
+        namespace: str,
+) -> List:
+    """
+    The service account of the control plane, allowed to watch the NeonTenants and NeonTimelines of its namespace,
+    to record the generations it issues in the status of the NeonTenants, and to bind the compute node pods to the
+    NeonTimelines, suspend them and scale them for the warm pool, and to watch the safekeepers they stream to
+    """
+    labels = {"app": "control-plane"}
+    service_account = kubernetes.client.V1ServiceAccount(
+        api_version="v1",
+        kind="ServiceAccount",
+        metadata=kubernetes.client.V1ObjectMeta(name="control-plane", namespace=namespace, labels=labels),
+    )
+    role = kubernetes.client.V1Role(
+        api_version="rbac.authorization.k8s.io/v1",
+        kind="Role",
+        metadata=kubernetes.client.V1ObjectMeta(name="control-plane", namespace=namespace, labels=labels),
+        rules=[
+            kubernetes.client.V1PolicyRule(
+                api_groups=["neon.tech"],
+                resources=["neontenants"],
+                verbs=["get", "list", "watch", "patch"],
+            ),
+            kubernetes.client.V1PolicyRule(
+                api_groups=["neon.tech"],
+                resources=["neontimelines"],
+                verbs=["get", "list", "watch", "patch"],
+            ),
+            kubernetes.client.V1PolicyRule(
+                api_groups=[""],
+                resources=["pods"],
+                verbs=["get", "list", "watch", "patch", "delete"],
+            ),
+            kubernetes.client.V1PolicyRule(
+                api_groups=["discovery.k8s.io"],
+                resources=["endpointslices"],
+                verbs=["get", "list", "watch"],
+            ),
+            kubernetes.client.V1PolicyRule(
+                api_groups=["apps"],
+                resources=["statefulsets/scale"],
+                verbs=["get", "patch"],
+            ),
+        ],
+    )
+    role_binding = kubernetes.client.V1RoleBinding(
+        api_version="rbac.authorization.k8s.io/v1",
+        kind="RoleBinding",
+        metadata=kubernetes.client.V1ObjectMeta(name="control-plane", namespace=namespace, labels=labels),
+        role_ref=kubernetes.client.V1RoleRef(api_group="rbac.authorization.k8s.io", kind="Role",
+                                             name="control-plane"),
+        subjects=[kubernetes.client.RbacV1Subject(kind="ServiceAccount", name="control-plane",
+                                                  namespace=namespace)],
+    )
+
+    objects = [service_account, role, role_binding]
+    for obj in objects:
+        apply.desired_hash(obj)
+    return objects
@@ -0,0 +1,214 @@
+# Warm standby of the tenants on the pageservers of a namespace: every tenant shard gets a secondary location on
+# another pageserver, which downloads the layers of the heatmap its attached location uploads. When a pageserver dies
+# the secondaries of its shards are promoted with a new generation from the control plane, so that the computes read
+# from a pageserver which already holds the hot layers instead of one downloading them all from the remote storage.
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+
+from resources import metrics
+from resources.pageserver_api import DEFAULT_STRIPE_SIZE, PageserverApiError, PageserverClient, tenant_shard_ids
+from resources.placement import PageserverPod
+
+
+@dataclass(frozen=True)
+class StandbyTenant:
+    """
+    A created NeonTenant with the pageservers of its shards, from the index of the NeonTenants.
+
+    Attributes:
+        name (str): The name of the NeonTenant.
+        tenant_id (str): The pageserver tenant id.
+        shards (Tuple[Tuple[str, Optional[int], Optional[int]], ...]): The shard id of each shard by shard number,
+            with the pageserver it is attached to and the one holding its secondary location.
+        shard_count (int): The shards of the tenant, 0 for an unsharded tenant.
+        stripe_size (int): The stripe size of a sharded tenant, in pages.
+        pinned (bool): Whether the pageserver of the tenant is set in its spec.pageserver.
+        migrating (bool): Whether the tenant is being moved to another pageserver.
+    """
+    name: str
+    tenant_id: str
+    shards: Tuple[Tuple[str, Optional[int], Optional[int]], ...]
+    shard_count: int = 0
+    stripe_size: int = DEFAULT_STRIPE_SIZE
+    pinned: bool = False
+    migrating: bool = False
+
+    def body(self, attached: List[Optional[int]], secondaries: List[Optional[int]]) -> Dict:
+        """
+        The patch of the NeonTenant recording the pageservers of its shards. A promoted tenant pinned to a
+        pageserver is pinned to the new one, which is not a migration since it is attached there already
+        """
+        if self.shard_count > 1:
+            return {"status": {"pageservers": attached, "secondaries": secondaries}}
+        body = {"status": {"pageserver": attached[0], "secondary": secondaries[0]}}
+        if self.pinned:
+            body["spec"] = {"pageserver": attached[0]}
+        return body
+
+
+def standby_tenant_of(name: str, spec: dict, status: dict) -> Optional[StandbyTenant]:
+    """
+    The standby of a NeonTenant, None for the tenants which are not created yet
+    """
+    if status.get("tenantId") is None:
+        return None
+    shard_count = int(spec.get("shardCount") or 0)
+    shard_ids = tenant_shard_ids(status["tenantId"], shard_count)
+    if len(shard_ids) > 1:
+        attached, secondaries = list(status.get("pageservers") or []), list(status.get("secondaries") or [])
+    else:
+        attached, secondaries = [status.get("pageserver")], [status.get("secondary")]
+    if len(attached) < len(shard_ids) or None in attached:
+        return None
+    secondaries += [None] * (len(shard_ids) - len(secondaries))
+    return StandbyTenant(name=name, tenant_id=status["tenantId"],
+                         shards=tuple(zip(shard_ids, attached, secondaries)),
+                         shard_count=shard_count if len(shard_ids) > 1 else 0,
+                         stripe_size=int(spec.get("stripeSize") or DEFAULT_STRIPE_SIZE),
+                         pinned=spec.get("pageserver") is not None,
+                         migrating=spec.get("pageserver") is not None and spec["pageserver"] != attached[0])
+
+
+class Failover:
+    """
+    Keeps a warm secondary location for every tenant shard of a namespace and promotes them when a pageserver dies.
+
+    A pageserver is dead once its pod has been unready for grace_seconds and it does not answer its status
+    endpoint. The shards attached to it whose secondary is on a ready pageserver get a new generation for that
+    pageserver from the control plane, which makes the dead pageserver stale if it comes back, and the secondary is
+    attached in AttachedSingle. The shards without a secondary on a ready pageserver, such as the promoted ones, get
+    a new one on the least loaded other pageserver: it is set to a warm Secondary location, the attached location
+    uploads its heatmap and the secondary starts downloading it, then keeps following it at every heatmap period of
+    the tenant.
+
+    Attributes:
+        client (PageserverClient): The pooled client of the pageserver http api and the control plane hook.
+        node_url (str): The http api of a pageserver, formatted with its namespace and node_id.
+        grace_seconds (float): How long a pageserver pod may be unready before its shards are promoted elsewhere.
+    """
+
+    def __init__(self, client: PageserverClient, node_url: str, grace_seconds: float = 30):
+        self.client = client
+        self.node_url = node_url
+        self.grace_seconds = grace_seconds
+        # When each pageserver pod was first seen unready.
+        self._unready_since: Dict[Tuple[str, int], float] = {}
+        self._logger = logging.getLogger(__name__)
+
+    def url(self, namespace: str, node_id: int) -> str:
+        return self.node_url.format(namespace=namespace, node_id=node_id)
+
+    async def dead(self, namespace: str, pods: List[PageserverPod]) -> Dict[int, float]:
+        """
+        The dead pageservers of a namespace
+        :return: The monotonic time each dead pageserver was first seen unready, by node id
+        """
+        now = time.monotonic()
+        for pod in pods:
+            if pod.ready:
+                self._unready_since.pop((namespace, pod.node_id), None)
+            else:
+                self._unready_since.setdefault((namespace, pod.node_id), now)
+        suspects = [pod.node_id for pod in pods if not pod.ready
+                    and now - self._unready_since[(namespace, pod.node_id)] >= self.grace_seconds]
+        answers = await asyncio.gather(*(self.client.healthy(self.url(namespace, node_id)) for node_id in suspects))
+        return {node_id: self._unready_since[(namespace, node_id)]
+                for node_id, healthy in zip(suspects, answers) if not healthy}
+
+    async def promote(self, namespace: str, tenant: StandbyTenant, shard_id: str, node_id: int,
+                      control_plane_url: str) -> bool:
+        """
+        Attach a shard to the pageserver holding its secondary location, with a new generation
+        :return: Whether it was promoted, False if the control plane does not know the shard
+        """
+        generation = await self.client.attach_hook(control_plane_url, shard_id, node_id)
+        if generation is None:
+            return False
+        await self.client.location_config(self.url(namespace, node_id), shard_id, "AttachedSingle",
+                                          generation=generation, shard_count=tenant.shard_count,
+                                          stripe_size=tenant.stripe_size)
+        return True
+
+    async def add_secondary(self, namespace: str, tenant: StandbyTenant, shard_id: str, attached: int,
+                            node_id: int):
+        """
+        Set up a warm secondary location of a shard and start filling it from the heatmap of the attached location
+        """
+        await self.client.location_config(self.url(namespace, node_id), shard_id, "Secondary",
+                                          shard_count=tenant.shard_count, stripe_size=tenant.stripe_size)
+        try:
+            await self.client.heatmap_upload(self.url(namespace, attached), shard_id)
+            await self.client.secondary_download(self.url(namespace, node_id), shard_id)
+        except PageserverApiError as e:
+            # The secondary catches up with the heatmap at the next heatmap period anyway.
+            self._logger.debug(f"Warming up the secondary of {shard_id} on pageserver {node_id} failed: {e}")
+        metrics.SECONDARY_LOCATIONS.inc()
+
+    async def reconcile_tenant(self, namespace: str, tenant: StandbyTenant, ready: Set[int], dead: Dict[int, float],
+                               control_plane_url: str, place: Callable[[int], Awaitable[int]],
+                               patch: Callable[[StandbyTenant, Dict], Awaitable[None]]):
+        """
+        Promote the shards of a tenant attached to a dead pageserver, then give a secondary location to those
+        without one on a ready pageserver
+        :param place: Picks the pageserver of a new secondary location, other than the given attached pageserver
+        :param patch: Records the new pageservers of the shards in the NeonTenant
+        """
+        attached = [node_id for _, node_id, _ in tenant.shards]
+        secondaries = [secondary for _, _, secondary in tenant.shards]
+        for number, (shard_id, node_id, secondary) in enumerate(tenant.shards):
+            if node_id not in dead:
+                continue
+            if secondary is None or secondary not in ready or secondary == node_id:
+                self._logger.warning(f"Shard {shard_id} of {namespace}/{tenant.name} is on the dead pageserver "
+                                     f"{node_id} without a secondary location to promote.")
+                metrics.FAILOVER_PROMOTIONS.labels("unprotected").inc()
+                continue
+            if not await self.promote(namespace, tenant, shard_id, secondary, control_plane_url):
+                continue
+            self._logger.info(f"Promoted shard {shard_id} of {namespace}/{tenant.name} from the dead pageserver "
+                              f"{node_id} to its secondary on {secondary}.")
+            metrics.FAILOVER_PROMOTIONS.labels("promoted").inc()
+            metrics.FAILOVER_SECONDS.observe(time.monotonic() - dead[node_id])
+            attached[number], secondaries[number] = secondary, None
+        if attached != [node_id for _, node_id, _ in tenant.shards]:
+            # Recorded before the new secondaries are set up: it points the computes at the promoted shards.
+            await patch(tenant, tenant.body(attached, secondaries))
+        added = False
+        for number, (shard_id, _, _) in enumerate(tenant.shards):
+            if attached[number] not in ready or (secondaries[number] in ready and
+                                                 secondaries[number] != attached[number]):
+                continue
+            try:
+                node_id = await place(attached[number])
+            except PageserverApiError as e:
+                # A single ready pageserver has no other one to back it up.
+                self._logger.debug(f"No secondary location for shard {shard_id} of {namespace}/{tenant.name}: {e}")
+                continue
+            await self.add_secondary(namespace, tenant, shard_id, attached[number], node_id)
+            secondaries[number], added = node_id, True
+        if added:
+            await patch(tenant, tenant.body(attached, secondaries))
+
+    async def reconcile(self, namespace: str, pods: List[PageserverPod], tenants: List[StandbyTenant],
+                        control_plane_url: str, place: Callable[[int], Awaitable[int]],
+                        patch: Callable[[StandbyTenant, Dict], Awaitable[None]]) -> Dict[int, float]:
+        """
+        Reconcile the standby of the tenants of a namespace, the tenants being migrated excepted
+        :return: The dead pageservers of the namespace
+        """
+        dead = await self.dead(namespace, pods)
+        ready = {pod.node_id for pod in pods if pod.ready}
+        results = await asyncio.gather(*(self.reconcile_tenant(namespace, tenant, ready, dead, control_plane_url,
+                                                               place, patch)
+                                         for tenant in tenants if not tenant.migrating), return_exceptions=True)
+        for tenant, result in zip([tenant for tenant in tenants if not tenant.migrating], results):
+            if isinstance(result, (PageserverApiError, aiohttp.ClientError, asyncio.TimeoutError)):
+                self._logger.warning(f"Reconciling the standby of {namespace}/{tenant.name} failed: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+        return dead
@@ -0,0 +1,127 @@
+# Prometheus metrics of the operator's reconcile hot path, served on /metrics.
+import contextvars
+import functools
+import time
+from typing import Dict, Optional
+
+import kopf
+import kubernetes_asyncio
+import prometheus_client
+
+RECONCILE_SECONDS = prometheus_client.Histogram(
+    "neon_operator_reconcile_seconds", "Time spent in a handler invocation.", ["handler", "outcome"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+RECONCILES_IN_PROGRESS = prometheus_client.Gauge(
+    "neon_operator_reconciles_in_progress", "Handler invocations currently running.", ["handler"])
+RETRIES = prometheus_client.Counter(
+    "neon_operator_retries_total", "Handler invocations ending in a retry.", ["handler"])
+API_CALLS = prometheus_client.Counter(
+    "neon_operator_api_calls_total", "Kubernetes api calls made by the operator.", ["verb", "resource"])
+API_CALLS_PER_RECONCILE = prometheus_client.Histogram(
+    "neon_operator_api_calls_per_reconcile", "Kubernetes api calls made by a single handler invocation.",
+    ["handler"], buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128))
+OBJECTS = prometheus_client.Counter(
+    "neon_operator_objects_total", "Objects handled by the apply engine, by outcome.", ["kind", "action"])
+PAGESERVER_SECONDS = prometheus_client.Histogram(
+    "neon_operator_pageserver_request_seconds", "Latency of the pageserver http api calls.",
+    ["method", "endpoint", "status"])
+BUILDER_SECONDS = prometheus_client.Histogram(
+    "neon_operator_builder_seconds", "Time spent building the desired objects of a component.", ["builder"],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+TENANT_MIGRATION_SECONDS = prometheus_client.Histogram(
+    "neon_operator_tenant_migration_seconds", "Duration of the tenant migrations between pageservers, cold when "
+    "the computes switched before the target caught up.", ["outcome"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200))
+TENANT_MIGRATION_READ_LATENCY = prometheus_client.Histogram(
+    "neon_operator_tenant_migration_read_latency_seconds", "Mean read latency of a migrated tenant on the source "
+    "before the computes switched and on the target after.", ["phase"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+REBALANCE_MIGRATIONS = prometheus_client.Counter(
+    "neon_operator_rebalance_migrations_total", "Tenant migrations started by the pageserver rebalancer.")
+FAILOVER_SECONDS = prometheus_client.Histogram(
+    "neon_operator_failover_seconds", "Time from a pageserver turning unready until a tenant shard it held was "
+    "promoted on its secondary location.",
+    buckets=(1, 5, 10, 20, 30, 45, 60, 120, 300, 600))
+FAILOVER_PROMOTIONS = prometheus_client.Counter(
+    "neon_operator_failover_promotions_total", "Tenant shards of a dead pageserver by outcome, unprotected when "
+    "they had no secondary location to promote.", ["outcome"])
+SECONDARY_LOCATIONS = prometheus_client.Counter(
+    "neon_operator_secondary_locations_total", "Secondary locations set up to keep a warm standby of a tenant shard.")
+QUEUE_DEPTH = prometheus_client.Gauge(
+    "neon_operator_queue_depth", "Handlers waiting, for a retry slot or for their pre-requisites.", ["queue"])
+
+# The api calls made by the handler invocation running in the current task and the tasks it spawned.
+_api_calls: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar("api_calls", default=None)
+
+
+def serve(port: int):
+    """
+    Serve the /metrics endpoint from a background thread
+    """
+    prometheus_client.start_http_server(port)
+
+
+def reconcile(fn):
+    """
+    Measure a kopf handler: its latency and outcome, the api calls it makes and whether it ends in a retry
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        handler = fn.__name__
+        calls = {"count": 0}
+        token = _api_calls.set(calls)
+        outcome = "success"
+        started = time.perf_counter()
+        RECONCILES_IN_PROGRESS.labels(handler).inc()
+        try:
+            return await fn(*args, **kwargs)
+        except kopf.TemporaryError:
+            outcome = "retry"
+            RETRIES.labels(handler).inc()
+            raise
+        except BaseException:
+            outcome = "failure"
+            raise
+        finally:
+            RECONCILES_IN_PROGRESS.labels(handler).dec()
+            RECONCILE_SECONDS.labels(handler, outcome).observe(time.perf_counter() - started)
+            API_CALLS_PER_RECONCILE.labels(handler).observe(calls["count"])
+            _api_calls.reset(token)
+    return wrapper
+
+
+def builder(fn):
+    """
+    Measure the time spent in a resource builder
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with BUILDER_SECONDS.labels(fn.__name__).time():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def instrument(kube_client: kubernetes_asyncio.client.ApiClient) -> kubernetes_asyncio.client.ApiClient:
+    """
+    Count every api call made through the client, by verb and resource
+    """
+    call_api = kube_client.call_api
+
+    @functools.wraps(call_api)
+    def counted_call_api(resource_path, method, *args, **kwargs):
+        API_CALLS.labels(method.lower(), _resource(resource_path)).inc()
+        calls = _api_calls.get()
+        if calls is not None:
+            calls["count"] += 1
+        return call_api(resource_path, method, *args, **kwargs)
+
+    kube_client.call_api = counted_call_api
+    return kube_client
+
+
+def _resource(resource_path: str) -> str:
+    # /apis/apps/v1/namespaces/{namespace}/statefulsets/{name}/status -> statefulsets/status
+    parts = [part for part in resource_path.strip("/").split("/") if not part.startswith("{")]
+    if len(parts) > 1 and parts[-1] in ("status", "scale"):
+        return f"{parts[-2]}/{parts[-1]}"
+    return parts[-1] if parts else ""
@@ -0,0 +1,186 @@
+# Live migration of a tenant between pageservers with the generations of the control plane: the source is made stale,
+# the target attached with a new generation and warmed up until it caught up with the source, the computes switched
+# over to the target, and the source detached once they have settled on it.
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import aiohttp
+
+from resources import metrics
+from resources.pageserver_api import PageserverApiError, PageserverClient
+from resources.placement import parse_metrics
+
+# The latency of the reads of the computes, served by get_page_at_lsn.
+GETPAGE_METRIC = "pageserver_smgr_query_seconds"
+GETPAGE_QUERY = "get_page_at_lsn"
+
+
+def parse_lsn(lsn: Optional[str]) -> int:
+    """
+    The position of a postgres LSN such as 0/16B9188
+    """
+    if not lsn:
+        return 0
+    high, _, low = lsn.partition("/")
+    return (int(high, 16) << 32) + int(low or "0", 16)
+
+
+@dataclass
+class MigrationReport:
+    """
+    How a migration went, recorded in the status.migration of the NeonTenant.
+
+    Attributes:
+        source (int): The pageserver the tenant moved from.
+        target (int): The pageserver the tenant moved to.
+        generation (int): The generation of the tenant on the target.
+        duration_seconds (float): The time from the start of the migration until the source was detached.
+        warmed_up (bool): Whether the target caught up with the source before the computes were switched.
+        read_latency_before (Optional[float]): The mean read latency of the tenant on the source while it was
+            migrated, None without reads.
+        read_latency_after (Optional[float]): The mean read latency of the tenant on the target once the computes
+            switched, None without reads.
+    """
+    source: int
+    target: int
+    generation: int
+    duration_seconds: float = 0.0
+    warmed_up: bool = False
+    read_latency_before: Optional[float] = None
+    read_latency_after: Optional[float] = None
+
+    def status(self) -> Dict:
+        return {
+            "source": self.source,
+            "target": self.target,
+            "generation": self.generation,
+            "durationSeconds": round(self.duration_seconds, 3),
+            "warmedUp": self.warmed_up,
+            "readLatencyBeforeSeconds": self.read_latency_before,
+            "readLatencyAfterSeconds": self.read_latency_after,
+        }
+
+
+class MigrationError(Exception):
+    """
+    Raised when a migration cannot proceed, such as a tenant unknown to the control plane.
+    """
+
+
+class Migrations:
+    """
+    Moves tenants between the pageservers of a namespace without downtime.
+
+    The source is first set to AttachedStale, keeping on serving reads but no longer deleting layers, then the
+    control plane issues a new generation for the target, which is attached in AttachedMulti and warmed up: it
+    downloads the layers it needs and ingests the WAL until the last record LSN of every timeline caught up with
+    the source, for warmup_timeout_seconds at most. The computes are then switched over, the source is detached
+    after settle_seconds and the target becomes AttachedSingle. Each step can be run again, so that a failed
+    migration is retried from the start.
+
+    Attributes:
+        client (PageserverClient): The pooled client of the pageserver http api and the control plane hook.
+        warmup_timeout_seconds (float): How long the target is given to catch up before the computes switch anyway.
+        settle_seconds (float): How long the source stays attached once the computes switched, while the read
+            latency on the target is measured.
+        poll_seconds (float): How often the warm up is checked.
+    """
+
+    def __init__(self, client: PageserverClient, warmup_timeout_seconds: float = 300, settle_seconds: float = 30,
+                 poll_seconds: float = 1):
+        self.client = client
+        self.warmup_timeout_seconds = warmup_timeout_seconds
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self._logger = logging.getLogger(__name__)
+
+    async def read_latency(self, base_url: str, tenant_id: str) -> Tuple[float, float]:
+        """
+        The total seconds and count of the reads of a tenant on a pageserver, (0, 0) when they cannot be read
+        """
+        try:
+            text = await self.client.metrics(base_url)
+        except (PageserverApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.debug(f"Reading the read latency of {tenant_id} from {base_url} failed: {e}")
+            return 0.0, 0.0
+        values = parse_metrics(text, (f"{GETPAGE_METRIC}_sum", f"{GETPAGE_METRIC}_count"),
+                               labels={"tenant_id": tenant_id, "smgr_query_type": GETPAGE_QUERY})
+        return values[f"{GETPAGE_METRIC}_sum"], values[f"{GETPAGE_METRIC}_count"]
+
+    @staticmethod
+    def mean(first: Tuple[float, float], last: Tuple[float, float]) -> Optional[float]:
+        count = last[1] - first[1]
+        if count <= 0:
+            return None
+        return (last[0] - first[0]) / count
+
+    async def caught_up(self, source_url: str, target_url: str, tenant_id: str) -> bool:
+        """
+        Whether every timeline of the tenant on the target reached the last record LSN it has on the source
+        """
+        source, target = await asyncio.gather(self.client.list_timelines(source_url, tenant_id),
+                                              self.client.list_timelines(target_url, tenant_id))
+        target_lsns = {timeline.timeline_id: parse_lsn(timeline.last_record_lsn) for timeline in target}
+        return all(target_lsns.get(timeline.timeline_id, -1) >= parse_lsn(timeline.last_record_lsn)
+                   for timeline in source)
+
+    async def warm_up(self, source_url: str, target_url: str, tenant_id: str) -> bool:
+        """
+        Wait until the target caught up with the source
+        :return: Whether it did before warmup_timeout_seconds
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.warmup_timeout_seconds
+        while True:
+            try:
+                if await self.caught_up(source_url, target_url, tenant_id):
+                    return True
+            except PageserverApiError as e:
+                # The target answers 404 or 503 while it is still activating the tenant.
+                if e.status not in (404, 503):
+                    raise
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_seconds)
+
+    async def migrate(self, tenant_id: str, source: int, target: int, source_url: str, target_url: str,
+                      control_plane_url: str, switch: Callable[[], Awaitable[None]]) -> MigrationReport:
+        """
+        Move a tenant from a pageserver to another
+        :param switch: Points the computes of the tenant at the target
+        :return: How the migration went
+        :raises MigrationError: if the control plane does not know the tenant
+        """
+        started = time.monotonic()
+        before = await self.read_latency(source_url, tenant_id)
+        location = await self.client.get_location_config(source_url, tenant_id)
+        if location is not None and location.get("mode", "").startswith("Attached"):
+            # Still serving reads, with the generation it has, but no longer deleting the layers the target uses.
+            await self.client.location_config(source_url, tenant_id, "AttachedStale",
+                                              generation=location.get("generation"))
+        generation = await self.client.attach_hook(control_plane_url, tenant_id, target)
+        if generation is None:
+            raise MigrationError(f"Tenant {tenant_id} is not known to the control plane")
+        report = MigrationReport(source=source, target=target, generation=generation)
+        await self.client.location_config(target_url, tenant_id, "AttachedMulti", generation=generation)
+        report.warmed_up = await self.warm_up(source_url, target_url, tenant_id)
+        if not report.warmed_up:
+            self._logger.warning(f"Tenant {tenant_id} did not catch up on pageserver {target} within "
+                                 f"{self.warmup_timeout_seconds}s, switching the computes anyway.")
+        report.read_latency_before = self.mean(before, await self.read_latency(source_url, tenant_id))
+        after = await self.read_latency(target_url, tenant_id)
+        await switch()
+        await asyncio.sleep(self.settle_seconds)
+        report.read_latency_after = self.mean(after, await self.read_latency(target_url, tenant_id))
+        await self.client.location_config(source_url, tenant_id, "Detached")
+        await self.client.location_config(target_url, tenant_id, "AttachedSingle", generation=generation)
+        report.duration_seconds = time.monotonic() - started
+        metrics.TENANT_MIGRATION_SECONDS.labels("success" if report.warmed_up else "cold").observe(
+            report.duration_seconds)
+        for phase, latency in (("before", report.read_latency_before), ("after", report.read_latency_after)):
+            if latency is not None:
+                metrics.TENANT_MIGRATION_READ_LATENCY.labels(phase).observe(latency)
+        return report
@@ -1,10 +1,55 @@
+import hashlib
+import math
+from typing import List, Optional
+
 import kopf
 import kubernetes
-from kubernetes.client import V1ResourceRequirements, ApiException
+import kubernetes_asyncio
+from kubernetes.client import V1ResourceRequirements
+
+from resources import apply, metrics
+from resources.common import parse_cpu, parse_memory, resource_quantity
+
+# The pages of the pageserver page cache.
+PAGE_SIZE = 8192
+# Set on the pod template, a change of the pageserver.toml restarts the pageservers.
+CONFIG_HASH_ANNOTATION = "neon.tech/pageserver-config-hash"
+
+
+def pageserver_tuning(resources: V1ResourceRequirements = None, tuning: Optional[dict] = None) -> dict:
+    """
+    The tuning of the pageservers, each setting of the pageServer.tuning section of the NeonDeployment or derived
+    from the cpu and memory limits of the pageserver pods
+    :param resources: resource requirements for the pageserver
+    :param tuning: the pageServer.tuning section, overriding the derived settings
+    :return: the settings by their camel case name
+    """
+    cpu = parse_cpu(resource_quantity(resources, "cpu"))
+    memory = parse_memory(resource_quantity(resources, "memory"))
+    cpus = max(math.ceil(cpu), 1)
+    derived = {
+        # The page cache of the materialized pages, next to the OS cache of the layer files.
+        "pageCacheSize": max(int(memory * 0.2), 8 * 2 ** 20),
+        # Every open layer file is a descriptor, upstream defaults to 100.
+        "maxFileDescriptors": min(max(int(memory / 2 ** 30 * 1000), 100), 100000),
+        # The tokio worker threads, background tasks such as compaction and gc running on 3/4 of them at most:
+        # otherwise sized by the cores of the node, not the cpu limit of the pod.
+        "workerThreads": max(cpus, 2),
+        "concurrentTenantWarmup": min(cpus * 2, 32),
+        # Compacting less often on small pods, which have less cpu to spare for it.
+        "compactionPeriod": "20s" if cpu >= 1 else "60s",
+        "compactionThreshold": 10 if cpu >= 1 else 20,
+        "gcPeriod": "1h",
+        "gcHorizon": 64 * 2 ** 20,
+    }
+    overrides = {key: value for key, value in (tuning or {}).items() if value is not None}
+    if "pageCacheSize" in overrides:
+        overrides["pageCacheSize"] = parse_memory(overrides["pageCacheSize"])
+    return {**derived, **overrides}
 
 
-def deploy_pageserver(
-        kube_client: kubernetes.client.ApiClient,
+async def apply_pageserver(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
         resources: V1ResourceRequirements,
         remote_storage_endpoint: str,
@@ -12,98 +57,70 @@ def deploy_pageserver(
         remote_storage_bucket_region: str,
         remote_storage_prefix_in_bucket: str,
         image_pull_policy: str = "IfNotPresent",
-        image: str = "neondatabase/neon"):
+        image: str = "neondatabase/neon",
+        tuning: Optional[dict] = None,
+        replicas: int = 1,
+        desired_state: apply.DesiredState = None,
+) -> List[apply.ApplyResult]:
     """
-    Deploys the pageserver resources to the kubernetes cluster
+    Creates or updates the pageserver resources in the kubernetes cluster with server-side apply, the pageservers
+    restarting only when their pageserver.toml changes
     :param kube_client: kubernetes api client
     :param namespace: namespace to deploy to
     :param resources: resource requirements for the pageserver
-    :param image_pull_policy: image pull policy for the pageserver container image (default: IfNotPresent)
-    :param image: pageserver container image (default: neondatabase/neon)
     :param remote_storage_endpoint: endpoint for the remote storage
     :param remote_storage_bucket_name: name of the remote storage bucket
     :param remote_storage_bucket_region: region of the remote storage bucket
     :param remote_storage_prefix_in_bucket: prefix in the remote storage bucket
-    :return: if successful, returns None, otherwise returns an ApiException
-    """
-    deployment = pageserver_statefulset(namespace, resources, image_pull_policy, image)
-    kopf.adopt(deployment)
-    service = pageserver_service(namespace)
-    kopf.adopt(service)
-    configmap = pageserver_configmap(namespace, remote_storage_endpoint, remote_storage_bucket_name,
-                                     remote_storage_bucket_region, remote_storage_prefix_in_bucket)
-    kopf.adopt(configmap)
-
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.create_namespaced_stateful_set(namespace=namespace, body=deployment)
-        core_client.create_namespaced_service(namespace=namespace, body=service)
-        core_client.create_namespaced_config_map(namespace=namespace, body=configmap)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
-
-
-def update_pageserver(
-        kube_client: kubernetes.client.ApiClient,
-        namespace: str,
-        resources: V1ResourceRequirements,
-        image_pull_policy: str = "IfNotPresent",
-        image: str = "neondatabase/neon",
-        replicas: int = 3, ):
-    """
-    Updates the pageserver resources in the kubernetes cluster
-    :param kube_client: kubernetes api client
-    :param namespace: namespace to update in
-    :param resources: resource requirements for the pageserver
     :param image_pull_policy: image pull policy for the pageserver container image (default: IfNotPresent)
     :param image: pageserver container image (default: neondatabase/neon)
-    :param replicas: number of replicas to update to (default: 3)
-    :return: if successful, returns None, otherwise returns an ApiException
+    :param tuning: the pageServer.tuning section of the NeonDeployment, see pageserver_tuning
+    :param replicas: number of pageservers, each one a node the tenants are placed on
+    :param desired_state: hashes of the objects applied so far, objects whose desired state is unchanged are skipped
+    :return: the result of each object
+    :raises ApplyError: if any object could not be applied
     """
-    deployment = pageserver_statefulset(namespace, resources, image_pull_policy, image)
+    settings = pageserver_tuning(resources, tuning)
+    configmap = pageserver_configmap(namespace, remote_storage_endpoint, remote_storage_bucket_name,
+                                     remote_storage_bucket_region, remote_storage_prefix_in_bucket, settings)
+    kopf.adopt(configmap)
+    config_hash = hashlib.sha256(configmap.data["pageserver.toml"].encode()).hexdigest()[:16]
+    deployment = pageserver_statefulset(namespace, resources, image_pull_policy, image, replicas=replicas,
+                                        config_hash=config_hash, worker_threads=settings["workerThreads"])
     kopf.adopt(deployment)
     service = pageserver_service(namespace)
     kopf.adopt(service)
-    configmap = pageserver_configmap(namespace)
-    kopf.adopt(configmap)
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.patch_namespaced_stateful_set(namespace=namespace, name="pageserver", body=deployment)
-        core_client.patch_namespaced_service(namespace=namespace, name="pageserver", body=service)
-        core_client.patch_namespaced_config_map(namespace=namespace, name="pageserver", body=configmap)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [configmap, deployment, service], desired_state)
 
 
-def delete_pageserver(
-        kube_client: kubernetes.client.ApiClient,
+async def delete_pageserver(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
+) -> List[apply.ApplyResult]:
     """
     Deletes the pageserver resources from the kubernetes cluster
     :param kube_client: kubernetes api client
     :param namespace: namespace to delete from
-    :return: if successful, returns None, otherwise returns an ApiException
+    :return: the result of each object, objects which were already gone are reported as absent
+    :raises ApplyError: if any object could not be deleted
     """
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.delete_namespaced_stateful_set(namespace=namespace, name="pageserver")
-        core_client.delete_namespaced_service(namespace=namespace, name="pageserver")
-        core_client.delete_namespaced_config_map(namespace=namespace, name="pageserver")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.delete(kube_client, namespace, [
+        ("StatefulSet", "pageserver"),
+        ("Service", "pageserver"),
+        ("ConfigMap", "pageserver"),
+    ])
 
 
+@metrics.builder
 def pageserver_statefulset(namespace: str,
                            resources: V1ResourceRequirements,
                            image_pull_policy: str,
                            image: str,
                            replicas: int = 1,
-                           storage_capacity: str = "1Gi") -> kubernetes.client.V1StatefulSet:
+                           storage_capacity: str = "1Gi",
+                           config_hash: Optional[str] = None,
+                           worker_threads: Optional[int] = None) -> kubernetes.client.V1StatefulSet:
     """
     Creates a kubernetes statefulset for the pageserver
     :param namespace: namespace to deploy to
@@ -112,8 +129,13 @@ def pageserver_statefulset(namespace: str,
     :param image: default pageserver container image (default: neondatabase/neon)
     :param replicas: number of replicas to deploy (default: 1)
     :param storage_capacity: storage capacity for the pageserver (default: 1Gi)
+    :param config_hash: digest of the pageserver.toml, rolling the pods out when it changes
+    :param worker_threads: tokio worker threads of the pageserver, the cores of the node when not set
     :return: returns a kubernetes statefulset object
     """
+    tuning_env = []
+    if worker_threads is not None:
+        tuning_env.append(kubernetes.client.V1EnvVar(name="TOKIO_WORKER_THREADS", value=str(worker_threads)))
 
     statefulset = kubernetes.client.V1StatefulSet(
         api_version="apps/v1",
@@ -132,6 +154,7 @@ def pageserver_statefulset(namespace: str,
             template=kubernetes.client.V1PodTemplateSpec(
                 metadata=kubernetes.client.V1ObjectMeta(
                     labels={"app": "pageserver"},
+                    annotations={CONFIG_HASH_ANNOTATION: config_hash} if config_hash else None,
                 ),
                 spec=kubernetes.client.V1PodSpec(
                     containers=[kubernetes.client.V1Container(
@@ -190,6 +213,7 @@ def pageserver_statefulset(namespace: str,
                                     ),
                                 ),
                             ),
+                            *tuning_env,
                         ],
                         volume_mounts=[
                             kubernetes.client.V1VolumeMount(
@@ -248,7 +272,7 @@ def pageserver_statefulset(namespace: str,
                     ),
                     spec=kubernetes.client.V1PersistentVolumeClaimSpec(
                         access_modes=["ReadWriteOnce"],
-                        resources=kubernetes.client.V1ResourceRequirements(
+                        resources=kubernetes.client.V1VolumeResourceRequirements(
                             requests={"storage": storage_capacity},
                         ),
                     ),
@@ -257,14 +281,16 @@ def pageserver_statefulset(namespace: str,
         ),
     )
 
+    apply.desired_hash(statefulset)
     return statefulset
 
 
+@metrics.builder
 def pageserver_service(
         namespace: str,
 ) -> kubernetes.client.V1Service:
     """
-    Creates a kubernetes service for the pageserver
+    Creates the headless kubernetes service governing the pageserver StatefulSet
     :param namespace: namespace to deploy to
     :return: returns a kubernetes service object
     """
@@ -274,7 +300,10 @@ def pageserver_service(
             kubernetes.client.V1ServicePort(port=9898, name="http", target_port=9898),
             kubernetes.client.V1ServicePort(port=6400, name="pg", target_port=6400),
         ],
-        type="ClusterIP"
+        # Headless, the governing service of the StatefulSet: the operator and the computes reach each pageserver by
+        # the dns name of its pod, unready pods included so that the operator can tell a dead one from a slow one.
+        cluster_ip="None",
+        publish_not_ready_addresses=True,
     )
 
     service = kubernetes.client.V1Service(
@@ -288,15 +317,18 @@ def pageserver_service(
         spec=spec,
     )
 
+    apply.desired_hash(service)
     return service
 
 
+@metrics.builder
 def pageserver_configmap(
         namespace: str,
         remote_storage_endpoint: str = "http://minio:9000",
         remote_storage_bucket_name: str = "neon",
         remote_storage_bucket_region: str = "eu-north-1",
         remote_storage_prefix_in_bucket: str = "/pageserver/",
+        tuning: Optional[dict] = None,
 ) -> kubernetes.client.V1ConfigMap:
     """
     Creates a kubernetes configmap for the pageserver
@@ -305,8 +337,11 @@ def pageserver_configmap(
     :param remote_storage_bucket_name: name of the remote storage bucket
     :param remote_storage_bucket_region: region of the remote storage bucket
     :param remote_storage_prefix_in_bucket: prefix in the remote storage bucket
+    :param tuning: the settings of pageserver_tuning, the derived ones when not set
     :return: returns a kubernetes configmap object
     """
+    if tuning is None:
+        tuning = pageserver_tuning()
     configmap = kubernetes.client.V1ConfigMap(
         api_version="v1",
         kind="ConfigMap",
@@ -323,6 +358,15 @@ control_plane_api_token = ''
 http_auth_type = 'Trust'
 pg_auth_type = 'Trust'
 auth_validation_public_key_path = '/etc/pageserver/auth_public_key.pem'
+page_cache_size = {max(tuning["pageCacheSize"] // PAGE_SIZE, 1)}
+max_file_descriptors = {tuning["maxFileDescriptors"]}
+concurrent_tenant_warmup = {tuning["concurrentTenantWarmup"]}
+
+[tenant_config]
+compaction_period = '{tuning["compactionPeriod"]}'
+compaction_threshold = {tuning["compactionThreshold"]}
+gc_period = '{tuning["gcPeriod"]}'
+gc_horizon = {tuning["gcHorizon"]}
 
 [remote_storage]
 endpoint='{remote_storage_endpoint}'
@@ -332,4 +376,5 @@ prefix_in_bucket='{remote_storage_prefix_in_bucket}'
     """},
     )
 
+    apply.desired_hash(configmap)
     return configmap
@@ -0,0 +1,266 @@
+# Client of the pageserver management http api, and of the control plane hook issuing the generations of the tenants
+# attached to a pageserver, with pooled keep-alive connections per server.
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from resources import metrics
+
+# The stripe of a sharded tenant in pages of 8KiB: consecutive pages of a relation stay on the same shard up to it.
+DEFAULT_STRIPE_SIZE = 32768
+
+
+def tenant_shard_id(tenant_id: str, number: int, count: int) -> str:
+    """
+    The id of a shard of a tenant as the pageserver names it, the tenant id itself for an unsharded tenant
+    """
+    if count <= 1:
+        return tenant_id
+    return f"{tenant_id}-{number:02x}{count:02x}"
+
+
+def tenant_shard_ids(tenant_id: str, count: int) -> List[str]:
+    """
+    The ids of the shards of a tenant, by shard number
+    """
+    return [tenant_shard_id(tenant_id, number, count) for number in range(max(count, 1))]
+
+
+def tenant_of(shard_id: str) -> str:
+    """
+    The tenant id of a shard id
+    """
+    return shard_id.split("-", 1)[0]
+
+
+def shard_number_of(shard_id: str) -> int:
+    """
+    The shard number of a shard id, 0 for an unsharded tenant
+    """
+    return int(shard_id.split("-", 1)[1][:2], 16) if "-" in shard_id else 0
+
+
+class PageserverApiError(Exception):
+    """
+    Raised when the pageserver answers a management call with an error.
+
+    Attributes:
+        status (int): The http status of the response.
+        message (str): The error message returned by the pageserver.
+    """
+
+    def __init__(self, status: int, message: str):
+        self.status = status
+        self.message = message
+        super().__init__(f"{status}: {message}")
+
+
+@dataclass
+class TimelineInfo:
+    """
+    The part of the pageserver's timeline description used by the operator.
+
+    Attributes:
+        tenant_id (str): The tenant of the timeline.
+        timeline_id (str): The id of the timeline.
+        pg_version (Optional[int]): The postgres major version of the timeline.
+        last_record_lsn (Optional[str]): The last WAL record ingested by the pageserver.
+    """
+    tenant_id: str
+    timeline_id: str
+    pg_version: Optional[int] = None
+    last_record_lsn: Optional[str] = None
+
+
+class PageserverClient:
+    """
+    Keeps one pool of keep-alive connections per pageserver and caps the number of requests in flight, so that
+    many handlers talking to the same pageserver reuse connections instead of opening one per call.
+
+    Attributes:
+        pool_size (int): The maximum number of connections per pageserver.
+        timeout (aiohttp.ClientTimeout): The timeouts applied to every request.
+        tenant_config (dict): The tenant config every location is set with, under the config of the call.
+    """
+
+    def __init__(self, pool_size: int = 16, max_concurrency: int = 64, total_timeout: float = 30.0,
+                 connect_timeout: float = 5.0, tenant_config: Optional[dict] = None):
+        self.pool_size = pool_size
+        self.tenant_config = tenant_config or {}
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    def _session(self, base_url: str) -> aiohttp.ClientSession:
+        session = self._sessions.get(base_url)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            session = aiohttp.ClientSession(base_url=base_url, connector=connector, timeout=self.timeout)
+            self._sessions[base_url] = session
+        return session
+
+    async def close(self):
+        sessions, self._sessions = self._sessions, {}
+        await asyncio.gather(*(session.close() for session in sessions.values()))
+
+    async def _request(self, base_url: str, method: str, path: str, endpoint: str, request: Optional[dict] = None,
+                       allowed: tuple = ()):
+        """
+        Send a request over the pooled connections of a pageserver
+        :param endpoint: The path template, used as the metrics label
+        :param allowed: Error statuses which are an expected outcome rather than a failure
+        :return: The decoded json body, None for an empty one
+        """
+        started = time.perf_counter()
+        status = "error"
+        try:
+            async with self._semaphore:
+                async with self._session(base_url).request(method, path, json=request) as response:
+                    status = response.status
+                    body = await response.read()
+        finally:
+            metrics.PAGESERVER_SECONDS.labels(method, endpoint, status).observe(time.perf_counter() - started)
+        if status >= 400 and status not in allowed:
+            raise PageserverApiError(status, body.decode("utf-8", errors="replace"))
+        if not body or status in allowed:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return body.decode("utf-8")
+
+    async def create_tenant(self, base_url: str, tenant_id: str, config: Optional[dict] = None) -> str:
+        """
+        Create a tenant, succeeding if it already exists so that retried handlers stay idempotent
+        :return: The id of the tenant
+        """
+        await self._request(base_url, "POST", "/v1/tenant", "/v1/tenant",
+                            request={"new_tenant_id": tenant_id, **(config or {})}, allowed=(409,))
+        return tenant_id
+
+    async def location_config(self, base_url: str, tenant_id: str, mode: str, generation: Optional[int] = None,
+                              config: Optional[dict] = None, shard_count: int = 0,
+                              stripe_size: int = DEFAULT_STRIPE_SIZE):
+        """
+        Set the location of a tenant, or of a shard of a tenant, on a pageserver, creating it if it does not exist
+        yet. Setting the same location again is a no-op, so that retried handlers stay idempotent
+        :param tenant_id: The tenant id, or the shard id of a shard
+        :param mode: AttachedSingle, AttachedMulti, AttachedStale, Secondary or Detached. A secondary location is
+            warm: it downloads the layers of the heatmap of the attached location
+        :param generation: The generation the control plane issued for the attachment, for the attached modes
+        :param shard_count: The shards of the tenant, 0 for an unsharded tenant
+        :param stripe_size: The stripe size of a sharded tenant, in pages
+        """
+        await self._request(base_url, "PUT", f"/v1/tenant/{tenant_id}/location_config",
+                            "/v1/tenant/{tenant_id}/location_config",
+                            request={"mode": mode, "generation": generation,
+                                     "secondary_conf": {"warm": True} if mode == "Secondary" else None,
+                                     "shard_number": shard_number_of(tenant_id), "shard_count": shard_count,
+                                     "shard_stripe_size": stripe_size,
+                                     "tenant_conf": {**self.tenant_config, **(config or {})}})
+
+    async def get_location_config(self, base_url: str, tenant_id: str) -> Optional[dict]:
+        """
+        The location of a tenant on a pageserver, with its mode and generation, None if it has no location there
+        """
+        return await self._request(base_url, "GET", f"/v1/location_config/{tenant_id}",
+                                   "/v1/location_config/{tenant_id}", allowed=(404,))
+
+    async def list_timelines(self, base_url: str, tenant_id: str) -> List[TimelineInfo]:
+        """
+        The timelines of a tenant attached to a pageserver
+        """
+        timelines = await self._request(base_url, "GET", f"/v1/tenant/{tenant_id}/timeline",
+                                        "/v1/tenant/{tenant_id}/timeline") or []
+        return [TimelineInfo(tenant_id=info.get("tenant_id", tenant_id), timeline_id=info["timeline_id"],
+                             pg_version=info.get("pg_version"), last_record_lsn=info.get("last_record_lsn"))
+                for info in timelines]
+
+    async def heatmap_upload(self, base_url: str, tenant_id: str):
+        """
+        Upload the heatmap of an attached tenant now, rather than at its next heatmap period
+        """
+        await self._request(base_url, "POST", f"/v1/tenant/{tenant_id}/heatmap_upload",
+                            "/v1/tenant/{tenant_id}/heatmap_upload")
+
+    async def secondary_download(self, base_url: str, tenant_id: str):
+        """
+        Start downloading the layers of the heatmap to a secondary location, without waiting for the download
+        """
+        await self._request(base_url, "POST", f"/v1/tenant/{tenant_id}/secondary/download?wait_ms=0",
+                            "/v1/tenant/{tenant_id}/secondary/download")
+
+    async def healthy(self, base_url: str) -> bool:
+        """
+        Whether a pageserver answers its status endpoint
+        """
+        try:
+            await self._request(base_url, "GET", "/v1/status", "/v1/status")
+        except (PageserverApiError, aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+        return True
+
+    async def list_tenants(self, base_url: str) -> List[dict]:
+        """
+        The tenants attached to a pageserver
+        """
+        return await self._request(base_url, "GET", "/v1/tenant", "/v1/tenant") or []
+
+    async def metrics(self, base_url: str) -> str:
+        """
+        The prometheus metrics of a pageserver, in the text exposition format
+        """
+        return await self._request(base_url, "GET", "/metrics", "/metrics") or ""
+
+    async def attach_hook(self, base_url: str, tenant_id: str, node_id: Optional[int]) -> Optional[int]:
+        """
+        Attach a tenant to a pageserver through the control plane, or detach it when no pageserver is given
+        :param base_url: The control plane api
+        :return: The generation issued for the tenant, None if the control plane does not know the tenant yet
+        """
+        response = await self._request(base_url, "POST", "/attach-hook", "/attach-hook",
+                                       request={"tenant_id": tenant_id, "node_id": node_id}, allowed=(404,))
+        return int(response["gen"]) if response is not None else None
+
+    async def set_tenant_config(self, base_url: str, tenant_id: str, config: Optional[dict] = None):
+        await self._request(base_url, "PUT", "/v1/tenant/config", "/v1/tenant/config",
+                            request={"tenant_id": tenant_id, **self.tenant_config, **(config or {})})
+
+    async def delete_tenant(self, base_url: str, tenant_id: str):
+        """
+        Delete a tenant, succeeding if it is already gone
+        """
+        await self._request(base_url, "DELETE", f"/v1/tenant/{tenant_id}", "/v1/tenant/{tenant_id}",
+                            allowed=(404,))
+
+    async def create_timeline(self, base_url: str, tenant_id: str, timeline_id: str, pg_version: int,
+                              ancestor_timeline_id: Optional[str] = None,
+                              ancestor_start_lsn: Optional[str] = None) -> TimelineInfo:
+        """
+        Create a timeline, or a branch of the ancestor timeline when one is given
+        :return: The created timeline, or the requested one if it already existed
+        """
+        request = {"new_timeline_id": timeline_id, "pg_version": pg_version}
+        if ancestor_timeline_id is not None:
+            request["ancestor_timeline_id"] = ancestor_timeline_id
+        if ancestor_start_lsn is not None:
+            request["ancestor_start_lsn"] = ancestor_start_lsn
+        info = await self._request(base_url, "POST", f"/v1/tenant/{tenant_id}/timeline",
+                                   "/v1/tenant/{tenant_id}/timeline", request=request, allowed=(409,))
+        if not isinstance(info, dict):
+            return TimelineInfo(tenant_id=tenant_id, timeline_id=timeline_id, pg_version=pg_version)
+        return TimelineInfo(tenant_id=info.get("tenant_id", tenant_id),
+                            timeline_id=info.get("timeline_id", timeline_id),
+                            pg_version=info.get("pg_version", pg_version),
+                            last_record_lsn=info.get("last_record_lsn"))
+
+    async def delete_timeline(self, base_url: str, tenant_id: str, timeline_id: str):
+        """
+        Delete a timeline, succeeding if it is already gone
+        """
+        await self._request(base_url, "DELETE", f"/v1/tenant/{tenant_id}/timeline/{timeline_id}",
+                            "/v1/tenant/{tenant_id}/timeline/{timeline_id}", allowed=(404,))
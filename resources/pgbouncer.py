@@ -1,58 +1,41 @@
+from typing import List
+
 import kopf
 import kubernetes
-from kubernetes.client import V1ResourceRequirements, ApiException
+import kubernetes_asyncio
+from kubernetes.client import V1ResourceRequirements
+
+from resources import apply, metrics
 
 
-def deploy_pgbouncer(
+async def apply_pgbouncer(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
+        resources: V1ResourceRequirements = None,
+) -> List[apply.ApplyResult]:
     """
-    Deploy the pgbouncer proxy to the cluster
-    :return:
+    Create or update the pgbouncer proxy in the cluster with server-side apply
+    :param kube_client: The shared kubernetes api client
+    :param namespace: The namespace to deploy to
+    :param resources: Resource requirements for the pgbouncer container
+    :return: The result of each applied object
     """
-    deployment = pgbouncer_deployment()
-    service = pgbouncer_service()
-    kopf.adopt(deployment)
-    kopf.adopt(service)
-
-    apps_client = kubernetes.client.AppsV1Api()
-    core_client = kubernetes.client.CoreV1Api()
-    try:
-        apps_client.create_namespaced_deployment(namespace=namespace, body=deployment)
-        core_client.create_namespaced_service(namespace=namespace, body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
-
-
-def update_pgbouncer(
-        namespace: str,
-):
-    deployment = pgbouncer_deployment()
-    service = pgbouncer_service()
+    deployment = pgbouncer_deployment(namespace, resources)
+    service = pgbouncer_service(namespace)
     kopf.adopt(deployment)
     kopf.adopt(service)
 
-    apps_client = kubernetes.client.AppsV1Api()
-    core_client = kubernetes.client.CoreV1Api()
-    try:
-        apps_client.patch_namespaced_deployment(namespace=namespace, name="pgbouncer", body=deployment)
-        core_client.patch_namespaced_service(namespace=namespace, name="pgbouncer", body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [deployment, service])
 
 
-def delete_pgbouncer(
+async def delete_pgbouncer(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    apps_client = kubernetes.client.AppsV1Api()
-    core_client = kubernetes.client.CoreV1Api()
-    try:
-        apps_client.delete_namespaced_deployment(namespace=namespace, name="pgbouncer")
-        core_client.delete_namespaced_service(namespace=namespace, name="pgbouncer")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [("Deployment", "pgbouncer"), ("Service", "pgbouncer")])
 
 
+@metrics.builder
 def pgbouncer_deployment(
         namespace: str,
         resources: V1ResourceRequirements,
@@ -135,6 +118,7 @@ def pgbouncer_deployment(
     )
 
 
+@metrics.builder
 def pgbouncer_configmap(
         namespace: str,
 ) -> kubernetes.client.V1ConfigMap:
@@ -165,6 +149,7 @@ def pgbouncer_configmap(
     )
 
 
+@metrics.builder
 def pgbouncer_service(
         namespace: str,
 ) -> kubernetes.client.V1Service:
@@ -0,0 +1,303 @@
+# Placement of the tenants on the pageservers of a namespace: every ready pageserver is scored by the tenants it
+# holds, their resident size and its cpu usage, read from its http api and its metrics. The least loaded one which is
+# not hot gets the new tenants, and a tenant is moved off the most loaded one when it is too far ahead of the least
+# loaded one. The shards of a sharded tenant are each placed on a different pageserver.
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+
+import aiohttp
+
+from resources.common import parse_cpu
+from resources.pageserver_api import PageserverApiError, PageserverClient
+
+RESIDENT_SIZE_METRIC = "pageserver_resident_physical_size"
+CPU_METRIC = "process_cpu_seconds_total"
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+@dataclass(frozen=True)
+class PageserverPod:
+    """
+    A pod of the pageserver StatefulSet, from the index of the pageserver pods.
+
+    Attributes:
+        node_id (int): The index of the pod, which is the node id of its pageserver.
+        name (str): The name of the pod.
+        ready (bool): Whether the pod is ready.
+        cpu (float): The cpu limit of the pageserver container in cores.
+    """
+    node_id: int
+    name: str
+    ready: bool
+    cpu: float
+
+
+def pageserver_pod_of(name: str, labels: dict, spec: dict, status: dict) -> Optional[PageserverPod]:
+    """
+    The pageserver of a pod, None for the pods which are not part of the StatefulSet
+    """
+    index = labels.get("apps.kubernetes.io/pod-index") or name.rsplit("-", 1)[-1]
+    if not str(index).isdigit():
+        return None
+    ready = any(condition.get("type") == "Ready" and condition.get("status") == "True"
+                for condition in status.get("conditions") or [])
+    limits = {}
+    for container in spec.get("containers") or []:
+        if container.get("name") == "pageserver":
+            limits = (container.get("resources") or {}).get("limits") or {}
+    return PageserverPod(node_id=int(index), name=name, ready=ready, cpu=parse_cpu(limits.get("cpu")))
+
+
+@dataclass(frozen=True)
+class PlacedTenant:
+    """
+    A NeonTenant placed on a pageserver, from the index of the NeonTenants.
+
+    Attributes:
+        name (str): The name of the NeonTenant.
+        tenant_id (str): The pageserver tenant id.
+        node_id (int): The pageserver the tenant is on, its status.pageserver.
+        target (Optional[int]): The pageserver the tenant is asked to move to, its spec.pageserver.
+    """
+    name: str
+    tenant_id: str
+    node_id: int
+    target: Optional[int] = None
+
+    @property
+    def migrating(self) -> bool:
+        return self.target is not None and self.target != self.node_id
+
+
+def samples(text: str) -> Iterator[Tuple[str, Dict[str, str], float]]:
+    """
+    The samples of a prometheus text exposition: their metric name, labels and value
+    """
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        # name{labels} value [timestamp]
+        name, _, rest = line.partition("{")
+        labels = {}
+        if rest:
+            rest, _, value = rest.rpartition("}")
+            labels = dict(_LABEL.findall(rest))
+        else:
+            name, _, value = line.partition(" ")
+        try:
+            yield name, labels, float(value.split()[0])
+        except (IndexError, ValueError):
+            continue
+
+
+def parse_metrics(text: str, names: Tuple[str, ...], labels: Optional[Dict[str, str]] = None) -> Dict[str, float]:
+    """
+    The sum of the samples of some metrics of a prometheus text exposition, over all their labels
+    :param labels: The labels a sample must have to be counted
+    """
+    values = dict.fromkeys(names, 0.0)
+    for name, sample_labels, value in samples(text):
+        if name in values and all(sample_labels.get(key) == wanted for key, wanted in (labels or {}).items()):
+            values[name] += value
+    return values
+
+
+def metric_by_label(text: str, name: str, label: str) -> Dict[str, float]:
+    """
+    The sum of the samples of a metric by the value of one of its labels
+    """
+    values: Dict[str, float] = {}
+    for sample_name, labels, value in samples(text):
+        if sample_name == name and label in labels:
+            values[labels[label]] = values.get(labels[label], 0.0) + value
+    return values
+
+
+@dataclass
+class PageserverLoad:
+    """
+    The load of a pageserver when it was last scraped, its tenant count including the tenants placed since.
+
+    Attributes:
+        node_id (int): The node id of the pageserver.
+        tenants (int): The tenants attached to the pageserver.
+        resident_size (float): The bytes of the layers of its tenants on its local disk.
+        cpu (float): The cpu it used since the previous scrape, as a share of its cpu limit.
+        scraped_at (float): The monotonic time of the scrape.
+        tenant_sizes (Dict[str, float]): The resident size of each of its tenants.
+    """
+    node_id: int
+    tenants: int
+    resident_size: float
+    cpu: float
+    scraped_at: float
+    tenant_sizes: Dict[str, float] = field(default_factory=dict)
+
+
+class Placement:
+    """
+    Picks the pageserver each new tenant of a namespace is created on.
+
+    The pageservers are scored by their share of the tenant count and of the resident size of the most loaded
+    pageserver, plus their cpu usage, and the lowest score wins. A pageserver using more than hot_cpu of its cpu
+    limit, or holding max_tenants, is hot and gets no new tenants while another one can take them. Loads are scraped
+    at most every ttl_seconds, the placements of a namespace being serialized so that a burst of new tenants spreads
+    over the pageservers instead of piling on the one which was the least loaded at the last scrape.
+
+    Attributes:
+        client (PageserverClient): The pooled client of the pageserver http api.
+        node_url (str): The http api of a pageserver, formatted with its namespace and node_id.
+        hot_cpu (float): The share of its cpu limit above which a pageserver is hot.
+        max_tenants (int): The tenants above which a pageserver is hot, 0 for no limit.
+        ttl_seconds (float): How long a scraped load is used for.
+    """
+
+    def __init__(self, client: PageserverClient, node_url: str, hot_cpu: float = 0.8, max_tenants: int = 0,
+                 ttl_seconds: float = 10):
+        self.client = client
+        self.node_url = node_url
+        self.hot_cpu = hot_cpu
+        self.max_tenants = max_tenants
+        self.ttl_seconds = ttl_seconds
+        self._loads: Dict[Tuple[str, int], PageserverLoad] = {}
+        # The cpu seconds of each pageserver at its previous scrape, its usage being the rate since.
+        self._cpu_seconds: Dict[Tuple[str, int], Tuple[float, float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._logger = logging.getLogger(__name__)
+
+    def url(self, namespace: str, node_id: int) -> str:
+        return self.node_url.format(namespace=namespace, node_id=node_id)
+
+    async def scrape(self, namespace: str, pod: PageserverPod) -> Optional[PageserverLoad]:
+        """
+        The current load of a pageserver, None if it did not answer
+        """
+        url = self.url(namespace, pod.node_id)
+        try:
+            tenants, text = await asyncio.gather(self.client.list_tenants(url), self.client.metrics(url))
+        except (PageserverApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.warning(f"Reading the load of the pageserver {namespace}/{pod.name} failed: {e}")
+            return None
+        samples = parse_metrics(text, (RESIDENT_SIZE_METRIC, CPU_METRIC))
+        now = time.monotonic()
+        key = (namespace, pod.node_id)
+        cpu = 0.0
+        previous = self._cpu_seconds.get(key)
+        # A restarted pageserver starts counting again.
+        if previous is not None and now > previous[0] and samples[CPU_METRIC] >= previous[1]:
+            cpu = (samples[CPU_METRIC] - previous[1]) / (now - previous[0]) / max(pod.cpu, 0.001)
+        self._cpu_seconds[key] = (now, samples[CPU_METRIC])
+        return PageserverLoad(node_id=pod.node_id, tenants=len(tenants), resident_size=samples[RESIDENT_SIZE_METRIC],
+                              cpu=cpu, scraped_at=now,
+                              tenant_sizes=metric_by_label(text, RESIDENT_SIZE_METRIC, "tenant_id"))
+
+    async def loads(self, namespace: str, pods: List[PageserverPod]) -> List[PageserverLoad]:
+        """
+        The loads of the ready pageservers which answered, scraping those older than ttl_seconds
+        """
+        now = time.monotonic()
+        ready = [pod for pod in pods if pod.ready]
+        stale = [pod for pod in ready if (namespace, pod.node_id) not in self._loads
+                 or now - self._loads[(namespace, pod.node_id)].scraped_at >= self.ttl_seconds]
+        for pod, load in zip(stale, await asyncio.gather(*(self.scrape(namespace, pod) for pod in stale))):
+            if load is None:
+                self._loads.pop((namespace, pod.node_id), None)
+            else:
+                self._loads[(namespace, pod.node_id)] = load
+        return [self._loads[(namespace, pod.node_id)] for pod in ready if (namespace, pod.node_id) in self._loads]
+
+    def hot(self, load: PageserverLoad) -> bool:
+        return load.cpu >= self.hot_cpu or 0 < self.max_tenants <= load.tenants
+
+    @staticmethod
+    def scores(loads: List[PageserverLoad]) -> Dict[int, float]:
+        """
+        The score of each pageserver by node id: its share of the most tenants and of the largest resident size,
+        plus its cpu usage
+        """
+        most_tenants = max(max(load.tenants for load in loads), 1)
+        most_resident = max(max(load.resident_size for load in loads), 1)
+        return {load.node_id: load.tenants / most_tenants + load.resident_size / most_resident + load.cpu
+                for load in loads}
+
+    def choose(self, loads: List[PageserverLoad]) -> PageserverLoad:
+        """
+        The least loaded pageserver which is not hot, the least loaded one when they all are
+        """
+        scores = self.scores(loads)
+        candidates = [load for load in loads if not self.hot(load)] or loads
+        return min(candidates, key=lambda load: (scores[load.node_id], load.node_id))
+
+    async def place(self, namespace: str, pods: List[PageserverPod]) -> int:
+        """
+        Pick the pageserver a new tenant is created on
+        :param pods: The pageserver pods of the namespace
+        :return: The node id of the pageserver
+        :raises PageserverApiError: if no ready pageserver answered, which is transient
+        """
+        return (await self.place_shards(namespace, pods, 1))[0]
+
+    async def place_shards(self, namespace: str, pods: List[PageserverPod], count: int,
+                           exclude: Collection[int] = ()) -> List[int]:
+        """
+        Pick the pageservers the shards of a new tenant are created on, a different one for each shard so that
+        the shards spread the load of the tenant, the least loaded ones first
+        :param pods: The pageserver pods of the namespace
+        :param count: The shards of the tenant
+        :param exclude: The pageservers not to pick, such as the one a secondary location backs up
+        :return: The node id of the pageserver of each shard, by shard number
+        :raises PageserverApiError: if fewer ready pageservers than shards answered, which is transient
+        """
+        lock = self._locks.setdefault(namespace, asyncio.Lock())
+        async with lock:
+            loads = [load for load in await self.loads(namespace, pods) if load.node_id not in exclude]
+            if not loads or len(loads) < count:
+                raise PageserverApiError(503, f"{len(loads)} ready pageservers in {namespace} to place "
+                                              f"{max(count, 1)} shards on")
+            node_ids = []
+            for _ in range(max(count, 1)):
+                load = self.choose([load for load in loads if load.node_id not in node_ids])
+                if self.hot(load):
+                    self._logger.warning(f"Every pageserver of {namespace} is hot, placing on node {load.node_id}.")
+                load.tenants += 1
+                node_ids.append(load.node_id)
+            return node_ids
+
+    async def rebalance(self, namespace: str, pods: List[PageserverPod], tenants: List[PlacedTenant],
+                        skew: float) -> Optional[Tuple[PlacedTenant, int]]:
+        """
+        Pick a tenant to move from the most loaded pageserver to the least loaded one, when the score of the first
+        exceeds the score of the second by more than skew. The tenant moved is the largest one moving less than half
+        of the difference of their resident sizes, the smallest one when they are all larger, so that the move
+        does not just swap the two pageservers. Nothing moves while a tenant of the namespace is migrating
+        :param tenants: The tenants of the namespace
+        :return: The tenant and the node id of its new pageserver, None if the pageservers are balanced
+        """
+        if any(tenant.migrating for tenant in tenants):
+            return None
+        lock = self._locks.setdefault(namespace, asyncio.Lock())
+        async with lock:
+            loads = await self.loads(namespace, pods)
+        if len(loads) < 2:
+            return None
+        scores = self.scores(loads)
+        hottest = max(loads, key=lambda load: (scores[load.node_id], load.node_id))
+        coolest = self.choose(loads)
+        if hottest is coolest or scores[hottest.node_id] - scores[coolest.node_id] <= skew:
+            return None
+        candidates = [tenant for tenant in tenants if tenant.node_id == hottest.node_id]
+        # A pageserver holding a single tenant would only pass its load on.
+        if len(candidates) < 2:
+            return None
+        half_gap = (hottest.resident_size - coolest.resident_size) / 2
+        sizes = {tenant.tenant_id: hottest.tenant_sizes.get(tenant.tenant_id, 0.0) for tenant in candidates}
+        fitting = [tenant for tenant in candidates if sizes[tenant.tenant_id] <= half_gap]
+        if fitting:
+            tenant = max(fitting, key=lambda tenant: (sizes[tenant.tenant_id], tenant.name))
+        else:
+            tenant = min(candidates, key=lambda tenant: (sizes[tenant.tenant_id], tenant.name))
+        return tenant, coolest.node_id
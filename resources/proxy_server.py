@@ -1,61 +1,34 @@
+from typing import List
+
 import kopf
 import kubernetes
-from kubernetes.client import ApiException
-
-
-def deploy_proxy_server(
-        kube_client: kubernetes.client.ApiClient,
-        namespace: str,
-        image: str = "neondatabase/neon",
-        replicas: int = 1,
-):
-    deployment = proxy_server_deployment(namespace, image, replicas)
-    service = proxy_server_service(namespace)
-    kopf.adopt(deployment)
-    kopf.adopt(service)
+import kubernetes_asyncio
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.create_namespaced_deployment(namespace=namespace, body=deployment)
-        core_client.create_namespaced_service(namespace=namespace, body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+from resources import apply, metrics
 
 
-def update_proxy_server(
-        kube_client: kubernetes.client.ApiClient,
+async def apply_proxy_server(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
         image: str = "neondatabase/neon",
         replicas: int = 1,
-):
+) -> List[apply.ApplyResult]:
     deployment = proxy_server_deployment(namespace, image, replicas)
     service = proxy_server_service(namespace)
     kopf.adopt(deployment)
     kopf.adopt(service)
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.patch_namespaced_deployment(namespace=namespace, name="proxy-server", body=deployment)
-        core_client.patch_namespaced_service(namespace=namespace, name="proxy-server", body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [deployment, service])
 
 
-def delete_proxy_server(
-        kube_client: kubernetes.client.ApiClient,
+async def delete_proxy_server(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.delete_namespaced_deployment(namespace=namespace, name="proxy-server")
-        core_client.delete_namespaced_service(namespace=namespace, name="proxy-server")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [("Deployment", "proxy-server"), ("Service", "proxy-server")])
 
 
+@metrics.builder
 def proxy_server_deployment(
         namespace: str,
         image: str,
@@ -132,6 +105,7 @@ def proxy_server_deployment(
     return deployment
 
 
+@metrics.builder
 def proxy_server_service(
         namespace: str,
 ) -> kubernetes.client.V1Service:
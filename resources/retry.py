@@ -0,0 +1,112 @@
+# Retry policy for handlers waiting on other components: transient failures are retried with jittered
+# exponential backoff, permanent ones stop the handler.
+import asyncio
+import contextlib
+import random
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Optional
+
+import aiohttp
+import kopf
+
+from resources import metrics
+
+# Statuses returned while a component is starting, overloaded or briefly unreachable.
+TRANSIENT_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+@dataclass
+class RetryPolicy:
+    """
+    The backoff applied between the attempts of a handler.
+
+    Attributes:
+        base_delay (float): The delay in seconds before the first retry.
+        max_delay (float): The upper bound of the delay in seconds.
+    """
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def delay(self, retry: int) -> float:
+        """
+        The delay before the given retry, doubling each time and jittered so that handlers failing together
+        do not retry together
+        """
+        # The retries of kopf are not bounded, the exponent is: 2 ** 32 seconds is past any max_delay already.
+        ceiling = min(self.max_delay, self.base_delay * 2 ** min(retry, 32))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def transient(self, message: str, retry: int) -> kopf.TemporaryError:
+        """
+        The error making kopf retry the handler after the backoff delay
+        """
+        return kopf.TemporaryError(message, delay=self.delay(retry))
+
+
+def is_transient(exc: BaseException) -> bool:
+    """
+    Classify a failure of a call to another component, connection problems and timeouts are transient
+    """
+    if isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    # Api errors carrying the http status of the response, like PageserverApiError.
+    status = getattr(exc, "status", None)
+    return isinstance(status, int) and status in TRANSIENT_STATUSES
+
+
+class NamespaceLimiter:
+    """
+    Caps how many handlers of the same namespace retry at the same time, so that a component which is down
+    is not hammered by every object of its namespace at once.
+
+    Attributes:
+        limit (int): The number of concurrent retries per namespace.
+    """
+
+    def __init__(self, limit: int = 4):
+        self.limit = limit
+        self._semaphores: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(self.limit))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, namespace: str, retry: int) -> AsyncIterator[None]:
+        """
+        Hold a retry slot of the namespace, first attempts are never limited
+        """
+        if retry == 0:
+            yield
+            return
+        semaphore = self._semaphores[namespace]
+        with metrics.QUEUE_DEPTH.labels("retry-slot").track_inprogress():
+            await semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+class Wakeups:
+    """
+    Wakes up the handlers waiting on a namespace when the watched objects of the namespace change.
+    """
+
+    def __init__(self):
+        self._events: Dict[str, asyncio.Event] = {}
+
+    def notify(self, namespace: str):
+        event = self._events.pop(namespace, None)
+        if event is not None:
+            event.set()
+
+    async def wait(self, namespace: str, timeout: Optional[float]) -> bool:
+        """
+        Wait for the next change in the namespace
+        :return: True if woken up by a change, False on timeout
+        """
+        event = self._events.setdefault(namespace, asyncio.Event())
+        try:
+            with metrics.QUEUE_DEPTH.labels("pre-requisites").track_inprogress():
+                await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
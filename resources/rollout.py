@@ -0,0 +1,99 @@
+# Run component rollouts as a dependency graph, so independent components are applied concurrently.
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, List, Sequence
+
+
+@dataclass
+class Step:
+    """
+    A single component of a rollout.
+
+    Attributes:
+        name (str): The name of the component, referenced by the steps depending on it.
+        action (Callable[[], Awaitable]): The coroutine function creating, updating or deleting the component.
+        after (Sequence[str]): The names of the steps which must succeed before this one starts.
+    """
+    name: str
+    action: Callable[[], Awaitable]
+    after: Sequence[str] = ()
+
+
+class RolloutError(Exception):
+    """
+    Raised when at least one step of a rollout failed.
+
+    Attributes:
+        phases (Dict[str, dict]): The per-step report, including the failed and skipped steps.
+    """
+
+    def __init__(self, phases: Dict[str, dict]):
+        self.phases = phases
+        failed = [f"{name}: {phase['error']}" for name, phase in phases.items() if phase['state'] == 'Failed']
+        super().__init__("; ".join(failed))
+
+
+async def run(steps: Iterable[Step]) -> Dict[str, dict]:
+    """
+    Run the steps concurrently, each one waiting only for the steps listed in its `after`
+    :param steps: The steps of the rollout
+    :return: A report per step with its state, its own duration and the time since the rollout started
+    :raises RolloutError: if any step failed; steps depending on a failed step are skipped
+    """
+    steps = {step.name: step for step in steps}
+    order = _topological_order(steps)
+    phases: Dict[str, dict] = {}
+    tasks: Dict[str, asyncio.Task] = {}
+    rollout_started = time.monotonic()
+
+    async def run_step(step: Step) -> bool:
+        prerequisites = await asyncio.gather(*(tasks[name] for name in step.after))
+        if not all(prerequisites):
+            phases[step.name] = {"state": "Skipped"}
+            return False
+        started = time.monotonic()
+        try:
+            await step.action()
+        except Exception as e:
+            phases[step.name] = {"state": "Failed", "error": str(e)}
+            return False
+        finished = time.monotonic()
+        phases[step.name] = {
+            "state": "Ready",
+            "seconds": round(finished - started, 3),
+            "readyAfterSeconds": round(finished - rollout_started, 3),
+        }
+        return True
+
+    for name in order:
+        tasks[name] = asyncio.create_task(run_step(steps[name]))
+    await asyncio.gather(*tasks.values())
+
+    # Report the phases in dependency order rather than completion order.
+    phases = {name: phases[name] for name in order}
+    if any(phase["state"] != "Ready" for phase in phases.values()):
+        raise RolloutError(phases)
+    return phases
+
+
+def _topological_order(steps: Dict[str, Step]) -> List[str]:
+    order: List[str] = []
+    visiting = set()
+
+    def visit(name: str):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Rollout step {name} is part of a dependency cycle")
+        if name not in steps:
+            raise ValueError(f"Unknown rollout step {name}")
+        visiting.add(name)
+        for dependency in steps[name].after:
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for step_name in steps:
+        visit(step_name)
+    return order
@@ -1,46 +1,16 @@
 # Create a safekeeper statefulset, service, and persistent volume claim.
-from typing import Any
+from typing import Any, List
 
 import kopf
 import kubernetes
-from kubernetes.client import V1ResourceRequirements, ApiException
+import kubernetes_asyncio
+from kubernetes.client import V1ResourceRequirements
 
+from resources import apply, metrics
 
-def deploy_safekeeper(
-        kube_client: kubernetes.client.ApiClient,
-        namespace: str,
-        resources: V1ResourceRequirements,
-        remote_storage_bucket_endpoint: Any,
-        remote_storage_bucket_name: Any,
-        remote_storage_bucket_region: Any,
-        remote_storage_prefix_in_bucket: Any = None,
-        image_pull_policy: str = "IfNotPresent",
-        image: str = "neondatabase/neon",
-        replicas: int = 3,
-):
-    deployment = safekeeper_statefulset(namespace=namespace, resources=resources,
-                                        remote_storage_bucket_endpoint=remote_storage_bucket_endpoint,
-                                        remote_storage_bucket_name=remote_storage_bucket_name,
-                                        remote_storage_bucket_region=remote_storage_bucket_region,
-                                        remote_storage_prefix_in_bucket=remote_storage_prefix_in_bucket,
-                                        image_pull_policy=image_pull_policy, image=image, replicas=replicas)
-    kopf.adopt(deployment)
-    service = safekeeper_service(namespace)
-    kopf.adopt(service)
-    # pvc = safekeeper_pvc(namespace)
-
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.create_namespaced_stateful_set(namespace=namespace, body=deployment)
-        core_client.create_namespaced_service(namespace=namespace, body=service)
-        # core_client.create_namespaced_persistent_volume_claim(namespace=namespace, body=pvc)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
 
-
-def update_safekeeper(
-        kube_client: kubernetes.client.ApiClient,
+async def apply_safekeeper(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
         resources: V1ResourceRequirements,
         remote_storage_bucket_endpoint: Any,
@@ -50,7 +20,8 @@ def update_safekeeper(
         image_pull_policy: str = "IfNotPresent",
         image: str = "neondatabase/neon",
         replicas: int = 3,
-):
+        desired_state: apply.DesiredState = None,
+) -> List[apply.ApplyResult]:
     deployment = safekeeper_statefulset(namespace=namespace, resources=resources,
                                         remote_storage_bucket_endpoint=remote_storage_bucket_endpoint,
                                         remote_storage_bucket_name=remote_storage_bucket_name,
@@ -62,29 +33,17 @@ def update_safekeeper(
     kopf.adopt(service)
     # pvc = safekeeper_pvc(namespace)
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.patch_namespaced_stateful_set(namespace=namespace, name="safekeeper", body=deployment)
-        core_client.patch_namespaced_service(namespace=namespace, name="safekeeper", body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [deployment, service], desired_state)
 
 
-def delete_safekeeper(
-        kube_client: kubernetes.client.ApiClient,
+async def delete_safekeeper(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.delete_namespaced_stateful_set(namespace=namespace, name="safekeeper")
-        core_client.delete_namespaced_service(namespace=namespace, name="safekeeper")
-        # core_client.delete_namespaced_persistent_volume_claim(namespace=namespace, name="safekeeper")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [("StatefulSet", "safekeeper"), ("Service", "safekeeper")])
 
 
+@metrics.builder
 def safekeeper_statefulset(
         namespace: str,
         resources: V1ResourceRequirements,
@@ -194,9 +153,11 @@ def safekeeper_statefulset(
         )
     )
 
+    apply.desired_hash(deployment)
     return deployment
 
 
+@metrics.builder
 def safekeeper_service(
         namespace: str,
 ) -> kubernetes.client.V1Service:
@@ -206,8 +167,12 @@ def safekeeper_service(
         metadata=kubernetes.client.V1ObjectMeta(
             name="safekeeper",
             namespace=namespace,
+            labels={"app": "safekeeper"},
         ),
         spec=kubernetes.client.V1ServiceSpec(
+            # Headless, the governing service of the StatefulSet: the computes reach each safekeeper by the dns name
+            # of its pod.
+            cluster_ip="None",
             selector={"app": "safekeeper"},
             ports=[
                 kubernetes.client.V1ServicePort(
@@ -224,9 +189,11 @@ def safekeeper_service(
         ),
     )
 
+    apply.desired_hash(service)
     return service
 
 
+@metrics.builder
 def safekeeper_pvc(
         namespace: str,
         storage: str = "1Gi",
@@ -243,7 +210,7 @@ def safekeeper_pvc(
         ),
         spec=kubernetes.client.V1PersistentVolumeClaimSpec(
             access_modes=access_modes,
-            resources=kubernetes.client.V1ResourceRequirements(
+            resources=kubernetes.client.V1VolumeResourceRequirements(
                 requests={"storage": storage},
             ),
         ),
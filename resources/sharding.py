@@ -0,0 +1,219 @@
+# Split the watched namespaces between operator replicas with Lease-based membership and consistent hashing.
+import asyncio
+import bisect
+import datetime
+import hashlib
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+import kubernetes_asyncio
+from kubernetes_asyncio.client import ApiException
+
+MEMBER_LABEL = "neon.tech/operator-shard-member"
+OWNER_ANNOTATION = "neon.tech/shard-owner"
+FINALIZER_PREFIX = "neon.tech/shard-"
+LEGACY_FINALIZER = "neon.tech/neon-finalizer"
+
+# The custom resources reconciled by the operator, moved between replicas when the shards rebalance.
+SHARDED_PLURALS = ("neondeployments", "neontenants", "neontimelines")
+
+
+def finalizer(member: str) -> str:
+    """
+    The finalizer of a replica, each replica only adds and removes its own one
+    """
+    return f"{FINALIZER_PREFIX}{member}"
+
+
+class HashRing:
+    """
+    A consistent hash ring mapping namespaces to the live operator replicas.
+
+    Every member is placed on the ring many times, so that a joining or leaving replica only moves
+    about 1/N of the namespaces and the load stays balanced.
+
+    Attributes:
+        members (List[str]): The sorted names of the live replicas.
+    """
+
+    def __init__(self, members: List[str], vnodes: int = 64):
+        self.members = sorted(set(members))
+        self._points = sorted((_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._keys = [point for point, _ in self._points]
+
+    def owner(self, namespace: str) -> Optional[str]:
+        """
+        The replica responsible for a namespace, None if there are no live replicas
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._keys, _hash(namespace)) % len(self._points)
+        return self._points[index][1]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big")
+
+
+class Shard:
+    """
+    The membership of this replica, renewed through its own Lease in the operator namespace.
+
+    Attributes:
+        member (str): The name of this replica, usually its pod name.
+        namespace (str): The namespace holding the membership leases.
+        ring (HashRing): The ring built from the last observed live members.
+    """
+
+    def __init__(self, kube_client: kubernetes_asyncio.client.ApiClient, member: str, namespace: str,
+                 lease_duration: int = 15, renew_interval: float = 5.0):
+        self.kube_client = kube_client
+        self.member = member
+        self.namespace = namespace
+        self.lease_duration = lease_duration
+        self.renew_interval = renew_interval
+        self.ring = HashRing([member])
+        self._valid_until = 0.0
+        self._logger = logging.getLogger(__name__)
+
+    def owns(self, namespace: str) -> bool:
+        """
+        Whether this replica reconciles the objects of a namespace.
+        A replica which could not renew its lease stops claiming anything, as others may have taken over.
+        """
+        if time.monotonic() > self._valid_until:
+            return False
+        return self.ring.owner(namespace) == self.member
+
+    async def join(self):
+        """
+        Register this replica and learn the current members, before any handler runs
+        """
+        await self._renew()
+        members = await self._live_members()
+        self.ring = HashRing(members)
+        # Objects left behind by replicas that are gone; the rest is picked up by kopf's initial listing.
+        await self._claim(self.ring, set(members))
+
+    async def run(self):
+        """
+        Keep the lease renewed and rebalance the namespaces whenever a replica joins or leaves
+        """
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                await self._renew()
+                members = await self._live_members()
+            except ApiException as e:
+                self._logger.warning(f"Failed to renew the shard membership of {self.member}: {e.status} {e.reason}")
+                continue
+            if members != self.ring.members:
+                previous, self.ring = self.ring, HashRing(members)
+                self._logger.info(f"Shard members changed from {previous.members} to {members}.")
+                try:
+                    await self._claim(previous, set(members))
+                except ApiException as e:
+                    self._logger.warning(f"Failed to claim the rebalanced objects: {e.status} {e.reason}")
+
+    async def leave(self):
+        """
+        Drop the lease so that the other replicas take over the namespaces of this one immediately
+        """
+        self._valid_until = 0.0
+        try:
+            await kubernetes_asyncio.client.CoordinationV1Api(self.kube_client).delete_namespaced_lease(
+                name=self._lease_name(), namespace=self.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+    def _lease_name(self) -> str:
+        return f"neon-operator-shard-{self.member}"
+
+    async def _renew(self):
+        coordination_client = kubernetes_asyncio.client.CoordinationV1Api(self.kube_client)
+        started = time.monotonic()
+        body = {
+            "apiVersion": "coordination.k8s.io/v1",
+            "kind": "Lease",
+            "metadata": {"name": self._lease_name(), "labels": {MEMBER_LABEL: "true"}},
+            "spec": {
+                "holderIdentity": self.member,
+                "leaseDurationSeconds": self.lease_duration,
+                "renewTime": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            },
+        }
+        try:
+            await coordination_client.patch_namespaced_lease(name=self._lease_name(), namespace=self.namespace,
+                                                             body=body)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            await coordination_client.create_namespaced_lease(namespace=self.namespace, body=body)
+        self._valid_until = started + self.lease_duration
+
+    async def _live_members(self) -> List[str]:
+        coordination_client = kubernetes_asyncio.client.CoordinationV1Api(self.kube_client)
+        leases = await coordination_client.list_namespaced_lease(namespace=self.namespace,
+                                                                 label_selector=f"{MEMBER_LABEL}=true")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        members = set()
+        for lease in leases.items:
+            spec = lease.spec
+            if spec.renew_time is None or spec.holder_identity is None:
+                continue
+            if spec.renew_time + datetime.timedelta(seconds=spec.lease_duration_seconds or 0) > now:
+                members.add(spec.holder_identity)
+        members.add(self.member)
+        return sorted(members)
+
+    async def _claim(self, previous: HashRing, members: Set[str]):
+        """
+        Touch the objects this replica just took over, so that kopf picks them up without waiting for a re-list,
+        and hand it the finalizers of replicas which are gone
+        """
+        custom_client = kubernetes_asyncio.client.CustomObjectsApi(self.kube_client)
+        for plural in SHARDED_PLURALS:
+            objects = await custom_client.list_cluster_custom_object(group="neon.tech", version="v1alpha1",
+                                                                     plural=plural)
+            for obj in objects.get("items", []):
+                metadata = obj["metadata"]
+                if self.ring.owner(metadata["namespace"]) != self.member:
+                    continue
+                finalizers = metadata.get("finalizers") or []
+                stale = [f for f in finalizers if _is_stale(f, members)]
+                if previous.owner(metadata["namespace"]) == self.member and not stale:
+                    continue
+                patch: Dict[str, dict] = {"metadata": {
+                    "annotations": {OWNER_ANNOTATION: self.member},
+                    "resourceVersion": metadata["resourceVersion"],
+                }}
+                if stale:
+                    # Take over the finalizer in a single write, so that an object being deleted
+                    # still gets its deletion handlers run by the new owner.
+                    kept = [f for f in finalizers if f not in stale and f != finalizer(self.member)]
+                    patch["metadata"]["finalizers"] = kept + [finalizer(self.member)]
+                try:
+                    await custom_client.patch_namespaced_custom_object(
+                        group="neon.tech", version="v1alpha1", plural=plural,
+                        namespace=metadata["namespace"], name=metadata["name"], body=patch,
+                        _content_type="application/merge-patch+json")
+                except ApiException as e:
+                    # A newer version is handled by the next event anyway.
+                    if e.status not in (404, 409):
+                        raise
+
+
+def _is_stale(name: str, members: Set[str]) -> bool:
+    if name == LEGACY_FINALIZER:
+        return True
+    return name.startswith(FINALIZER_PREFIX) and name[len(FINALIZER_PREFIX):] not in members
+
+
+def owns_namespace(namespace, memo, **_) -> bool:
+    """
+    Handler filter passing only the objects of the namespaces owned by this replica, every object when not sharded
+    """
+    shard: Optional[Shard] = memo.get("shard")
+    return shard is None or shard.owns(namespace)
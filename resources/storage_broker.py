@@ -1,15 +1,21 @@
+from typing import List
+
 import kopf
 import kubernetes
-from kubernetes.client import ApiException, V1ResourceRequirements
+import kubernetes_asyncio
+from kubernetes.client import V1ResourceRequirements
+
+from resources import apply, metrics
 
 
-def deploy_storage_broker(
-        kube_client: kubernetes.client.ApiClient,
+async def apply_storage_broker(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
         image: str = "neondatabase/neon:latest",
         replicas: int = 1,
         resources: V1ResourceRequirements = None,
-):
+        desired_state: apply.DesiredState = None,
+) -> List[apply.ApplyResult]:
     deployment = storage_broker_deployment(
         namespace=namespace,
         image=image,
@@ -19,52 +25,17 @@ def deploy_storage_broker(
     kopf.adopt(deployment)
     kopf.adopt(service)
 
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.create_namespaced_deployment(namespace=namespace, body=deployment)
-        core_client.create_namespaced_service(namespace=namespace, body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
-
-
-def update_storage_broker(
-        kube_client: kubernetes.client.ApiClient,
-        namespace: str,
-        image: str = "neondatabase/neon:latest",
-        replicas: int = 1,
-        resources: V1ResourceRequirements = None,
-):
-    deployment = storage_broker_deployment(namespace=namespace,
-                                           image=image,
-                                           replicas=replicas,
-                                           resources=resources)
-    service = storage_broker_service(namespace)
-    kopf.adopt(deployment)
-    kopf.adopt(service)
-
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.patch_namespaced_deployment(namespace=namespace, name="storage-broker", body=deployment)
-        core_client.patch_namespaced_service(namespace=namespace, name="storage-broker", body=service)
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+    return await apply.apply(kube_client, namespace, [deployment, service], desired_state)
 
 
-def delete_storage_broker(
-        kube_client: kubernetes.client.ApiClient,
+async def delete_storage_broker(
+        kube_client: kubernetes_asyncio.client.ApiClient,
         namespace: str,
-):
-    apps_client = kubernetes.client.AppsV1Api(kube_client)
-    core_client = kubernetes.client.CoreV1Api(kube_client)
-    try:
-        apps_client.delete_namespaced_deployment(namespace=namespace, name="storage-broker")
-        core_client.delete_namespaced_service(namespace=namespace, name="storage-broker")
-    except ApiException as e:
-        print("Exception when calling Api: %s\n" % e)
+) -> List[apply.ApplyResult]:
+    return await apply.delete(kube_client, namespace, [("Deployment", "storage-broker"), ("Service", "storage-broker")])
 
 
+@metrics.builder
 def storage_broker_deployment(
         namespace: str,
         image: str,
@@ -118,9 +89,11 @@ def storage_broker_deployment(
         spec=spec,
     )
 
+    apply.desired_hash(deployment)
     return deployment
 
 
+@metrics.builder
 def storage_broker_service(
         namespace: str,
 ) -> kubernetes.client.V1Service:
@@ -144,4 +117,5 @@ def storage_broker_service(
         ),
     )
 
+    apply.desired_hash(service)
     return service
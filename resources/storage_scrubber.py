@@ -1,11 +1,14 @@
 import kubernetes
 
+from resources import metrics
+
 
 # TODO:
 #  Need to port the s3_scrubber logic for k8s based installations.
 #  Currently s3_scrubber only supports cloud based projects.
 
 # Create CronJob for storage scrubber
+@metrics.builder
 def storage_scrubber_cronjob(
         namespace: str,
         image: str,